@@ -6,7 +6,11 @@
 #include <Wire.h>
 
 
-#define EMG_DATA_LENGTH 100 // At 2 bytes per sample, 2 sensors, and a sampling rate of 500 Hz, this buffer is 25 ms long. 
+#define EMG_CHANNELS 2 // one EMG channel per sensor
+#define EMG_MIN_SAMPLES 5 // least and most samples of each channel in an EMG packet, as PACKET_SAMPLES in the PC software (Schema.py)
+#define EMG_MAX_SAMPLES 100
+#define EMG_MAX_LENGTH (EMG_CHANNELS * 2 * EMG_MAX_SAMPLES) // size of the EMG buffer, at 2 bytes per sample
+#define MAX_SAMPLE_RATE 1000 // Hz, both sensors are read each sample with a 400 us wait between them
 #define IMP_DATA_LENGTH 16
 #define TMP_DATA_LENGTH 4
 #define CMD_DATA_LENGTH 4
@@ -31,7 +35,8 @@ enum {
   SEN_START_IMP_PER, // Starts the periodic sampling of the impedance and temperature
   SEN_SET_AD_RANGE, // Set the AD5933 output range
   SEN_SET_AD_PGA, // Set the AD5933 *TODO*
-  SEN_SET_REF_SW // *Deprecated* Switch the reference input electrode to the EMG or AD5933 subsystem
+  SEN_SET_REF_SW, // *Deprecated* Switch the reference input electrode to the EMG or AD5933 subsystem
+  SEN_SET_AD_FREQ // Set the AD5933 excitation frequency in kHz (2 bytes, low byte first), used for the reads that follow
 };
 
 // Enum for commands recieved from the PC display software 
@@ -50,10 +55,22 @@ enum {
   UNI_SET_AD_PGA_5, // Set AD5933 gain to 5
   UNI_SET_REF_SW_IMP, // Command to set reference switch to the AD5933 subsystem
   UNI_SET_REF_SW_EMG, // Command to set reference switch to the EMG subsystem
+  UNI_SET_AD_FREQ_1, // Set AD5933 excitation frequency to option 1 of ad_freq_khz, the options give the frequencies of an impedance sweep
+  UNI_SET_AD_FREQ_2,
+  UNI_SET_AD_FREQ_3,
+  UNI_SET_AD_FREQ_4,
+  UNI_SET_AD_FREQ_5,
+  UNI_SET_AD_FREQ_6,
+  UNI_SET_AD_FREQ_7,
+  UNI_SET_AD_FREQ_8,
 };
 
+// AD5933 excitation frequencies in kHz of the UNI_SET_AD_FREQ_ options, as SWEEP_FREQUENCIES in the PC software (Schema.py)
+const uint16_t ad_freq_khz[8] = {1, 2, 5, 10, 20, 30, 50, 100};
+
 // Data buffers. Headers and footers used to wrap buffers with 8 know bytes that the PC software can check for to identify what data packet has been recieved.
-byte emg_data[EMG_DATA_LENGTH]; // EMG data buffer
+byte emg_data[EMG_MAX_LENGTH]; // EMG data buffer
+int emg_data_length = 100; // bytes of EMG sent per packet. At 2 bytes per sample, 2 sensors, and a sampling rate of 500 Hz, a packet is 50 ms long. Set by the PC with UNI_OPEN
 byte emg_cmd[CMD_DATA_LENGTH] = {'E', 'M', 'G', ':'}; // EMG header
 byte emg_cmd_end[CMD_DATA_LENGTH] = {':', 'G', 'M', 'E'}; // EMG footer 
 byte imp_data[IMP_DATA_LENGTH]; // Impedance data buffer
@@ -81,7 +98,7 @@ long sample_timer; // stores the time of the last EMG sample taken in micros
 long sample_dif; 
 long led_timer; // stores the time of the last LED change in micros (1 s)
 long led_period = 1000000; // LED toggle period in micros
-long sample_period = 2000; // Duration between EMG samples in micros (2 ms == 500 Hz)
+long sample_period = 2000; // Duration between EMG samples in micros (2 ms == 500 Hz). Set by the PC with UNI_OPEN
 
 long sample_counter; // Used for testing samples per second 
 
@@ -197,7 +214,7 @@ void getTestSamples() {
     emg_data[sample_counter + i] = (byte)random(0, 255);
   }
   sample_counter += 4;
-  if (sample_counter == EMG_DATA_LENGTH) {
+  if (sample_counter >= emg_data_length) {
     sample_counter = 0;
     update_flag = true;
   }
@@ -232,10 +249,10 @@ void getRealSamples() {
   emg_data[sample_counter + 3] = lowByteT(bee);
 
   sample_counter += 4;
-  if (sample_counter == EMG_DATA_LENGTH) { // Test if buffer full, send to PC if so with EMG header and footer
+  if (sample_counter >= emg_data_length) { // Test if buffer full, send to PC if so with EMG header and footer
     sample_counter = 0;
     Serial.write(emg_cmd, CMD_DATA_LENGTH);
-    Serial.write(emg_data, EMG_DATA_LENGTH);
+    Serial.write(emg_data, emg_data_length);
     Serial.write(emg_cmd_end, CMD_DATA_LENGTH);
   }
 }
@@ -288,9 +305,17 @@ void readTMP(int addr, uint8_t * buf) {
 // Function to parse data over the Serial comm from the PC software
 void parseData() {
   newData = false;
-  if (receivedChars[0] == UNI_OPEN) { // Command checking if the port is open
+  if (receivedChars[0] == UNI_OPEN) { // Command checking if the port is open, optionally followed by "<rate>,<samples>" to set the EMG sampling
+    if (receivedChars[1] != '\0') {
+      setSampling(receivedChars + 1);
+    }
     Serial.write(resp_cmd, CMD_DATA_LENGTH);
-    Serial.write("HI"); // Respond with expected string "HI" and generic response header and footer
+    Serial.print("HI:"); // Respond with expected string "HI" followed by the EMG sampling in use, "HI:<rate>,<channels>,<samples>", in generic response header and footer
+    Serial.print(1000000 / sample_period);
+    Serial.print(",");
+    Serial.print(EMG_CHANNELS);
+    Serial.print(",");
+    Serial.print(emg_data_length / (2 * EMG_CHANNELS));
     Serial.write(resp_cmd_end, CMD_DATA_LENGTH);
   }
 
@@ -375,7 +400,7 @@ void parseData() {
     }
 
     
-	// AD5933 setup commands for adjusting gain and output voltage - unsused in actual program
+	// AD5933 setup commands for adjusting gain, output voltage and excitation frequency
     if (receivedChars[0] == UNI_SET_AD_RANGE_1) {
       setADRange(1);
     }
@@ -400,9 +425,29 @@ void parseData() {
     if (receivedChars[0] == UNI_SET_REF_SW_IMP) {
       setREFsw(1);
     }
+    if (receivedChars[0] >= UNI_SET_AD_FREQ_1 && receivedChars[0] <= UNI_SET_AD_FREQ_8) {
+      setADFreq(ad_freq_khz[receivedChars[0] - UNI_SET_AD_FREQ_1]);
+    }
   }
 }
 
+// Sets the EMG sample rate in Hz and the samples of each channel per packet from the text "<rate>,<samples>", as sent by the PC after UNI_OPEN.
+// A sampling the loop cannot keep to, or whose period is not a whole number of micros, is ignored and the reply gives the sampling left in use
+void setSampling(char * args) {
+  char * comma = strchr(args, ',');
+  if (comma == NULL) {
+    return;
+  }
+  long rate = atol(args);
+  long samples = atol(comma + 1);
+  if (rate <= 0 || rate > MAX_SAMPLE_RATE || 1000000 % rate != 0 || samples < EMG_MIN_SAMPLES || samples > EMG_MAX_SAMPLES) {
+    return;
+  }
+  sample_period = 1000000 / rate;
+  emg_data_length = samples * EMG_CHANNELS * 2;
+  sample_counter = 0; // drop any part filled packet, every packet sent after the reply has the new length
+}
+
 uint8_t writing_buf[2] = {0, 0};
 
 // Writes the specific command value to each sensor for the reference switch
@@ -466,6 +511,26 @@ void setADPGA(uint8_t val) {
 
 }
 
+// Writes the excitation frequency in kHz to each sensor for the AD5933 (SET_AD_FREQ of the sensor firmware, 1 to 100 kHz)
+void setADFreq(uint16_t khz) {
+  writing_buf[0] = lowByteT(khz);
+  writing_buf[1] = highByteT(khz);
+  
+  Wire.beginTransmission(0x08);
+  Wire.write(SEN_SET_AD_FREQ);
+  Wire.endTransmission();
+  Wire.beginTransmission(0x08);
+  Wire.write(writing_buf, 2);
+  Wire.endTransmission();
+  
+  Wire.beginTransmission(0x09);
+  Wire.write(SEN_SET_AD_FREQ);
+  Wire.endTransmission();
+  Wire.beginTransmission(0x09);
+  Wire.write(writing_buf, 2);
+  Wire.endTransmission();
+}
+
 // Simple function to query the sensor, err 0 indicates that the sensor has ACKed on the I2C bus and is present
 bool checkSensor(int addr) {
   Wire.beginTransmission(addr);
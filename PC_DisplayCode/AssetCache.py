@@ -0,0 +1,179 @@
+# Process wide cache for the image assets shown by the stimulus displays
+# Images are decoded once as QImages on a worker thread (QPixmaps may only be created on the GUI thread), then converted and shared by every widget that asks for them
+# Scaled copies are kept per requested size so a stimulus change or resize does not rescale the full size image each time
+
+import logging
+import os
+import time
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets") # resolve assets relative to this file so the program works from any working directory and on any OS
+
+# builds a platform independent path to an asset file
+def assetPath(name):
+    return os.path.join(ASSET_DIR, name)
+
+# Worker object moved onto a QThread, decodes each requested image file in turn and passes it back to the cache
+class ImageLoader(QObject):
+
+    sig_imageLoaded = pyqtSignal(str, QImage) # signal emitted for each decoded image (name, image)
+    sig_finished = pyqtSignal(float) # signal emitted when all images are decoded, with the time taken in seconds
+
+    def __init__(self, names):
+        super(ImageLoader, self).__init__()
+        self.names = names
+        self.logger = logging.getLogger("app_logger.ImageLoader")
+
+    def run(self):
+        tic = time.perf_counter()
+        for name in self.names:
+            image = QImage(assetPath(name))
+            if image.isNull():
+                self.logger.warning(f"Could not load asset {name}")
+            self.sig_imageLoaded.emit(name, image)
+        self.sig_finished.emit(time.perf_counter() - tic)
+
+# Worker object moved onto a QThread, scales a set of decoded images to one size and passes each back to the cache
+class ImageScaler(QObject):
+
+    sig_imageScaled = pyqtSignal(str, int, int, QImage) # signal emitted for each scaled image (name, w, h, image)
+    sig_finished = pyqtSignal(float) # signal emitted when all images are scaled, with the time taken in seconds
+
+    def __init__(self, images, w, h):
+        super(ImageScaler, self).__init__()
+        self.images = images
+        self.w = w
+        self.h = h
+
+    def run(self):
+        tic = time.perf_counter()
+        for name, image in self.images:
+            self.sig_imageScaled.emit(name, self.w, self.h, image.scaled(self.w, self.h, Qt.KeepAspectRatio))
+        self.sig_finished.emit(time.perf_counter() - tic)
+
+class PixmapCache(QObject):
+
+    sig_pixmapReady = pyqtSignal(str) # signal emitted when an asset is available for display, widgets waiting on it can then refresh
+
+    max_sizes = 4 # number of scaled sizes kept per image, old sizes are dropped when the window is dragged through many sizes
+
+    _instance = None
+
+    # access the single cache shared by the process, created on first use (must be after the QApplication exists)
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = PixmapCache()
+        return cls._instance
+
+    def __init__(self, *args, **kwargs):
+
+        super(PixmapCache, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.PixmapCache")
+
+        self.images = {} # decoded images by asset name, kept so scaling can be done away from the GUI thread
+        self.pixmaps = {} # full size pixmaps by asset name
+        self.scaled_pixmaps = {} # scaled pixmaps by asset name, each a dict of {(w, h): pixmap} in insertion order
+        self.pending = set() # names queued on a loader thread but not yet returned
+        self.loaders = [] # (thread, worker) pairs kept alive until they finish
+        self.pending_sizes = set() # (w, h) sizes currently being prescaled
+
+    # queue any assets not already loaded to be decoded in the background
+    def preload(self, names):
+        names = [n for n in dict.fromkeys(names) if n not in self.pixmaps and n not in self.pending]
+        if len(names) == 0:
+            return
+        self.pending.update(names)
+        thread = QThread()
+        loader = ImageLoader(names)
+        loader.moveToThread(thread)
+        thread.started.connect(loader.run)
+        loader.sig_imageLoaded.connect(self.imageLoaded)
+        loader.sig_finished.connect(self.loaderFinished)
+        self.logger.info(f"Decoding {len(names)} assets in background")
+        self.startWorker(thread, loader)
+        
+    # queue scaling of the given assets to (w, h) in the background, so a later stimulus change at this size is only a lookup
+    # assets that are still decoding are skipped, widgets request again once they are ready
+    def prescale(self, names, w, h):
+        if (w, h) in self.pending_sizes:
+            return
+        images = [(n, self.images[n]) for n in dict.fromkeys(names) if n in self.images and not self.images[n].isNull() and (w, h) not in self.scaled_pixmaps.get(n, {})]
+        if len(images) == 0:
+            return
+        self.pending_sizes.add((w, h))
+        thread = QThread()
+        scaler = ImageScaler(images, w, h)
+        scaler.moveToThread(thread)
+        thread.started.connect(scaler.run)
+        scaler.sig_imageScaled.connect(self.imageScaled)
+        scaler.sig_finished.connect(self.scalerFinished)
+        self.startWorker(thread, scaler)
+        
+    # common thread start for the decode and scale workers
+    def startWorker(self, thread, worker):
+        worker.sig_finished.connect(thread.quit)
+        thread.finished.connect(self.threadFinished)
+        self.loaders.append((thread, worker))
+        thread.start()
+
+    # callback on the GUI thread for each decoded image, converts to a pixmap and alerts waiting widgets
+    def imageLoaded(self, name, image):
+        self.pending.discard(name)
+        self.images[name] = image
+        self.pixmaps[name] = QPixmap.fromImage(image)
+        self.scaled_pixmaps.pop(name, None)
+        self.sig_pixmapReady.emit(name)
+
+    # callback on the GUI thread for each image scaled in the background
+    def imageScaled(self, name, w, h, image):
+        self.storeScaled(name, w, h, QPixmap.fromImage(image))
+
+    def loaderFinished(self, elapsed):
+        self.logger.info(f"Asset decode complete in {elapsed*1000:.1f} ms")
+        
+    def scalerFinished(self, elapsed):
+        scaler = self.sender()
+        self.pending_sizes.discard((scaler.w, scaler.h))
+        self.logger.debug(f"Prescaled {len(scaler.images)} assets to {scaler.w}x{scaler.h} in {elapsed*1000:.1f} ms")
+
+    # release the finished thread and its worker. finished is emitted before the thread has fully stopped, and destroying a QThread that is still stopping waits on it while holding the GIL,
+    # deadlocking with the thread if it needs the GIL to finish. wait() releases the GIL, so wait for it to stop before the last reference is dropped
+    def threadFinished(self):
+        thread = self.sender()
+        thread.wait()
+        self.loaders = [l for l in self.loaders if l[0] is not thread]
+
+    # whether the asset has been decoded yet
+    def isReady(self, name):
+        return name in self.pixmaps
+
+    # returns the full size pixmap, or a null pixmap if it is not yet decoded
+    def pixmap(self, name):
+        if name not in self.pixmaps:
+            self.preload([name])
+            return QPixmap()
+        return self.pixmaps[name]
+
+    # whether a scaled copy of the asset at (w, h) is already cached
+    def hasScaled(self, name, w, h):
+        return (w, h) in self.scaled_pixmaps.get(name, {})
+
+    # returns the pixmap scaled to fit (w, h) keeping aspect ratio, scaling on the GUI thread only if it was not prescaled
+    def scaled(self, name, w, h):
+        pixmap = self.pixmap(name)
+        if pixmap.isNull():
+            return pixmap
+        scaled = self.scaled_pixmaps.get(name, {}).get((w, h))
+        if scaled is None:
+            scaled = pixmap.scaled(w, h, Qt.KeepAspectRatio)
+            self.storeScaled(name, w, h, scaled)
+        return scaled
+        
+    def storeScaled(self, name, w, h, pixmap):
+        sizes = self.scaled_pixmaps.setdefault(name, {})
+        sizes[(w, h)] = pixmap
+        while len(sizes) > self.max_sizes:
+            del sizes[next(iter(sizes))] # drop the oldest size
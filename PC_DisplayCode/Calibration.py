@@ -0,0 +1,253 @@
+# Calibration of the AD5933 impedance readings of each board
+# A profile holds, for each electrode pair (FCU sen 1, FCU sen 2, ECR sen 1, ECR sen 2) at each excitation frequency calibrated, the polynomial giving the magnitude in ohms from the raw
+# magnitude and the open phase offset in degrees (phase = offset - raw phase), used by Engine.convertImpTemp. Profiles are saved as Calibration/<board serial number>.json and loaded when
+# that board connects, boards without one use DEFAULT_PROFILE, the coefficients fitted offline for the rig of the sEMG-MMD.
+# Calibrating (CalibrationRun, from the "Calibrate Impedance" control, see CalibrationWindow.py): the operator connects each reference load in turn across every electrode pair and the
+# AD5933 is read readings times at each frequency for it. Once all loads are measured the magnitude polynomials and phase offsets of every electrode and frequency are fitted
+# by least squares, the normal equations of all electrodes solved in one batched call, and the profile saved for the board
+# Profile file format (JSON):
+#   serial      - board serial number
+#   created     - date and time the profile was fitted
+#   loads       - the reference loads used, [resistance, capacitance] in ohms and farads
+#   frequencies - by frequency in Hz: "polynomials" (4 electrode pairs x [a, b, c], magnitude = a x^2 + b x + c), "phase_offsets" (4) and the fit's "rms" relative magnitude error and "phase_rms" in degrees
+
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+from PyQt5.QtCore import *
+
+from Clock import REAL_CLOCK
+from Commands import cmds
+from Schema import IT_FREQUENCY, SWEEP_FREQUENCIES
+
+CALIBRATION_DIR = "Calibration" # profiles are saved in this folder of the working directory
+
+ELECTRODES = 4 # electrode pairs, two per sensor
+
+# a reference load connected across an electrode pair while calibrating, a resistance in ohms with an optional capacitance in farads in parallel
+ReferenceLoad = namedtuple('ReferenceLoad', ['resistance', 'capacitance'], defaults=[0.0])
+
+DEFAULT_LOADS = [ReferenceLoad(r) for r in [1000, 2200, 4700, 10000, 22000, 47000]]
+
+# raised when a calibration cannot be made or a profile file is not valid, the message describes the problem
+class CalibrationError(Exception):
+    pass
+
+# complex impedance of a load at frequency in Hz
+def loadImpedance(load, frequency):
+    return load.resistance / (1 + 2j * np.pi * frequency * load.resistance * load.capacitance)
+
+# raw magnitude and phase in degrees of each electrode pair (..., 4) from AD5933 real and imaginary values (..., 8) as sent (signed int16 as unsigned)
+def rawPolar(imp):
+    as_i16 = np.asarray(imp, dtype=np.uint16).astype(np.int16).astype(np.float64)
+    return np.sqrt(as_i16[..., 0::2]**2 + as_i16[..., 1::2]**2), np.rad2deg(np.arctan2(as_i16[..., 1::2], as_i16[..., 0::2]))
+
+class CalibrationProfile:
+
+    # polynomials and phase_offsets are by frequency in Hz, arrays (4, 3) and (4,). rms and phase_rms, if given, are the errors of the fit by frequency
+    def __init__(self, serial, polynomials, phase_offsets, created=None, loads=None, rms=None, phase_rms=None):
+        self.serial = serial
+        self.polynomials = {f: np.asarray(p, dtype=np.float64) for f, p in polynomials.items()}
+        self.phase_offsets = {f: np.asarray(p, dtype=np.float64) for f, p in phase_offsets.items()}
+        self.created = created
+        self.loads = loads if loads is not None else []
+        self.rms = rms if rms is not None else {}
+        self.phase_rms = phase_rms if phase_rms is not None else {}
+
+    def frequencies(self):
+        return sorted(self.polynomials)
+
+    # the frequency whose calibration is used at frequency: that frequency if calibrated, otherwise IT_FREQUENCY if calibrated, otherwise the nearest
+    def calibratedFrequency(self, frequency):
+        if frequency in self.polynomials:
+            return frequency
+        if IT_FREQUENCY in self.polynomials:
+            return IT_FREQUENCY
+        return min(self.polynomials, key=lambda f: abs(f - frequency))
+
+    # magnitudes in ohms and phases in degrees (..., 4) from raw magnitudes and phases (..., 4) read at frequency
+    def convert(self, raw_magnitude, raw_phase, frequency=IT_FREQUENCY):
+        f = self.calibratedFrequency(frequency)
+        p = self.polynomials[f]
+        return (p[:, 0] * raw_magnitude + p[:, 1]) * raw_magnitude + p[:, 2], self.phase_offsets[f] - raw_phase
+
+    # raw magnitudes and phases (..., 4) that read as magnitudes and phases (..., 4) at frequency, the inverse of convert (for the simulated device)
+    def invert(self, magnitude, phase, frequency=IT_FREQUENCY):
+        f = self.calibratedFrequency(frequency)
+        a, b, c = self.polynomials[f].T
+        return (-b + np.sqrt(b**2 - 4 * a * (c - magnitude))) / (2 * a), self.phase_offsets[f] - phase
+
+    def describe(self):
+        if self.serial is None:
+            return "default calibration"
+        return f"calibration of board {self.serial} made {self.created}, at {', '.join(f'{f/1000:g}' for f in self.frequencies())} kHz"
+
+    def path(self, folder=CALIBRATION_DIR):
+        return os.path.join(folder, re.sub(r"[^A-Za-z0-9_-]", "_", self.serial) + ".json")
+
+    # save the profile for its board, replacing any earlier one. The file is written whole then renamed, so a board is never left with a partly written profile
+    def save(self, folder=CALIBRATION_DIR):
+        os.makedirs(folder, exist_ok=True)
+        raw = {"serial": self.serial, "created": self.created, "loads": [list(l) for l in self.loads], "frequencies": {}}
+        for f in self.frequencies():
+            raw["frequencies"][str(f)] = {"polynomials": self.polynomials[f].tolist(), "phase_offsets": self.phase_offsets[f].tolist(),
+                                          "rms": np.asarray(self.rms.get(f, [])).tolist(), "phase_rms": np.asarray(self.phase_rms.get(f, [])).tolist()}
+        path = self.path(folder)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(raw, f, indent=1)
+        os.replace(path + ".tmp", path)
+        return path
+
+# read a profile file, raises CalibrationError if it cannot be read or is not valid
+def readProfile(path):
+    try:
+        with open(path) as f:
+            raw = json.load(f)
+        polynomials, phase_offsets, rms, phase_rms = {}, {}, {}, {}
+        for key, entry in raw["frequencies"].items():
+            f = int(key)
+            polynomials[f] = np.array(entry["polynomials"], dtype=np.float64)
+            phase_offsets[f] = np.array(entry["phase_offsets"], dtype=np.float64)
+            rms[f] = np.array(entry.get("rms", []), dtype=np.float64)
+            phase_rms[f] = np.array(entry.get("phase_rms", []), dtype=np.float64)
+            if polynomials[f].shape != (ELECTRODES, 3) or phase_offsets[f].shape != (ELECTRODES,):
+                raise ValueError(f"wrong number of coefficients at {f} Hz")
+        if len(polynomials) == 0:
+            raise ValueError("no frequencies calibrated")
+        return CalibrationProfile(raw["serial"], polynomials, phase_offsets, raw.get("created"), [ReferenceLoad(*l) for l in raw.get("loads", [])], rms, phase_rms)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise CalibrationError(f"Could not read calibration {path}: {e}")
+
+# the profile saved for a board, or DEFAULT_PROFILE if there is none (or it cannot be read, which is logged)
+def loadProfile(serial, folder=CALIBRATION_DIR):
+    logger = logging.getLogger("app_logger.Calibration")
+    if serial:
+        path = CalibrationProfile(serial, {}, {}).path(folder)
+        if os.path.exists(path):
+            try:
+                profile = readProfile(path)
+                logger.info(f"Using {profile.describe()}")
+                return profile
+            except CalibrationError as e:
+                logger.error(f"{e}, using the default calibration")
+                return DEFAULT_PROFILE
+    logger.info(f"No calibration saved for board {serial}, using the default calibration")
+    return DEFAULT_PROFILE
+
+# the coefficients fitted offline for the sEMG-MMD rig, at IT_FREQUENCY, the two electrode pairs of a sensor sharing its coefficients
+DEFAULT_PROFILE = CalibrationProfile(None,
+    {IT_FREQUENCY: [[2.08553599726588e-06, 14.1943911679110, 39.1817314267489]] * 2 + [[7.95978542134756e-07, 14.1353065689958, 67.5674420365175]] * 2},
+    {IT_FREQUENCY: [96.991226597164020] * 2 + [95.3347889128904] * 2})
+
+# fit a profile for board serial from the readings of each load. raw is the AD5933 values read (loads, frequencies, readings, 8), frequencies in Hz.
+# The magnitude polynomial of each electrode pair is a least squares fit of the load magnitudes to the raw magnitudes of all readings, the raw magnitudes scaled so the normal equations
+# are well conditioned; the phase offset is the circular mean of load phase plus raw phase
+def fitProfile(serial, loads, frequencies, raw, created=None):
+    if len(loads) < 3:
+        raise CalibrationError("at least 3 reference loads are needed to fit the magnitude polynomials")
+    raw_magnitude, raw_phase = rawPolar(raw) # (loads, frequencies, readings, 4)
+    polynomials, phase_offsets, rms, phase_rms = {}, {}, {}, {}
+    for i, f in enumerate(frequencies):
+        z = np.array([loadImpedance(l, f) for l in loads])
+        x = np.moveaxis(raw_magnitude[:, i], 2, 0).reshape(ELECTRODES, -1) # (4, loads * readings)
+        y = np.repeat(np.abs(z), raw.shape[2])
+        scale = x.max(axis=1, keepdims=True)
+        xs = x / scale
+        v = np.stack([xs**2, xs, np.ones_like(xs)], axis=2) # (4, loads * readings, 3)
+        c = np.linalg.solve(np.einsum('emi,emj->eij', v, v), np.einsum('emi,m->ei', v, y)[:, :, None])[:, :, 0]
+        polynomials[f] = c / np.hstack([scale**2, scale, np.ones_like(scale)])
+        phase = np.angle(z, deg=True)[:, None, None] + raw_phase[:, i] # (loads, readings, 4) the offset each reading gives
+        phase_offsets[f] = np.angle(np.mean(np.exp(1j * np.deg2rad(phase)), axis=(0, 1)), deg=True)
+        p = polynomials[f]
+        rms[f] = np.sqrt(np.mean((((p[:, :1] * x + p[:, 1:2]) * x + p[:, 2:]) / y - 1)**2, axis=1))
+        phase_rms[f] = np.sqrt(np.mean(((phase - phase_offsets[f] + 180) % 360 - 180)**2, axis=(0, 1)))
+    return CalibrationProfile(serial, polynomials, phase_offsets, created, list(loads), rms, phase_rms)
+
+class CalibrationRun(QObject):
+
+    sig_progress = pyqtSignal(int, int) # signal emitted with each reading of a load (readings taken, readings needed)
+    sig_loadDone = pyqtSignal(int) # signal emitted when a load has been measured (its index), the next can be connected
+    sig_finished = pyqtSignal(object) # signal emitted once every load is measured, with the fitted CalibrationProfile
+    sig_failed = pyqtSignal(str) # signal emitted if a load could not be measured, with the reason
+
+    readings = 20 # readings of each load at each frequency
+    reading_timeout = 2000 # ms to wait for each reading before the measurement is abandoned
+
+    # commands are sent through link (a SerialLink) and the timeout timed by clock (see Clock.py). loads are ReferenceLoads, frequencies a subset of SWEEP_FREQUENCIES
+    def __init__(self, link, serial, loads, frequencies=(IT_FREQUENCY,), readings=None, clock=REAL_CLOCK, *args, **kwargs):
+
+        super(CalibrationRun, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.CalibrationRun")
+
+        if len(loads) < 3:
+            raise CalibrationError("at least 3 reference loads are needed to fit the magnitude polynomials")
+        self.link = link
+        self.serial = serial
+        self.loads = list(loads)
+        self.frequencies = list(frequencies)
+        if readings is not None:
+            self.readings = readings
+        self.clock = clock
+        self.raw = np.zeros((len(self.loads), len(self.frequencies), self.readings, 8), dtype=np.uint16)
+        self.measured = np.zeros(len(self.loads), dtype=bool)
+        self.running = False
+        self.load = None # index of the load being measured
+        self.taken = 0 # readings of it taken so far, across all frequencies
+
+        self.timer = clock.timer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.timeout)
+
+    # begin measuring load index, which the operator has connected across every electrode pair
+    def measure(self, index):
+        if self.running:
+            return
+        self.logger.info(f"Measuring load {index+1} of {len(self.loads)}: {self.loads[index].resistance:g} ohm, {self.loads[index].capacitance:g} F")
+        self.running = True
+        self.load = index
+        self.taken = 0
+        self.request()
+
+    # ask for the next reading, setting the frequency first when moving on to the next
+    def request(self):
+        f, n = divmod(self.taken, self.readings)
+        if n == 0:
+            self.link.sendCommand(cmds[f"SET_AD_FREQ_{SWEEP_FREQUENCIES.index(self.frequencies[f]) + 1}"])
+        self.link.sendCommand(cmds.IMP_TMP)
+        self.timer.start(self.reading_timeout)
+
+    # abandon a measurement, e.g. when the connection is lost. Loads already measured are kept
+    def stop(self):
+        self.timer.stop()
+        self.running = False
+
+    def timeout(self):
+        self.stop()
+        self.link.sendCommand(cmds[f"SET_AD_FREQ_{SWEEP_FREQUENCIES.index(IT_FREQUENCY) + 1}"])
+        self.sig_failed.emit(f"No reading from the sensors within {self.reading_timeout} ms")
+
+    # callback for each raw AD5933 reading (8 values) while measuring
+    def addReading(self, imp):
+        f, n = divmod(self.taken, self.readings)
+        self.raw[self.load, f, n] = imp
+        self.taken += 1
+        self.sig_progress.emit(self.taken, self.readings * len(self.frequencies))
+        if self.taken < self.readings * len(self.frequencies):
+            self.request()
+            return
+        self.stop()
+        self.link.sendCommand(cmds[f"SET_AD_FREQ_{SWEEP_FREQUENCIES.index(IT_FREQUENCY) + 1}"]) # single reads are made at this frequency again
+        self.measured[self.load] = True
+        self.sig_loadDone.emit(self.load)
+        if self.measured.all():
+            tic = time.perf_counter()
+            profile = fitProfile(self.serial, self.loads, self.frequencies, self.raw, QDateTime.currentDateTime().toString("yyyy-MM-dd hh:mm:ss"))
+            self.logger.info(f"Fitted {len(self.frequencies)} frequencies in {(time.perf_counter() - tic)*1000:.1f} ms, magnitude rms error up to "
+                             f"{max(e.max() for e in profile.rms.values()):.2%}, phase rms error up to {max(e.max() for e in profile.phase_rms.values()):.2f} degrees")
+            self.sig_finished.emit(profile)
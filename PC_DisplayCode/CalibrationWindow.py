@@ -0,0 +1,129 @@
+# Pop up window to calibrate the impedance readings of the connected board (see Calibration.py)
+# The operator enters the reference loads and readings per load, then connects each load in turn across every electrode pair and presses Measure.
+# Once all loads are measured the fitted profile's errors are shown, and Save stores it for the board and puts it in use. Closing the window without saving keeps the calibration in use
+
+import logging
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+
+from Calibration import DEFAULT_LOADS, CalibrationError, CalibrationRun, ReferenceLoad
+from Schema import IT_FREQUENCY, SWEEP_FREQUENCIES
+
+class CalibrationWindow(QDialog):
+
+    def __init__(self, engine, *args, **kwargs):
+
+        super(CalibrationWindow, self).__init__(*args, **kwargs)
+        self.setWindowTitle("Impedance Calibration")
+
+        self.logger = logging.getLogger("app_logger.CalibrationWindow")
+
+        self.engine = engine
+        self.run = None # CalibrationRun once started
+        self.profile = None # fitted profile waiting to be saved
+        self.next_load = 0
+
+        # setup widgets, fields for the loads and readings, an instruction label, progress of the load being measured and the action buttons
+        self.logger.info("Setting up widgets.")
+        description = engine.calibration.describe()
+        self.lbs = QLabel(description[:1].upper() + description[1:])
+        self.lel = QLineEdit(", ".join(f"{l.resistance:g}" for l in DEFAULT_LOADS)) # reference resistances in ohms
+        self.sbr = QSpinBox()
+        self.sbr.setRange(5, 500)
+        self.sbr.setValue(CalibrationRun.readings)
+        self.cbsf = QCheckBox() # calibrate every sweep frequency rather than the single read frequency
+        self.lin = QLabel("Enter the reference loads then press Start.")
+        self.lin.setWordWrap(True)
+        self.pbp = QProgressBar()
+        self.pbs = QPushButton("Start")
+        self.pbm = QPushButton("Measure")
+        self.pbsv = QPushButton("Save")
+        self.pbm.setEnabled(False)
+        self.pbsv.setEnabled(False)
+
+        self.logger.info("Setting up signals.")
+        self.pbs.pressed.connect(self.start)
+        self.pbm.pressed.connect(self.measure)
+        self.pbsv.pressed.connect(self.save)
+        engine.sig_serialError.connect(self.serialError)
+
+        self.logger.info("Setting up layout.")
+        layout = QFormLayout()
+        layout.addRow(QLabel("In use:"), self.lbs)
+        layout.addRow(QLabel("Reference loads (Ω):"), self.lel)
+        layout.addRow(QLabel("Readings per load:"), self.sbr)
+        layout.addRow(QLabel("Every sweep frequency:"), self.cbsf)
+        layout.addRow(self.lin)
+        layout.addRow(self.pbp)
+        layout_b = QHBoxLayout()
+        layout_b.addWidget(self.pbs)
+        layout_b.addWidget(self.pbm)
+        layout_b.addWidget(self.pbsv)
+        layout.addRow(layout_b)
+        self.setLayout(layout)
+
+    # read the loads and begin the calibration, prompting for the first load
+    def start(self):
+        try:
+            loads = [ReferenceLoad(float(v)) for v in self.lel.text().replace(";", ",").split(",") if v.strip() != ""]
+            if any(l.resistance <= 0 for l in loads):
+                raise ValueError("loads must be positive")
+            frequencies = SWEEP_FREQUENCIES if self.cbsf.isChecked() else [IT_FREQUENCY]
+            self.run = self.engine.startCalibration(loads, frequencies, self.sbr.value())
+        except (ValueError, CalibrationError) as e:
+            QMessageBox.warning(self, "Calibration not started", str(e))
+            return
+        self.run.sig_progress.connect(self.progress)
+        self.run.sig_loadDone.connect(self.loadDone)
+        self.run.sig_finished.connect(self.finished)
+        self.run.sig_failed.connect(self.failed)
+        for w in [self.pbs, self.lel, self.sbr, self.cbsf]:
+            w.setEnabled(False)
+        self.next_load = 0
+        self.prompt()
+
+    def prompt(self):
+        load = self.run.loads[self.next_load]
+        self.lin.setText(f"Connect load {self.next_load+1} of {len(self.run.loads)} ({load.resistance:g} Ω) across every electrode pair, then press Measure.")
+        self.pbm.setEnabled(True)
+
+    def measure(self):
+        self.pbm.setEnabled(False)
+        self.lin.setText(f"Measuring load {self.next_load+1} of {len(self.run.loads)}...")
+        self.run.measure(self.next_load)
+
+    def progress(self, taken, needed):
+        self.pbp.setMaximum(needed)
+        self.pbp.setValue(taken)
+
+    def loadDone(self, index):
+        self.next_load = index + 1
+        if self.next_load < len(self.run.loads):
+            self.prompt()
+
+    # show the errors of the fit at each frequency, the profile is kept until Save is pressed
+    def finished(self, profile):
+        self.profile = profile
+        lines = [f"{f/1000:g} kHz: magnitude error {' '.join(f'{e:.2%}' for e in profile.rms[f])}, phase error {' '.join(f'{e:.2f}' for e in profile.phase_rms[f])}°" for f in profile.frequencies()]
+        self.lin.setText("Calibration fitted, rms error of each electrode pair:\n" + "\n".join(lines) + "\nSave to use it for this board.")
+        self.pbsv.setEnabled(True)
+
+    def failed(self, reason):
+        self.lin.setText(f"{reason}. Check the sensors then press Measure to try load {self.next_load+1} again.")
+        self.pbm.setEnabled(True)
+
+    def serialError(self):
+        self.lin.setText("Connection lost, calibration abandoned.")
+        self.pbm.setEnabled(False)
+        self.pbsv.setEnabled(False)
+
+    def save(self):
+        self.engine.applyCalibration(self.profile)
+        self.accept()
+
+    # the engine ends the calibration however the window is closed, a profile is only used once saved
+    def done(self, result):
+        self.engine.sig_serialError.disconnect(self.serialError)
+        self.engine.endCalibration()
+        super(CalibrationWindow, self).done(result)
@@ -0,0 +1,270 @@
+# Catalog of every task recorded in a results folder, an SQLite database (<results folder>/catalog.sqlite) so questions about the collected data are answered in ms without rescanning the recordings
+#   tasks       - one row per task of each participant: its sample rate, samples, duration, start time and packets, the mean impedance and temperature of each sensor over its IT readings,
+#                 the signal quality flags raised during it (see SignalQuality.py), and the size and modification time of its file when catalogued
+#   repetitions - one row per repetition of a grip (a run of samples with the same non-rest class, counted from 1 within the task as Dataset.py does): its first sample and the sample after its last,
+#                 its time from the task start and duration, the mean impedance and temperature of the IT readings saved from its start up to the next repetition (with it_read "activation" there is
+#                 one, made just after it), the quality flags raised during it, and the byte offset in the task file of the packet holding its first sample with that packet's first sample,
+#                 so it can be read without reading the file from the start
+# The engine adds each task as it completes, from the packets, transitions, IT readings and quality flags the recorder wrote (see TaskRecorder.index), so nothing is read back from disk.
+# Tasks recorded before the catalog existed, or changed since they were catalogued, are added by rescanning their files (through the review files of SessionStore.py)
+# Impedances are the calibrated magnitudes in ohms averaged over the sensor's two electrodes, temperatures are in C. Tasks with it_sweep save their readings apart from the EMG, so have no impedance here
+# e.g.
+#   catalog = Catalog("Results")
+#   for rep in catalog.repetitions("grip_name = ? AND fcu_impedance < ?", ("Power Sphere", 40000)): print(rep["participant"], rep["file"], rep["repetition"], rep["start"], rep["stop"])
+# usage: python Catalog.py build [results folder] [--protocol <file>]   catalog the tasks not yet catalogued or changed since, and remove those no longer recorded
+#        python Catalog.py query "<condition>" [results folder]       list the repetitions meeting an SQL condition on their columns, and the time the query took
+
+import csv
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from Journal import readJournal
+from Schema import DEFAULT_SAMPLING, IMP
+from SessionStore import TaskRecording, taskFiles
+from SignalQuality import SENSORS
+
+CATALOG_NAME = "catalog.sqlite"
+
+# what the recorder saw of a task, in sample indices from the task start: the samples written, the first sample, wall time (s since the epoch) and byte offset in the task file of each packet,
+# each label transition, the IT values saved with each packet that had them (as itValues), and each change of quality flags as (index, channel, flags)
+TaskIndex = namedtuple('TaskIndex', ['samples', 'packet_index', 'packet_time', 'packet_offset', 'transition_index', 'transition_label', 'it_index', 'it_values', 'quality'])
+
+# positions in the IT values of the calibrated magnitudes and temperatures (see Schema.itValues), after the raw AD5933 values and before the phases
+IT_MAGNITUDES = slice(IMP.count, IMP.count + 4)
+IT_TEMPERATURES = slice(IMP.count + 8, IMP.count + 10)
+
+TASK_COLUMNS = ["participant", "task", "name", "file", "format", "sample_rate", "samples", "duration", "started", "packets", "it_readings",
+                "fcu_impedance", "ecr_impedance", "fcu_temperature", "ecr_temperature", "fcu_quality", "ecr_quality", "size", "modified"]
+REPETITION_COLUMNS = ["participant", "task", "file", "grip", "grip_name", "repetition", "start", "stop", "time", "duration", "it_readings",
+                      "fcu_impedance", "ecr_impedance", "fcu_temperature", "ecr_temperature", "fcu_quality", "ecr_quality", "file_offset", "offset_sample"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tasks ({", ".join(TASK_COLUMNS)}, PRIMARY KEY (participant, file));
+CREATE TABLE IF NOT EXISTS repetitions ({", ".join(REPETITION_COLUMNS)});
+CREATE INDEX IF NOT EXISTS repetitions_task ON repetitions (participant, file);
+CREATE INDEX IF NOT EXISTS repetitions_grip ON repetitions (grip_name, fcu_impedance);
+CREATE INDEX IF NOT EXISTS repetitions_ecr ON repetitions (grip_name, ecr_impedance);
+"""
+
+# mean of each column of rows, None where a column has no values (a query on it then never matches)
+def _means(rows):
+    means = []
+    for column in rows.T:
+        valid = column[~np.isnan(column)]
+        means.append(float(valid.mean()) if len(valid) > 0 else None)
+    return means
+
+# flags of each channel raised at any point in samples [start, stop), from quality changes sorted by index per channel {channel: (indices, flags)}
+def _flagsDuring(changes, start, stop):
+    flags = []
+    for c in range(len(SENSORS)):
+        indices, values = changes.get(c, (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)))
+        first = max(np.searchsorted(indices, start, side='right') - 1, 0) # the flags in effect at start
+        last = np.searchsorted(indices, stop, side='left')
+        flags.append(int(np.bitwise_or.reduce(values[first:last])) if last > first else 0)
+    return flags
+
+# the tasks row and repetitions rows of a task. number is its task number in the protocol (None if not in it), grips the protocol's grips for their names
+def taskRows(participant, number, name, file, source_path, sample_rate, index, grips=()):
+    samples = index.samples
+    packet_index = np.asarray(index.packet_index, dtype=np.int64)
+    packet_offset = np.asarray(index.packet_offset, dtype=np.int64)
+    it_index = np.asarray(index.it_index, dtype=np.int64)
+    it_values = np.full((len(index.it_values), IT_TEMPERATURES.stop), np.nan)
+    for i, values in enumerate(index.it_values):
+        values = np.asarray(values, dtype=float)[:IT_TEMPERATURES.stop]
+        it_values[i, :len(values)] = values
+    magnitudes = it_values[:, IT_MAGNITUDES]
+    it = np.column_stack([magnitudes[:, 0:2].mean(axis=1), magnitudes[:, 2:4].mean(axis=1), it_values[:, IT_TEMPERATURES]]) # fcu, ecr impedance, fcu, ecr temperature
+    changes = {}
+    for c in range(len(SENSORS)):
+        rows = sorted((i, f) for i, ch, f in index.quality if ch == c)
+        changes[c] = (np.asarray([i for i, f in rows], dtype=np.int64), np.asarray([f for i, f in rows], dtype=np.int64))
+
+    # runs of samples with the same class, a transition to the class already in effect continues the run
+    transition_index = np.asarray(index.transition_index, dtype=np.int64)
+    transition_label = np.asarray(index.transition_label, dtype=np.int64)
+    starts, labels = [0], [0] # rest until the first transition
+    for i, label in zip(transition_index, transition_label):
+        if i >= samples or label == labels[-1]:
+            continue
+        if i == starts[-1]: # replaces a run that had no samples
+            starts.pop()
+            labels.pop()
+            if len(labels) > 0 and labels[-1] == label:
+                continue
+        starts.append(int(i))
+        labels.append(int(label))
+    stops = starts[1:] + [samples]
+    grip_runs = [(start, stop, label) for start, stop, label in zip(starts, stops, labels) if label != 0 and stop > start]
+
+    repetitions = []
+    counts = {}
+    for k, (start, stop, label) in enumerate(grip_runs):
+        counts[label] = counts.get(label, 0) + 1
+        until = grip_runs[k+1][0] if k + 1 < len(grip_runs) else samples # readings up to the next repetition
+        readings = it[(it_index >= start) & (it_index < until)]
+        p = max(np.searchsorted(packet_index, start, side='right') - 1, 0)
+        repetitions.append([participant, number, file, label, grips[label-1].name if 0 < label <= len(grips) else None, counts[label], start, stop,
+                            start / sample_rate, (stop - start) / sample_rate, len(readings)] + _means(readings) + _flagsDuring(changes, start, stop)
+                           + [int(packet_offset[p]) if len(packet_offset) > 0 else None, int(packet_index[p]) if len(packet_index) > 0 else None])
+
+    # a task that received no packets (e.g. the device was lost for all of it) has no file
+    size, modified = (os.path.getsize(source_path), os.path.getmtime(source_path)) if os.path.exists(source_path) else (0, None)
+    task = [participant, number, name, file, os.path.splitext(source_path)[1][1:], sample_rate, samples, samples / sample_rate,
+            float(index.packet_time[0]) if len(index.packet_time) > 0 else None, len(packet_index), len(it)] + _means(it) + _flagsDuring(changes, 0, samples) + [size, modified]
+    return task, repetitions
+
+# the TaskIndex of a recorded task read back from its files, for tasks not catalogued as they were recorded. The byte offset of each packet is found from the newlines of the csv, or for compressed
+# recordings is the offset of the chunk holding it, as the recorder gives
+def indexFromFiles(results_path, file):
+    recording = TaskRecording(results_path, file)
+    packet_index = recording.packet_index
+    if recording.source_path.endswith(".emgz"):
+        from Compression import EmgzReader
+        reader = EmgzReader(recording.source_path)
+        packet_offset = reader.offsets[np.maximum(np.searchsorted(reader.firsts, packet_index, side='right') - 1, 0)] if len(reader.offsets) > 0 else np.zeros(len(packet_index), dtype=np.int64)
+    else:
+        with open(recording.source_path, 'rb') as f:
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+        row_offsets = np.concatenate([[0], np.flatnonzero(data == ord("\n")) + 1])
+        packet_offset = row_offsets[packet_index]
+    quality = []
+    quality_path = os.path.join(results_path, file + "_quality.csv")
+    if os.path.exists(quality_path):
+        with open(quality_path, newline='') as f:
+            quality = [(int(row[4]), int(row[1]), int(row[2])) for row in csv.reader(f) if len(row) >= 5] # a partial last row of an interrupted task is skipped
+    return TaskIndex(len(recording), packet_index, recording.packet_time, packet_offset, recording.transition_index, recording.transition_label,
+                     recording.it_index, recording.it_values, quality)
+
+class Catalog:
+
+    # results_dir holds the PID<n> participant folders (Engine.RESULTS_DIR). protocol, if given, numbers the tasks and names the grips (see Protocol.py)
+    def __init__(self, results_dir="Results", protocol=None, name=CATALOG_NAME):
+        self.logger = logging.getLogger("app_logger.Catalog")
+        self.results_dir = results_dir
+        self.protocol = protocol
+        os.makedirs(results_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(results_dir, name))
+        self.db.row_factory = sqlite3.Row # rows are read by column name or position
+        self.db.execute("PRAGMA journal_mode=WAL") # readers, e.g. a training script, are not blocked while a task is added
+        self.db.executescript(SCHEMA)
+
+    # add or replace a task of a participant (int) from its TaskIndex. Returns False, with the error logged, if the catalog could not be written; the task can be added later by build
+    def addTask(self, participant, number, name, file, source_path, sample_rate, index):
+        grips = self.protocol.grips if self.protocol is not None else ()
+        task, repetitions = taskRows(participant, number, name, file, source_path, sample_rate, index, grips)
+        try:
+            with self.db: # one transaction, readers see the task's old rows or all of its new ones
+                self.db.execute("DELETE FROM tasks WHERE participant = ? AND file = ?", (participant, file))
+                self.db.execute("DELETE FROM repetitions WHERE participant = ? AND file = ?", (participant, file))
+                self.db.execute(f"INSERT INTO tasks VALUES ({', '.join('?' * len(TASK_COLUMNS))})", task)
+                self.db.executemany(f"INSERT INTO repetitions VALUES ({', '.join('?' * len(REPETITION_COLUMNS))})", repetitions)
+        except sqlite3.Error as e:
+            self.logger.error(f"Could not catalog PID{participant} {file}: {e}")
+            return False
+        self.logger.info(f"Catalogued PID{participant} {file}: {index.samples} samples, {len(repetitions)} repetitions")
+        return True
+
+    # protocol task number of a task file, None if the protocol does not have it
+    def taskNumber(self, file):
+        if self.protocol is not None:
+            for number, task in enumerate(self.protocol.tasks, 1):
+                if task.file == file:
+                    return number
+        return None
+
+    # catalog every task recorded that is not yet catalogued or has changed since, and remove the tasks no longer recorded. Tasks the journal shows were started and not ended (still recording,
+    # or interrupted and not yet recovered) are left out. Returns the number of tasks added and removed
+    def build(self):
+        recorded = set()
+        added = 0
+        for folder in sorted(os.listdir(self.results_dir)):
+            match = re.fullmatch(r"PID(\d+)", folder)
+            path = os.path.join(self.results_dir, folder)
+            if match is None or not os.path.isdir(path):
+                continue
+            participant = int(match.group(1))
+            # the sample rate of each task and whether it ended, from the last journal entry of its file
+            last = {}
+            for entry in readJournal(path):
+                if "file" in entry and entry["type"] != "checkpoint":
+                    last[entry["file"]] = entry if entry["type"] != "task_end" else dict(last.get(entry["file"], {}), type="task_end")
+            # a task that ended without receiving a packet has no files, and is catalogued as it ended with no samples (see AcquisitionEngine.processTask), so is kept
+            files = taskFiles(path)
+            recorded.update((participant, file) for file, entry in last.items() if entry["type"] == "task_end" and file not in files)
+            for file in files:
+                entry = last.get(file)
+                if entry is not None and entry["type"] != "task_end":
+                    continue
+                recorded.add((participant, file))
+                source_path = os.path.join(path, file + ".csv")
+                if not os.path.exists(source_path):
+                    source_path = os.path.join(path, file + ".emgz")
+                stat = os.stat(source_path)
+                row = self.db.execute("SELECT size, modified FROM tasks WHERE participant = ? AND file = ?", (participant, file)).fetchone()
+                if row is not None and (row["size"], row["modified"]) == (stat.st_size, stat.st_mtime):
+                    continue
+                number = self.taskNumber(file)
+                name = self.protocol.tasks[number-1].name if number is not None else file
+                sample_rate = (entry or {}).get("sample_rate", DEFAULT_SAMPLING.sample_rate) # journals from before the sampling was recorded are of the default
+                if self.addTask(participant, number, name, file, source_path, sample_rate, indexFromFiles(path, file)):
+                    added += 1
+        removed = [(row["participant"], row["file"]) for row in self.db.execute("SELECT participant, file FROM tasks") if (row["participant"], row["file"]) not in recorded]
+        with self.db:
+            for participant, file in removed:
+                self.db.execute("DELETE FROM tasks WHERE participant = ? AND file = ?", (participant, file))
+                self.db.execute("DELETE FROM repetitions WHERE participant = ? AND file = ?", (participant, file))
+        self.logger.info(f"Catalog of {self.results_dir} built: {added} tasks added, {len(removed)} removed")
+        return added, len(removed)
+
+    # repetitions meeting an SQL condition on their columns, with the values of its ? parameters, in recording order
+    def repetitions(self, condition="1", parameters=()):
+        return self.db.execute(f"SELECT * FROM repetitions WHERE {condition} ORDER BY participant, task, file, start", parameters).fetchall()
+
+    # tasks meeting an SQL condition on their columns, as repetitions
+    def tasks(self, condition="1", parameters=()):
+        return self.db.execute(f"SELECT * FROM tasks WHERE {condition} ORDER BY participant, task, file", parameters).fetchall()
+
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    logger = logging.getLogger("app_logger")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    args = sys.argv[1:]
+    protocol = None
+    if "--protocol" in args:
+        i = args.index("--protocol")
+        from Protocol import loadProtocol
+        protocol = loadProtocol(args[i+1])
+        del args[i:i+2]
+    if len(args) < 1 or args[0] not in ["build", "query"] or (args[0] == "query" and len(args) < 2):
+        print("usage: python Catalog.py build [results folder] [--protocol <file>]\n       python Catalog.py query \"<condition>\" [results folder]")
+        sys.exit(2)
+    if args[0] == "build":
+        if protocol is None:
+            from Protocol import DEFAULT_PROTOCOL, loadProtocol
+            protocol = loadProtocol(DEFAULT_PROTOCOL)
+        catalog = Catalog(args[1] if len(args) > 1 else "Results", protocol)
+        tic = time.perf_counter()
+        added, removed = catalog.build()
+        print(f"{added} tasks added, {removed} removed in {time.perf_counter() - tic:.1f} s")
+    else:
+        catalog = Catalog(args[2] if len(args) > 2 else "Results")
+        tic = time.perf_counter()
+        rows = catalog.repetitions(args[1])
+        toc = time.perf_counter()
+        print(", ".join(REPETITION_COLUMNS))
+        for row in rows:
+            print(", ".join("" if v is None else f"{v:.6g}" if isinstance(v, float) else str(v) for v in row))
+        print(f"{len(rows)} repetitions in {(toc - tic)*1000:.1f} ms")
+    catalog.close()
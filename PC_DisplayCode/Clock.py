@@ -0,0 +1,147 @@
+# Clocks for everything in the program that waits or measures time: the trial schedule, the engine's timers, the simulated device and the recorder's checkpoints
+# RealClock is perf_counter time with QTimers, as the program always ran. VirtualClock is simulated time: timers are kept in a queue and run() fires them in deadline order on the calling thread,
+# jumping straight to each deadline, so a whole session runs as fast as the program can process it and every run is identical (see Simulator.py --virtual)
+# Objects take a clock (REAL_CLOCK by default) and use clock.now(), clock.timer() in place of QTimer(), clock.singleShot() in place of QTimer.singleShot() and clock.startAt() to arm a timer for a deadline
+
+import heapq
+import itertools
+import time
+from PyQt5.QtCore import *
+
+class RealClock:
+
+    threaded = True # devices run on their own thread (see SerialLink.attachDevice)
+
+    # perf_counter time in s
+    def now(self):
+        return time.perf_counter()
+
+    def timer(self):
+        timer = QTimer()
+        timer.setTimerType(Qt.PreciseTimer)
+        return timer
+
+    # call callback once after ms
+    def singleShot(self, ms, callback):
+        QTimer.singleShot(int(ms), Qt.PreciseTimer, callback)
+
+    # start a single shot timer to expire at clock time deadline.
+    # Rounding down means the timer can expire just before the deadline, the caller checks what is due and arms again with 0 ms until it is
+    def startAt(self, timer, deadline):
+        timer.start(max(0, int((deadline - self.now())*1000)))
+
+REAL_CLOCK = RealClock()
+
+# a timer on a VirtualClock, with the parts of the QTimer interface the program uses
+class VirtualTimer(QObject):
+
+    timeout = pyqtSignal()
+
+    def __init__(self, clock, *args, **kwargs):
+        super(VirtualTimer, self).__init__(*args, **kwargs)
+        self.clock = clock
+        self.interval_ms = 0
+        self.single_shot = False
+        self.entry = None # queue entry of the pending expiry, None when stopped
+
+    def setInterval(self, ms):
+        self.interval_ms = ms
+
+    def interval(self):
+        return self.interval_ms
+
+    def setSingleShot(self, single_shot):
+        self.single_shot = single_shot
+
+    def isSingleShot(self):
+        return self.single_shot
+
+    def setTimerType(self, timer_type):
+        pass
+
+    def isActive(self):
+        return self.entry is not None
+
+    # start or restart the timer, with a new interval in ms if given
+    def start(self, ms=None):
+        if ms is not None:
+            self.interval_ms = ms
+        self.stop()
+        self.entry = self.clock.scheduleNs(self.clock.ns + round(self.interval_ms * 1e6), self.expire)
+
+    def startAt(self, deadline):
+        self.stop()
+        self.entry = self.clock.schedule(deadline, self.expire)
+
+    def stop(self):
+        if self.entry is not None:
+            self.clock.cancel(self.entry)
+            self.entry = None
+
+    # a repeating timer is re-armed from its deadline, not from when it was handled, so it does not drift
+    def expire(self):
+        deadline = self.entry[0]
+        self.entry = None
+        if not self.single_shot:
+            self.entry = self.clock.scheduleNs(deadline + round(self.interval_ms * 1e6), self.expire)
+        self.timeout.emit()
+
+class VirtualClock:
+
+    threaded = False # devices run on the thread calling run(), so nothing happens between timer expiries
+
+    # start is the clock time to begin at, by default perf_counter time now so times convert to wall clock time as real ones do (see Recorder.wallTime).
+    # Time is counted in whole ns from the start, so deadlines a whole number of ms apart stay exactly that far apart however long the clock runs
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.ns = 0 # ns since start
+        self.queue = [] # heap of [deadline ns, sequence, callback], callback None once cancelled
+        self.sequence = itertools.count() # timers due at the same time fire in the order they were armed
+        self.fired = 0
+
+    def now(self):
+        return self.start + self.ns / 1e9
+
+    def timer(self):
+        return VirtualTimer(self)
+
+    def singleShot(self, ms, callback):
+        self.scheduleNs(self.ns + round(ms * 1e6), callback)
+
+    def startAt(self, timer, deadline):
+        timer.startAt(deadline)
+
+    # call callback at clock time deadline, or now if it has passed. Returns the queue entry, for cancel
+    def schedule(self, deadline, callback):
+        return self.scheduleNs(round((deadline - self.start) * 1e9), callback)
+
+    def scheduleNs(self, ns, callback):
+        entry = [max(ns, self.ns), next(self.sequence), callback]
+        heapq.heappush(self.queue, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    # fire timers in deadline order, advancing the clock to each, until the queue is empty, the clock reaches until (if given) or stop() (if given) returns True after a timer.
+    # Returns the number of timers fired
+    def run(self, until=None, stop=None):
+        until_ns = None if until is None else round((until - self.start) * 1e9)
+        fired = 0
+        while len(self.queue) > 0:
+            deadline, sequence, callback = self.queue[0]
+            if callback is None:
+                heapq.heappop(self.queue)
+                continue
+            if until_ns is not None and deadline > until_ns:
+                break
+            heapq.heappop(self.queue)
+            self.ns = deadline
+            callback()
+            fired += 1
+            if stop is not None and stop():
+                break
+        if until_ns is not None and (len(self.queue) == 0 or self.queue[0][0] > until_ns):
+            self.ns = max(self.ns, until_ns)
+        self.fired += fired
+        return fired
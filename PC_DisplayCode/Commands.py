@@ -1,6 +1,4 @@
 # File to store command enum such that multiple files can access these
+# The commands are defined with the rest of the serial protocol in Schema.py, they are imported here so existing code keeps working
 
-from enum import IntEnum
-
-cmds = IntEnum('cmds', ["OPEN", "CHECK_SEN", "IMP_TMP", "STOP_IMP_PER", "START_IMP_PER", "SET_AD_RANGE_1", "SET_AD_RANGE_2", "SET_AD_RANGE_3", "SET_AD_RANGE_4", "SET_AD_PGA_1", "SET_AD_PGA_5" ], start=0) # command details are given in the Arduino code
-cmd_wait_response = cmds.IMP_TMP - 1 # Commands above this value do not receive a response from the Arduino and so we should not wait for them to return a value
\ No newline at end of file
+from Schema import cmds, cmd_wait_response # command details are given in the Arduino code and Schema.py. Commands up to cmd_wait_response receive a response from the Arduino
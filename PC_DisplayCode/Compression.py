@@ -0,0 +1,359 @@
+# Lossless compressed recording format (.emgz) for the EMG of a task, saved in place of the task csv when AcquisitionEngine.compress_recording is set
+# Samples are 12 bit (0-4095, see SerialLink.emgDataReady) and change little between neighbours, so each channel of a chunk is stored as its first value followed by the
+# differences between samples, zigzag mapped to unsigned and bit packed in short blocks at the width of the largest difference in each block, so quiet rest periods pack
+# tighter than activity. A chunk may also be passed through zlib (CODEC_ZLIB)
+# Every chunk is self contained (first values, label runs, packet times and IT readings of its samples), so any part of a recording is read by decoding only the chunks covering it,
+# and a chunk torn by a crash is found by its checksum and dropped
+#
+# File layout, little endian:
+#   FILE_HEADER  - magic b"EMGZ", version, channels, sample rate
+#   then chunks, each CHUNK_HEADER (magic b"CHNK", codec, first sample index, samples, payload length, crc32 of the payload) followed by the payload:
+#     per channel: packed samples
+#     label runs:  packed sample offset of each run in the chunk, then a byte per run with its class
+#     packets:     packed sample offset of the first sample of each packet, then packed wall clock time of each in ms since the epoch
+#     IT readings: count (u2), then per reading its sample offset (u4), text length (u2) and the values as the csv text written by the recorder
+#   a packed sequence is: count (u4), first value (i8), the width of each block of BLOCK differences (u1 each), then the (count - 1) zigzag differences at their block's width, padded to a byte
+#
+# Run as a script to convert csv recordings for archiving, or to export a compressed recording back to csv:
+#   python Compression.py compress <task csv or participant folder>
+#   python Compression.py export <task emgz> [csv path]
+
+import csv
+import io
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+from PyQt5.QtCore import QDateTime
+
+FILE_MAGIC = b"EMGZ"
+CHUNK_MAGIC = b"CHNK"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sBBH") # magic, version, channels, sample rate
+CHUNK_HEADER = struct.Struct("<4sBQIII") # magic, codec, first sample, samples, payload length, crc32
+PACKED_HEADER = struct.Struct("<Iq") # count, first value
+BLOCK = 32 # differences packed at a common width
+MAX_WIDTH = 40 # widest difference that can be packed, enough for ms time stamps
+IT_HEADER = struct.Struct("<IH") # sample offset, text length
+
+CODEC_PACKED = 0 # differences bit packed
+CODEC_ZLIB = 1 # differences bit packed then zlib compressed
+
+TIMESTAMP_FORMAT = "yyyy-MM-dd hh-mm-ss-zzz" # as Recorder.TIMESTAMP_FORMAT, the csv time stamp format
+
+# A decoded chunk. channels is (channels, samples) uint16, labels the class of each sample, packets a list of (sample index, wall time ms), it a list of (sample index, csv text)
+Chunk = namedtuple('Chunk', ['first', 'channels', 'labels', 'packets', 'it'])
+
+# pack a sequence of integers as its first value and the zigzag differences, bit packed in blocks of BLOCK differences each at the width of its largest difference
+def packDeltas(values):
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return PACKED_HEADER.pack(0, 0)
+    diffs = np.diff(values)
+    zigzag = ((diffs << 1) ^ (diffs >> 63)).astype(np.uint64) # small differences of either sign become small unsigned values
+    widths = _bitLength(np.maximum.reduceat(zigzag, np.arange(0, len(zigzag), BLOCK))) if len(zigzag) > 0 else np.zeros(0, dtype=np.uint8)
+    bits = _bitMatrix(zigzag, np.repeat(widths, BLOCK)[:len(zigzag)])
+    return PACKED_HEADER.pack(len(values), int(values[0])) + widths.tobytes() + np.packbits(bits).tobytes()
+
+# unpack a sequence written by packDeltas from buf at pos, returns the values and the position after them
+def unpackDeltas(buf, pos):
+    count, first = PACKED_HEADER.unpack_from(buf, pos)
+    pos += PACKED_HEADER.size
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), pos
+    n_blocks = -(-(count - 1) // BLOCK)
+    widths = np.frombuffer(buf, dtype=np.uint8, count=n_blocks, offset=pos)
+    pos += n_blocks
+    value_widths = np.repeat(widths, BLOCK)[:count - 1]
+    n_bits = int(value_widths.sum(dtype=np.int64))
+    n_bytes = (n_bits + 7) // 8
+    bits = np.unpackbits(np.frombuffer(buf, dtype=np.uint8, count=n_bytes, offset=pos))[:n_bits]
+    matrix = np.zeros((count - 1, MAX_WIDTH), dtype=np.uint64)
+    matrix[_widthMask(value_widths)] = bits # each value's bits fill the low end of its row
+    zigzag = matrix @ (np.uint64(1) << np.arange(MAX_WIDTH - 1, -1, -1, dtype=np.uint64))
+    diffs = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+    values = np.empty(count, dtype=np.int64)
+    values[0] = first
+    np.cumsum(diffs, out=values[1:])
+    values[1:] += first
+    return values, pos + n_bytes
+
+# number of bits needed for each unsigned value
+def _bitLength(values):
+    return (values[:, np.newaxis] >= (np.uint64(1) << np.arange(MAX_WIDTH, dtype=np.uint64))).sum(axis=1).astype(np.uint8)
+
+# (values, MAX_WIDTH) mask selecting the low width bits of each row of a most significant bit first matrix
+def _widthMask(widths):
+    return np.arange(MAX_WIDTH) >= (MAX_WIDTH - widths.astype(np.int64))[:, np.newaxis]
+
+# the low width bits of each value, most significant first, concatenated
+def _bitMatrix(values, widths):
+    bits = (values[:, np.newaxis] >> np.arange(MAX_WIDTH - 1, -1, -1, dtype=np.uint64)) & np.uint64(1)
+    return bits[_widthMask(widths)].astype(np.uint8)
+
+def encodeChunk(channels, labels, packets, it):
+    parts = [packDeltas(c) for c in channels]
+    labels = np.asarray(labels)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(labels)) + 1]) if len(labels) > 0 else np.zeros(0, dtype=np.int64)
+    parts.append(packDeltas(starts))
+    parts.append(labels[starts].astype(np.uint8).tobytes())
+    parts.append(packDeltas([p[0] for p in packets]))
+    parts.append(packDeltas([p[1] for p in packets]))
+    parts.append(struct.pack("<H", len(it)))
+    for offset, text in it:
+        data = text.encode()
+        parts.append(IT_HEADER.pack(offset, len(data)) + data)
+    return b"".join(parts)
+
+def decodeChunk(payload, first, n, n_channels):
+    pos = 0
+    channels = np.empty((n_channels, n), dtype=np.uint16)
+    for c in range(n_channels):
+        channels[c], pos = unpackDeltas(payload, pos)
+    starts, pos = unpackDeltas(payload, pos)
+    run_labels = np.frombuffer(payload, dtype=np.uint8, count=len(starts), offset=pos)
+    pos += len(starts)
+    labels = np.repeat(run_labels, np.diff(np.append(starts, n)))
+    offsets, pos = unpackDeltas(payload, pos)
+    times, pos = unpackDeltas(payload, pos)
+    packets = [(first + int(o), int(t)) for o, t in zip(offsets, times)]
+    count, = struct.unpack_from("<H", payload, pos)
+    pos += 2
+    it = []
+    for i in range(count):
+        offset, length = IT_HEADER.unpack_from(payload, pos)
+        pos += IT_HEADER.size
+        it.append((first + offset, payload[pos:pos+length].decode()))
+        pos += length
+    return Chunk(first, channels, labels, packets, it)
+
+class EmgzWriter:
+
+    # chunk_samples is the number of samples buffered before a chunk is written, flush() ends a chunk early
+    def __init__(self, path, channels, sample_rate, chunk_samples=4096, codec=CODEC_PACKED):
+        self.logger = logging.getLogger("app_logger.EmgzWriter")
+        self.path = path
+        self.n_channels = channels
+        self.sample_rate = sample_rate
+        self.chunk_samples = chunk_samples
+        self.codec = codec
+        # appending, as with the csv files, after the last complete chunk of any samples already in the file, which the sample index continues from
+        resume = 0
+        if os.path.exists(path) and os.path.getsize(path) >= FILE_HEADER.size:
+            existing = EmgzReader(path)
+            if (existing.n_channels, existing.sample_rate) != (channels, sample_rate):
+                raise ValueError(f"{path} holds {existing.n_channels} channels at {existing.sample_rate} Hz, it cannot be appended to with {channels} at {sample_rate} Hz")
+            resume = len(existing)
+            with open(path, 'rb+') as f:
+                f.truncate(existing.valid_end)
+        elif os.path.exists(path):
+            os.remove(path) # a header cut short holds nothing
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            self.f.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, channels, sample_rate))
+        self.samples = resume # samples written or buffered, the index of the next sample
+        self.chunk_first = resume
+        self.buffer = [] # channel arrays of the buffered packets
+        self.labels = []
+        self.packets = [] # (sample offset in chunk, time ms)
+        self.it = [] # (sample offset in chunk, csv text)
+        self.encoded_samples = 0
+        self.encoded_bytes = 0
+        self.encode_time = 0 # thread CPU time spent encoding, seconds
+
+    # add a packet, channels is a list of the samples of each channel, time_ms its wall clock time, it_values any IT values saved with it
+    def append(self, channels, labels, time_ms, it_values=[]):
+        offset = self.samples - self.chunk_first
+        self.buffer.append(np.asarray(channels, dtype=np.int64))
+        self.labels.append(np.asarray(labels))
+        self.packets.append((offset, time_ms))
+        if len(it_values) > 0:
+            text = io.StringIO()
+            csv.writer(text).writerow(it_values)
+            self.it.append((offset, text.getvalue().rstrip("\r\n")))
+        self.samples += len(labels)
+        if self.samples - self.chunk_first >= self.chunk_samples:
+            self.writeChunk()
+
+    # encode and write the buffered packets as a chunk
+    def writeChunk(self):
+        if len(self.buffer) == 0:
+            return
+        tic = time.thread_time()
+        channels = np.concatenate(self.buffer, axis=1)
+        payload = encodeChunk(channels, np.concatenate(self.labels), self.packets, self.it)
+        if self.codec == CODEC_ZLIB:
+            payload = zlib.compress(payload, 1)
+        n = channels.shape[1]
+        self.f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self.codec, self.chunk_first, n, len(payload), zlib.crc32(payload)) + payload)
+        self.encode_time += time.thread_time() - tic
+        self.encoded_samples += n
+        self.encoded_bytes += CHUNK_HEADER.size + len(payload)
+        self.chunk_first = self.samples
+        self.buffer, self.labels, self.packets, self.it = [], [], [], []
+
+    # write any buffered samples as a chunk and pass the file to the OS
+    def flush(self):
+        self.writeChunk()
+        self.f.flush()
+
+    def tell(self):
+        return self.f.tell()
+
+    # compressed size against the samples as 16 bit values, and the CPU cost against the duration of the data
+    def report(self):
+        if self.encoded_samples == 0:
+            return "no samples"
+        raw = self.encoded_samples * self.n_channels * 2
+        duration = self.encoded_samples / self.sample_rate
+        return (f"{self.encoded_samples} samples in {self.encoded_bytes} bytes, {self.encoded_bytes*8/(self.encoded_samples*self.n_channels):.2f} bits per sample, "
+                f"ratio {raw/self.encoded_bytes:.2f} against 16 bit, encoding {self.encode_time*1000:.1f} ms CPU for {duration:.1f} s of data "
+                f"({duration/max(self.encode_time, 1e-9):.0f} x real time)")
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.logger.info(f"Closed {os.path.basename(self.path)}: {self.report()}")
+
+class EmgzReader:
+
+    # scans the chunk headers to index the file, stopping at the first chunk that is incomplete or fails its checksum
+    def __init__(self, path):
+        self.logger = logging.getLogger("app_logger.EmgzReader")
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        magic, version, self.n_channels, self.sample_rate = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != FILE_MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} emgz file")
+        offsets, firsts, counts = [], [], []
+        pos = FILE_HEADER.size
+        while pos + CHUNK_HEADER.size <= len(self.data):
+            magic, codec, first, n, length, crc = CHUNK_HEADER.unpack_from(self.data, pos)
+            end = pos + CHUNK_HEADER.size + length
+            if magic != CHUNK_MAGIC or end > len(self.data) or zlib.crc32(self.data[pos+CHUNK_HEADER.size:end]) != crc:
+                break
+            offsets.append(pos)
+            firsts.append(first)
+            counts.append(n)
+            pos = end
+        self.valid_end = pos # end of the last complete chunk
+        if pos < len(self.data):
+            self.logger.warning(f"Ignoring {len(self.data) - pos} bytes of incomplete chunk at the end of {os.path.basename(path)}")
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.firsts = np.asarray(firsts, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.firsts[-1] + self.counts[-1]) if len(self.firsts) > 0 else 0
+
+    def chunk(self, i):
+        pos = int(self.offsets[i])
+        magic, codec, first, n, length, crc = CHUNK_HEADER.unpack_from(self.data, pos)
+        payload = self.data[pos+CHUNK_HEADER.size:pos+CHUNK_HEADER.size+length]
+        if codec == CODEC_ZLIB:
+            payload = zlib.decompress(payload)
+        return decodeChunk(payload, first, n, self.n_channels)
+
+    def chunks(self):
+        for i in range(len(self.offsets)):
+            yield self.chunk(i)
+
+    # channels (channels, samples) and labels of samples [start, stop), decoding only the chunks covering them
+    def read(self, start, stop):
+        stop = min(stop, len(self))
+        if start >= stop:
+            return np.zeros((self.n_channels, 0), dtype=np.uint16), np.zeros(0, dtype=np.uint8)
+        a = np.searchsorted(self.firsts, start, side='right') - 1
+        b = np.searchsorted(self.firsts, stop, side='left')
+        chunks = [self.chunk(i) for i in range(a, b)]
+        channels = np.concatenate([c.channels for c in chunks], axis=1)
+        labels = np.concatenate([c.labels for c in chunks])
+        offset = start - chunks[0].first
+        return channels[:, offset:offset + stop - start], labels[offset:offset + stop - start]
+
+# truncate a file after its last complete chunk, returns the number of bytes removed
+def repairFile(path):
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+    if size < FILE_HEADER.size:
+        end = 0
+    else:
+        end = EmgzReader(path).valid_end
+    with open(path, 'rb+') as f:
+        f.truncate(end)
+    return size - end
+
+# wall clock time stamp string for a time in ms since the epoch
+def timeString(time_ms):
+    return QDateTime.fromMSecsSinceEpoch(int(time_ms)).toString(TIMESTAMP_FORMAT)
+
+# write a compressed recording as a task csv, identical to the csv the recorder would have written
+def exportCsv(path, csv_path):
+    reader = EmgzReader(path)
+    with open(csv_path, 'w', newline='') as f:
+        for chunk in reader.chunks():
+            extra = dict(chunk.it)
+            starts = [index - chunk.first for index, time_ms in chunk.packets] + [chunk.channels.shape[1]]
+            values = [",".join(str(c) for c in chunk.channels[:, i]) + f",{chunk.labels[i]}" for i in range(chunk.channels.shape[1])]
+            lines = []
+            for p, (index, time_ms) in enumerate(chunk.packets):
+                # the recorder writes the time stamp and any IT values on the first row of a packet, leaving the cells below them empty
+                it_text = extra.get(index)
+                fill = "," * len(next(csv.reader([it_text]))) if it_text is not None else ""
+                for i in range(starts[p], starts[p+1]):
+                    if i == starts[p]:
+                        lines.append(f"{timeString(time_ms)},{values[i]}" + (f",{it_text}" if it_text is not None else "") + "\r\n")
+                    else:
+                        lines.append(f",{values[i]}{fill}\r\n")
+            f.write("".join(lines))
+
+# compress a task csv to <task>.emgz alongside it, checking the result exports back to the same csv. Returns the writer report. chunk_samples is as EmgzWriter
+def compressCsv(csv_path, channels=2, sample_rate=500, codec=CODEC_PACKED, chunk_samples=4096):
+    emgz_path = os.path.splitext(csv_path)[0] + ".emgz"
+    if os.path.exists(emgz_path):
+        os.remove(emgz_path)
+    writer = EmgzWriter(emgz_path, channels, sample_rate, chunk_samples, codec)
+    with open(csv_path, newline='') as f:
+        packet = None # [channel samples, labels, time ms, IT values] of the packet being read
+        for row in csv.reader(f):
+            if row[0] != "": # first row of a packet
+                if packet is not None:
+                    writer.append(*packet)
+                packet = [[[] for c in range(channels)], [], QDateTime.fromString(row[0], TIMESTAMP_FORMAT).toMSecsSinceEpoch(), row[2 + channels:]]
+            for c in range(channels):
+                packet[0][c].append(int(row[1 + c]))
+            packet[1].append(int(row[1 + channels]))
+        if packet is not None:
+            writer.append(*packet)
+    writer.close()
+    check_path = emgz_path + ".check.csv"
+    exportCsv(emgz_path, check_path)
+    with open(csv_path, 'rb') as a, open(check_path, 'rb') as b:
+        same = a.read() == b.read()
+    os.remove(check_path)
+    if not same:
+        raise ValueError(f"{emgz_path} does not export back to {csv_path}")
+    return writer.report()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) >= 3 and sys.argv[1] == "compress":
+        target = sys.argv[2]
+        if os.path.isdir(target):
+            from SessionStore import taskFiles
+            paths = [os.path.join(target, name + ".csv") for name in taskFiles(target) if os.path.exists(os.path.join(target, name + ".csv"))]
+        else:
+            paths = [target]
+        for path in paths:
+            print(f"{path}: {compressCsv(path)}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "export":
+        exportCsv(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(sys.argv[2])[0] + ".csv")
+    else:
+        print("usage: python Compression.py compress <task csv or participant folder> | export <task emgz> [csv path]")
@@ -0,0 +1,257 @@
+# Dataset API over the recorded participants of a results folder, for model training
+# Each task recording is read through SessionStore's memory mapped binary files (converted from the csv or emgz once, then reused), so iterating over the corpus never goes back to text parsing.
+# The index lists every participant, task and repetition of each grip (a run of samples with the same non-rest class) from the label transitions saved with the binary files.
+# Labelled sliding windows are produced lazily: samples are decoded in chunks of chunk_samples to float32 arrays (channels, samples) held in an LRU cache limited to memory_budget bytes,
+# and the chunks the coming windows need are decoded ahead by a pool of worker threads, so a training loop can run over the whole corpus many times within a fixed memory use
+# e.g.
+#   dataset = Dataset("Results", protocol=loadProtocol(DEFAULT_PROTOCOL))
+#   for x, y, source in dataset.windows(250, 50, grips=[1, 2]): ...   # 0.5 s windows every 0.1 s, x (2, 250), y the class, source (pid, task, first sample)
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from SessionStore import CHANNELS, TaskRecording, taskFiles
+from SignalQuality import goodSamples
+
+# a repetition of a grip, or a rest period between them (grip 0), within a task. Samples [start, stop) of the task
+SEGMENT = np.dtype([('participant', '<i4'), ('task', '<i4'), ('grip', '<i4'), ('repetition', '<i4'), ('start', '<i8'), ('stop', '<i8')])
+
+# where a window came from, first is its first sample in the task recording
+WindowSource = namedtuple('WindowSource', ['participant', 'task', 'first'])
+
+# least recently used cache of decoded chunks, limited to a number of bytes. Safe to use from the worker threads
+class ChunkCache:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.chunks = OrderedDict() # least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self.chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        with self.lock:
+            if key in self.chunks:
+                return
+            self.chunks[key] = chunk
+            self.size += chunk.nbytes
+            while self.size > self.budget and len(self.chunks) > 1:
+                old_key, old = self.chunks.popitem(last=False)
+                self.size -= old.nbytes
+
+class Dataset:
+
+    chunk_samples = 1 << 15 # samples decoded at a time (65 s at 500 Hz, 256 kB as float32)
+
+    # results_dir holds the PID<n> participant folders (Engine.RESULTS_DIR). protocol, if given, names the tasks and grips (see Protocol.py)
+    def __init__(self, results_dir="Results", sample_rate=500, memory_budget=256 << 20, workers=4, prefetch=8, protocol=None):
+        self.logger = logging.getLogger("app_logger.Dataset")
+        self.results_dir = results_dir
+        self.sample_rate = sample_rate
+        self.cache = ChunkCache(memory_budget)
+        self.workers = workers
+        self.prefetch = prefetch # chunks decoded ahead of the window being produced
+        self.protocol = protocol
+        self.recordings = {} # TaskRecording by (participant, task), opened when first needed
+        self.lock = threading.Lock()
+        self.executor = None
+
+        # participants and the tasks recorded for each, in the order they were named
+        self.task_names = {}
+        for name in os.listdir(results_dir):
+            match = re.fullmatch(r"PID(\d+)", name)
+            if match is not None and os.path.isdir(os.path.join(results_dir, name)):
+                self.task_names[int(match.group(1))] = taskFiles(os.path.join(results_dir, name))
+        self.index = self.buildIndex()
+        self.logger.info(f"Opened {results_dir}: {len(self.task_names)} participants, {sum(len(t) for t in self.task_names.values())} tasks, "
+                         f"{np.count_nonzero(self.index['grip'] > 0)} repetitions")
+
+    def participants(self):
+        return sorted(self.task_names)
+
+    # task file names of a participant, e.g. "1_1"
+    def tasks(self, participant):
+        return self.task_names[participant]
+
+    # classes recorded, other than rest (0)
+    def grips(self):
+        return sorted(set(self.index['grip'].tolist()) - {0})
+
+    # the protocol name of a task file or grip class, or the file name or number if no protocol was given
+    def taskName(self, task_file):
+        if self.protocol is not None:
+            for task in self.protocol.tasks:
+                if task.file == task_file:
+                    return task.name
+        return task_file
+
+    def gripName(self, grip):
+        if grip == 0:
+            return "Rest"
+        if self.protocol is not None and grip <= len(self.protocol.grips):
+            return self.protocol.grips[grip-1].name
+        return str(grip)
+
+    def path(self, participant):
+        return os.path.join(self.results_dir, f"PID{participant}")
+
+    def recording(self, participant, task):
+        key = (participant, task)
+        with self.lock:
+            if key not in self.recordings:
+                self.recordings[key] = TaskRecording(self.path(participant), self.task_names[participant][task])
+            return self.recordings[key]
+
+    # one SEGMENT per run of samples with the same class in every task. Repetitions of each grip are counted from 1 within each task, rest periods are numbered likewise
+    def buildIndex(self):
+        segments = []
+        for participant in self.participants():
+            for task in range(len(self.task_names[participant])):
+                rec = self.recording(participant, task)
+                starts = np.concatenate([[0], rec.transition_index]) if len(rec.transition_index) == 0 or rec.transition_index[0] != 0 else rec.transition_index
+                labels = np.asarray([rec.labelAt(s) for s in starts])
+                stops = np.append(starts[1:], len(rec))
+                keep = stops > starts
+                counts = {}
+                for start, stop, label in zip(starts[keep], stops[keep], labels[keep]):
+                    counts[label] = counts.get(label, 0) + 1
+                    segments.append((participant, task, label, counts[label], start, stop))
+        return np.array(segments, dtype=SEGMENT)
+
+    # segments of the index matching the given participants, tasks (file names) and grips, any if None
+    def segments(self, participants=None, tasks=None, grips=None):
+        keep = np.ones(len(self.index), dtype=bool)
+        if participants is not None:
+            keep &= np.isin(self.index['participant'], participants)
+        if tasks is not None:
+            names = np.array([self.task_names[p][t] for p, t in zip(self.index['participant'], self.index['task'])])
+            keep &= np.isin(names, tasks)
+        if grips is not None:
+            keep &= np.isin(self.index['grip'], grips)
+        return self.index[keep]
+
+    # samples of chunk number n of a task as float32 (channels, samples), from the cache or decoded from the mapped file
+    def chunk(self, participant, task, n):
+        key = (participant, task, n)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            records = self.recording(participant, task).window(n * self.chunk_samples, (n + 1) * self.chunk_samples)
+            chunk = np.empty((len(CHANNELS), len(records)), dtype=np.float32)
+            for c, name in enumerate(CHANNELS):
+                chunk[c] = records[name]
+            self.cache.put(key, chunk)
+        return chunk
+
+    # samples [start, stop) of a task, joined across chunks if needed. get(n) returns chunk n
+    def samples(self, start, stop, get):
+        first, last = start // self.chunk_samples, (stop - 1) // self.chunk_samples
+        if first == last:
+            offset = first * self.chunk_samples
+            return get(first)[:, start - offset:stop - offset]
+        return np.concatenate([get(n) for n in range(first, last + 1)], axis=1)[:, start - first * self.chunk_samples:stop - first * self.chunk_samples]
+
+    # first sample and class of every window of length window (samples) taken every step samples through the tasks, in task order.
+    # A window is labelled with the class of its last sample. With whole set, windows spanning a change of class are left out. With exclude_quality set (SignalQuality flags),
+    # windows containing samples flagged when recorded are left out. Rest windows are included only if rest is set
+    def plan(self, window, step, participants=None, tasks=None, grips=None, rest=False, whole=True, exclude_quality=None):
+        plans = []
+        for participant in self.participants() if participants is None else participants:
+            for task, name in enumerate(self.task_names[participant]):
+                if tasks is not None and name not in tasks:
+                    continue
+                rec = self.recording(participant, task)
+                starts = np.arange(0, len(rec) - window + 1, step, dtype=np.int64)
+                pos_end = np.searchsorted(rec.transition_index, starts + window - 1, side='right') - 1
+                labels = np.where(pos_end >= 0, rec.transition_label[np.maximum(pos_end, 0)], 0).astype(np.int64)
+                keep = np.ones(len(starts), dtype=bool)
+                if whole:
+                    keep &= np.searchsorted(rec.transition_index, starts, side='right') - 1 == pos_end
+                if not rest:
+                    keep &= labels != 0
+                if grips is not None:
+                    keep &= np.isin(labels, grips) | ((labels == 0) & rest)
+                if exclude_quality is not None:
+                    good = goodSamples(self.path(participant), name, len(rec), exclude_quality, sample_rate=self.sample_rate).all(axis=0)
+                    bad_before = np.concatenate([[0], np.cumsum(~good)]) # bad samples before each index
+                    keep &= bad_before[starts + window] == bad_before[starts]
+                plans.append((participant, task, starts[keep], labels[keep]))
+        return plans
+
+    # labelled windows as (samples float32 (channels, window), class, WindowSource), produced lazily in task order (options as plan).
+    # With shuffle (a seed) the tasks are taken in a random order and windows are shuffled within each chunk, so the cache and prefetch still work
+    def windows(self, window, step, participants=None, tasks=None, grips=None, rest=False, whole=True, exclude_quality=None, shuffle=None):
+        plans = self.plan(window, step, participants, tasks, grips, rest, whole, exclude_quality)
+        order = [] # (participant, task, start, label) in the order they are produced
+        rng = np.random.default_rng(shuffle) if shuffle is not None else None
+        if rng is not None:
+            plans = [plans[i] for i in rng.permutation(len(plans))]
+        for participant, task, starts, labels in plans:
+            blocks = starts // self.chunk_samples
+            for b in np.unique(blocks):
+                idx = np.flatnonzero(blocks == b)
+                if rng is not None:
+                    idx = rng.permutation(idx)
+                order.extend((participant, task, int(starts[i]), int(labels[i])) for i in idx)
+        if self.executor is None and self.workers > 0:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="dataset")
+
+        # chunk keys in the order they are first needed, decoded ahead by the workers
+        needed = []
+        seen = set()
+        for participant, task, start, label in order:
+            for n in range(start // self.chunk_samples, (start + window - 1) // self.chunk_samples + 1):
+                if (participant, task, n) not in seen:
+                    seen.add((participant, task, n))
+                    needed.append((participant, task, n))
+        ahead = deque(needed)
+        pending = {}
+
+        def refill():
+            while self.executor is not None and len(pending) < self.prefetch and len(ahead) > 0:
+                key = ahead.popleft()
+                pending[key] = self.executor.submit(self.chunk, *key)
+
+        for participant, task, start, label in order:
+            def get(n):
+                future = pending.pop((participant, task, n), None)
+                if future is not None:
+                    future.result() # decoded into the cache
+                return self.chunk(participant, task, n)
+            refill()
+            yield self.samples(start, start + window, get), label, WindowSource(participant, task, start)
+
+    # windows stacked into batches of (samples (batch, channels, window), classes (batch), sources), the last batch may be smaller
+    def batches(self, batch_size, window, step, **options):
+        xs, ys, sources = [], [], []
+        for x, y, source in self.windows(window, step, **options):
+            xs.append(x)
+            ys.append(y)
+            sources.append(source)
+            if len(xs) == batch_size:
+                yield np.stack(xs), np.asarray(ys), sources
+                xs, ys, sources = [], [], []
+        if len(xs) > 0:
+            yield np.stack(xs), np.asarray(ys), sources
+
+    # stop the workers, the dataset can still be used without prefetch
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -1,5 +1,8 @@
 # Widget to host information from the EMG sensors
-# Display of EMG over time, shows previous samples updating from right to left
+# Display of EMG over time, shows the last seconds of samples updating from right to left against time, sized for the device's sampling (see Schema.py)
+# The samples since the task started are all kept, with a min/max pyramid of them updated as they arrive (LiveHistory), so the history slider zooms out from the last seconds to the whole task.
+# Each frame draws the span shown from the pyramid level whose bins are the fewest still covering it at up to max_points points, so a frame costs the same at any zoom
+# In review mode (see ReviewWindow.py) the same graphs show a recorded session against time instead, with markers for label transitions and IT readings and a playhead
 
 import logging
 from PyQt5.QtCore import *
@@ -9,27 +12,106 @@ import numpy as np
 
 import pyqtgraph as pg
 
+from SessionStore import PYRAMID_FACTOR
+
 import time
 
+# samples of each channel with a min/max pyramid over them, extended as samples are appended. Level k (from 1) holds the [min, max] of each channel over each complete run of PYRAMID_FACTOR**k
+# samples, as the review pyramid of SessionStore.py, and grows by a bin each time the level below completes PYRAMID_FACTOR more, so appending costs the same however long the history is
+class LiveHistory:
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.clear()
+
+    def clear(self):
+        self.samples = np.zeros((1024, self.channels), dtype=np.uint16) # grown by doubling
+        self.n = 0
+        self.levels = [] # [min, max] bins of level k at k-1, shape (capacity, channels, 2)
+        self.counts = [] # complete bins of each level
+
+    # arrays are grown by doubling, so the cost of copying is spread over the appends
+    def _grow(self, array, size):
+        if size <= len(array):
+            return array
+        grown = np.zeros((max(size, 2*len(array)),) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    # append samples (channels, n)
+    def append(self, samples):
+        m = samples.shape[1]
+        self.samples = self._grow(self.samples, self.n + m)
+        self.samples[self.n:self.n+m] = samples.T
+        self.n += m
+        below_count = self.n
+        k = 0
+        while below_count >= PYRAMID_FACTOR:
+            if k == len(self.levels):
+                self.levels.append(np.zeros((64, self.channels, 2), dtype=np.uint16))
+                self.counts.append(0)
+            count = self.counts[k]
+            complete = below_count // PYRAMID_FACTOR
+            if complete == count: # no new bin here, so none above
+                break
+            self.levels[k] = self._grow(self.levels[k], complete)
+            if k == 0: # from the samples
+                block = self.samples[count*PYRAMID_FACTOR:complete*PYRAMID_FACTOR].reshape(-1, PYRAMID_FACTOR, self.channels)
+                self.levels[k][count:complete, :, 0] = block.min(axis=1)
+                self.levels[k][count:complete, :, 1] = block.max(axis=1)
+            else:
+                block = self.levels[k-1][count*PYRAMID_FACTOR:complete*PYRAMID_FACTOR].reshape(-1, PYRAMID_FACTOR, self.channels, 2)
+                self.levels[k][count:complete, :, 0] = block[:, :, :, 0].min(axis=1)
+                self.levels[k][count:complete, :, 1] = block[:, :, :, 1].max(axis=1)
+            self.counts[k] = complete
+            below_count = complete
+            k += 1
+
+    # points to draw the last span samples with at most max_points per channel: the sample index of each point and the values (points, channels). The samples themselves if
+    # few enough, otherwise a curve through the min and max of each bin of the lowest level with few enough bins, the newest from the samples not yet making a complete bin
+    def points(self, span, max_points):
+        span = min(span, self.n)
+        start = self.n - span
+        if span <= max_points:
+            return np.arange(start, self.n), self.samples[start:self.n]
+        k = 1
+        while k < len(self.levels) and 2 * (span // PYRAMID_FACTOR**k + 2) > max_points:
+            k += 1
+        width = PYRAMID_FACTOR**k
+        count = self.counts[k-1]
+        bins = self.levels[k-1][start // width:count]
+        if count * width < self.n: # the partial bin at the end
+            tail = self.samples[count*width:self.n]
+            bins = np.concatenate([bins, np.stack([tail.min(axis=0), tail.max(axis=0)], axis=1)[np.newaxis]])
+        centres = (np.arange(start // width, start // width + len(bins)) + 0.5) * width - 0.5
+        centres[-1] = min(centres[-1], self.n - 1)
+        return np.repeat(centres, 2), bins.transpose(0, 2, 1).reshape(-1, self.channels)
+
 class EMGDisplayWidget(QWidget):
 
+    sig_timeRangeChanged = pyqtSignal(float, float) # signal emitted in review mode when the time range shown changes, by panning, zooming or setTimeRange (start, end in seconds)
+    
+    review = False # True once switched to review mode
+    max_points = 5000 # points drawn per graph each frame, the span shown is drawn from the pyramid level with no more (the last 10 s at 500 Hz are drawn sample by sample)
+    history_seconds = 1800 # seconds kept between tasks, when the program is left running outside a task the history is cut back to the last seconds shown once it holds this many
+    slider_steps = 1000
     
-    def __init__(self, packet_size, max_packets, *args, **kwargs):
+    # sampling is the EMG Sampling of the device, seconds the length of EMG shown
+    def __init__(self, sampling, seconds, *args, **kwargs):
     
         super(EMGDisplayWidget, self).__init__(*args, **kwargs)
         
         self.logger = logging.getLogger("app_logger.EMGDisplayWidget")
         
-        # initialise values based on expected packets and maximum packets
-        self.packet_size = packet_size//2
-        self.max_packets = max_packets
-        self.max_size = packet_size * max_packets
+        self.seconds = seconds
         self.num_graphs = 2
         
         # data and graph storage
-        self.display_data = [[], []] # a fifo buffer for incoming data packets
+        self.history = LiveHistory(self.num_graphs) # every sample since the task started
+        self.pending = [] # sample blocks received since the last frame, added to the history at the frame
         self.graphs = []
         self.line_refs = []
+        self.span = seconds # seconds shown, from the last seconds up to the whole task
         
         
         self.logger.info("Setting up widgets.")
@@ -38,21 +120,34 @@ class EMGDisplayWidget(QWidget):
         for i in range(self.num_graphs):
             self.graphs.append(pg.PlotWidget())
             self.graphs[i].setYRange(0, 4096, padding=0.025) # force the range so this doesn't dynamically update based on min and max plotted values
+            self.graphs[i].setLabel('bottom', "Time", units='s')
 
-            
+        # history slider, on a log scale from the seconds shown at the left to the whole task at the right
+        self.history_label = QLabel()
+        self.history_slider = QSlider(Qt.Horizontal)
+        self.history_slider.setRange(0, self.slider_steps)
         
         self.logger.info("Setting up signals.")
+        self.history_slider.valueChanged.connect(self.historyChanged)
         
         self.logger.info("Setting up layout.")
         layout = QVBoxLayout()
         for graph in self.graphs:
             layout.addWidget(graph)
+        self.history_widget = QWidget()
+        layout_h = QHBoxLayout()
+        layout_h.setContentsMargins(0, 0, 0, 0)
+        layout_h.addWidget(QLabel("History"))
+        layout_h.addWidget(self.history_slider)
+        layout_h.addWidget(self.history_label)
+        self.history_widget.setLayout(layout_h)
+        layout.addWidget(self.history_widget)
         
         self.setLayout(layout)
         
         self.logger.info("Finalising.")
         
-        self.displayClear()    
+        self.setSampling(sampling)
         
         # force a policy such that if the EMG is toggled hidden on the main window it is able to reclaim its spot on return
         sp = QSizePolicy()
@@ -71,40 +166,121 @@ class EMGDisplayWidget(QWidget):
         
     def sensorsReady(self):
         pass
+        
+    # the history starts again with each task, so the right of the slider is the whole task
+    def taskStarted(self, number, name):
+        self.displayClear()
     
-    # wipes all display data and initialises each fifo with 0s (probably should be 2048 for pretty reasons)
-    def displayClear(self):
-        self.display_data = [[], []] # clear buffers
-        for i in range(self.max_packets): # refill buffers
-            self.display_data[0].append(np.zeros(self.packet_size).tolist())
-            self.display_data[1].append(np.zeros(self.packet_size).tolist())
+    # set the time axis for the Sampling given, called again when the device connects with another sampling, which starts the history again
+    def setSampling(self, sampling):
+        self.sample_rate = sampling.sample_rate
+        if not self.review:
+            self.displayClear()
         
-        # update graphs with cleared buffers
+    # wipes the history and the graphs
+    def displayClear(self):
+        self.history.clear()
+        self.pending = []
         if len(self.line_refs) == 0:
             for i in range(self.num_graphs):
-                ref  = self.graphs[i].plot(np.zeros(self.max_size).tolist())
-                self.line_refs.append(ref)
+                self.line_refs.append(self.graphs[i].plot([], []))
         else:
             for i in range(self.num_graphs):
-                self.line_refs[i].setData(np.zeros(self.max_size).tolist())
+                self.line_refs[i].setData([], [])
+        self.historyChanged(self.history_slider.value())
+        
+    # seconds the slider is set to show, from the seconds shown at the left to the whole history at the right
+    def sliderSpan(self):
+        whole = max(self.history.n / self.sample_rate, self.seconds)
+        return self.seconds * (whole / self.seconds) ** (self.history_slider.value() / self.slider_steps)
+        
+    # callback when the history slider moves, and at each frame as the history grows
+    def historyChanged(self, value=None):
+        span = self.sliderSpan()
+        if span != self.span or value is not None:
+            self.span = span
+            for graph in self.graphs:
+                graph.setXRange(-span, 0, padding=0)
+            whole = self.history_slider.value() == self.slider_steps
+            self.history_label.setText(f"{'task ' if whole else 'last '}{span:.0f} s" if span < 120 else f"{'task ' if whole else 'last '}{span/60:.1f} min")
     
     tic = 0
-    # called on receipt of new data from the serial com
-    def insertNewData(self, data):
+    # called on receipt of new data from the serial com, an EMGPacket (see Packets.py). Its read only sample arrays are kept as they are, not copied
+    def insertNewData(self, packet):
         """
         toc = time.perf_counter() # used for testing timing of updates when matplotlib seemed laggy
         print(toc - self.tic)
         self.tic = toc
         """
-        for i in range(self.num_graphs):
-            self.display_data[i].append(data[i]) # append the new data packet
-        self.displayUpdate()
+        self.insertSamples(packet.samples) # drawn at the next display frame (see AcquisitionEngine.sig_displayFrame)
+        
+    # add samples (channels, n) of any length, a packet or the samples read from a shared ring at a frame of the display process (see SharedDisplay.py)
+    def insertSamples(self, samples):
+        self.pending.append(samples)
         
+    # add the samples received since the last frame to the history and redraw the span shown. Several packets may have arrived if frames were skipped under load
     def displayUpdate(self):
+        if len(self.pending) > 0:
+            self.history.append(np.concatenate(self.pending, axis=1))
+            self.pending = []
+        if self.history.n > self.history_seconds * self.sample_rate: # outside a task for a long time, keep the last seconds
+            recent = self.history.samples[self.history.n - int(self.seconds * self.sample_rate):self.history.n].T.copy()
+            self.history.clear()
+            self.history.append(recent)
+        self.historyChanged()
+        index, values = self.history.points(int(np.ceil(self.span * self.sample_rate)), self.max_points)
+        t = (index - (self.history.n - 1)) / self.sample_rate # the newest sample at 0
         for i in range(self.num_graphs):
-            if len(self.display_data[i]) > self.max_packets:
-                self.display_data[i].pop(0) # remove the oldest data packet
-            data = []
-            for j in range(len(self.display_data[i])):
-                data.extend(self.display_data[i][j]) # combine all the packets into one list
-            self.line_refs[i].setData(data) # plot
\ No newline at end of file
+            self.line_refs[i].setData(t, values[:, i])
+            
+    # switch the graphs from the live display to showing a recorded session against time. Both graphs share the time axis, panning or zooming either emits the new range to be redrawn
+    def setReviewMode(self):
+        self.review = True
+        self.history_widget.hide() # the review window zooms the graphs itself
+        self.markers = [] # pool of marker lines, one per graph for each marker shown
+        self.playheads = []
+        for i, graph in enumerate(self.graphs):
+            graph.setLabel('bottom', "Time", units='s')
+            graph.enableAutoRange(x=False)
+            if i > 0:
+                graph.setXLink(self.graphs[0])
+            playhead = pg.InfiniteLine(angle=90, movable=False, pen=pg.mkPen('y', width=2))
+            graph.addItem(playhead)
+            self.playheads.append(playhead)
+        self.graphs[0].getViewBox().sigXRangeChanged.connect(self.viewRangeChanged)
+        
+    # callback when the shown time range of the graphs changes
+    def viewRangeChanged(self, view_box, time_range):
+        self.sig_timeRangeChanged.emit(time_range[0], time_range[1])
+        
+    def setTimeRange(self, start, end):
+        self.graphs[0].setXRange(start, end, padding=0)
+        
+    # draw a min/max envelope for graph i as one curve passing through the min and max of each bin, which at the finest level are the samples themselves
+    def setEnvelope(self, i, t, lo, hi):
+        self.line_refs[i].setData(np.repeat(t, 2), np.column_stack([lo, hi]).ravel())
+        
+    def setPlayhead(self, t):
+        for playhead in self.playheads:
+            playhead.setPos(t)
+            
+    # show vertical markers [(time, text, colour)], the text is shown on the top graph. Lines are reused between calls
+    def setMarkers(self, markers):
+        while len(self.markers) < len(markers):
+            lines = []
+            for i, graph in enumerate(self.graphs):
+                line = pg.InfiniteLine(angle=90, movable=False, label="" if i == 0 else None, labelOpts={'position': 0.95})
+                graph.addItem(line)
+                lines.append(line)
+            self.markers.append(lines)
+        for j, lines in enumerate(self.markers):
+            for i, line in enumerate(lines):
+                if j < len(markers):
+                    t, text, colour = markers[j]
+                    line.setPos(t)
+                    line.setPen(pg.mkPen(colour, style=Qt.DashLine))
+                    if i == 0:
+                        line.label.setFormat(text)
+                    line.show()
+                else:
+                    line.hide()
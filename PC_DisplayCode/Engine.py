@@ -0,0 +1,703 @@
+# Acquisition engine, everything needed to run a session without a display
+# AcquisitionEngine owns the serial link, the conversion of IT readings, sensor checks, the task schedule, labelling, recording, the session journal and the stream publisher.
+# It uses QtCore only (no QtWidgets, QtGui or QtMultimedia), and reports everything through signals, so the GUI (MainWindow) is one client connecting its displays and controls to it
+# Running this file starts the engine on its own under a QCoreApplication for unattended recordings or machines without a display, e.g. on a lab PC over ssh:
+# usage: python Engine.py [protocol] --pid <n> [--tasks <first>[-<last>]] [--gap <s>] [--stream <address>] [--compress] [--simulate <speed>]
+#   --pid      participant ID, the session is recorded to Results/PID<n> and resumed from its journal if it already exists
+#   --tasks    task numbers to run (from 1), default all remaining tasks of the protocol. A task already recorded is recorded again, its earlier files set aside as <file>_incomplete_<n>
+#   --gap      seconds between the end of one task and the start of the next, default 10
+#   --stream   publish the decoded data as main.py --stream (see Streaming.py)
+#   --compress save the EMG compressed (see Compression.py)
+#   --simulate run from a simulated device at speed times the real rate rather than the rig (see Simulator.py)
+# The tasks are run back to back once the sensors are connected. If the connection is lost during a task the task is abandoned (its files set aside as in the GUI) and run again once the
+# sensors are back. Ctrl+C abandons any running task the same way and exits, so the session can be resumed later from the GUI or the command line
+
+import logging
+import os
+import signal
+import sys
+import time
+from enum import Enum
+
+startup_tic = time.perf_counter() # taken before the Qt imports so the startup time reported when run as a program includes them
+
+import numpy as np
+from PyQt5.QtCore import *
+
+from Calibration import CALIBRATION_DIR, DEFAULT_PROFILE, CalibrationError, CalibrationRun, loadProfile, rawPolar
+from Catalog import Catalog
+from Clock import REAL_CLOCK
+from Commands import cmds
+from Schema import IT_FREQUENCY, ITReading, itValues
+from Journal import Durability, SessionJournal, recoverUnfinished, sessionStatus, setAsideTask
+from ImpedanceSweep import ImpedanceSweep
+from Labelling import Labeller, SampleClock
+from Packets import frozen
+from Pipeline import Load, Throttle
+from SignalQuality import QualityMonitor
+from Protocol import DEFAULT_PROTOCOL, ProtocolError, loadProtocol
+from Recorder import TaskRecorder
+from Scheduler import Phase, TrialScheduler
+from SerialCom import SerialLink
+from Streaming import StreamPublisher
+
+RESULTS_DIR = "Results" # participant folders are created in this folder of the working directory
+
+# folder a participant's session is recorded to, pid as entered (a string)
+def participantPath(pid):
+    return QDir(RESULTS_DIR).absoluteFilePath("PID" + pid)
+
+# set up the program log, written to Logs/log_<date time>.log, keeping the newest 100 logs. If console is set the log is also printed
+# suffix is added to the log file name and prune, if False, leaves the old logs alone, for a second process of the program logging beside the first (see SharedDisplay.py)
+def startLogging(console=False, suffix="", prune=True):
+    logger = logging.getLogger("app_logger") # each part of the program creates a child of this logger, the name shows in the log where the message comes from
+    logger.setLevel(logging.DEBUG)
+
+    # check logs folder, if we have more than 100 logs, clear the oldest
+    dir = QDir()
+    if not dir.exists("Logs"):
+        dir.mkdir("Logs")
+    dir.cd("Logs")
+    logs = dir.entryList()
+    l_logs = len(logs)
+    if prune and l_logs > 100:
+        for i in range(100, l_logs-1):
+            dir.remove(logs[l_logs-i])
+
+    # Determine the output file name of the log
+    fh = logging.FileHandler("Logs/log_%s%s.log" % (QDateTime.currentDateTime().toString("yyyy-MM-dd hh-mm-ss"), suffix))
+    fh.setLevel(logging.DEBUG)
+
+    # setup the format of the logger, posts the time, the widget name, the level of message, and the message
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+    if console:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+    return logger
+
+# convert a raw IT reading from the device. imp is the AD5933 real and imaginary values for each sensor as unsigned int16 (FCU sen 1, FCU sen 2, ECR sen 1, ECR sen 2), temp the MAX30205 value for FCU and ECR
+# profile is the calibration of the board (see Calibration.py), frequency the excitation frequency the reading was made at
+# returns an ITReading (see Schema.py) of the "raw AD5933 values", "calculated magnitudes", "calculated phases", "calculated temperatures"
+def convertImpTemp(imp, temp, profile=DEFAULT_PROFILE, frequency=IT_FREQUENCY):
+    temps = [t * 0.00390625 for t in temp] # the MAX30205 provides this value as a multiplier for the recorded interger value. Performing float maths on the PC is more straightforward so done here
+
+    # Convert the raw readings to signed intergers, then calculate the magnitude and phase values as per the AD5933 datasheet
+    comb_val, phase_val = rawPolar(imp)
+
+    # apply the calibration polynomial of each electrode pair to the recorded magnitude value, and the open (no DUT) adjustment in phase to the recorded phase
+    imps, phases = profile.convert(comb_val, phase_val, frequency)
+
+    return ITReading(tuple(imp), tuple(imps.tolist()), tuple(phases.tolist()), tuple(temps))
+
+State = Enum('State', ['INACTIVE', 'STIM_ON', 'STIM_OFF'])
+
+class AcquisitionEngine(QObject):
+
+    # device signals
+    sig_portNotification = pyqtSignal(str) # errors/warnings/info on the com port
+    sig_deviceNotification = pyqtSignal(str) # errors/warnings/info on the Arduino or Sensors
+    sig_serialError = pyqtSignal() # signal emitted if there is an error on the serial port
+    sig_sensorsReady = pyqtSignal() # signal emitted when the Arduino alerts that sensors are detected on the bus, a participant session can then be opened
+    sig_emgDataReady = pyqtSignal(object) # signal emitted for every EMG packet as read, an immutable EMGPacket (see Packets.py) passed by reference
+    sig_emgLabelled = pyqtSignal(object) # signal emitted for every EMG packet once labelled, the same EMGPacket with the class of each sample (all rest outside a task) and the task index of its first sample (None outside a task)
+    sig_impTempReady = pyqtSignal(object) # signal emitted with the latest processed impedance and temperature reading, an ITReading (see Schema.py) of the "raw AD5933 values", "calculated magnitudes", "calculated phases", "calculated temperatures"
+    sig_displayFrame = pyqtSignal() # signal emitted when the displays should redraw the data received since the last frame, skipped while the pipeline is overloaded
+    sig_pipelineLoad = pyqtSignal(str, int) # signal emitted when the load on the live pipeline changes (Load name, packets waiting), see Pipeline.py
+    sig_sweepReady = pyqtSignal(object) # signal emitted with each completed impedance sweep, a SweepResult (see ImpedanceSweep.py)
+    sig_calibrationChanged = pyqtSignal(str) # signal emitted when the impedance calibration in use changes, with its description
+    sig_samplingChanged = pyqtSignal(object) # signal emitted when the device connects with an EMG sampling other than the one in use, the new Sampling (see Schema.py)
+    sig_qualityUpdate = pyqtSignal(list, list) # signal emitted with the signal quality score and flags of each sensor (see SignalQuality.py), at once when flags change, otherwise at most every quality_interval
+
+    # session signals
+    sig_sessionOpened = pyqtSignal(str, int) # signal emitted when a participant session is opened (folder, number of the next task to run, beyond the last task if all are complete)
+    sig_taskStarted = pyqtSignal(int, str) # signal emitted when a task starts (task number from 1, task name)
+    sig_taskEnded = pyqtSignal(int, bool) # signal emitted when a task stops (task number, True if it ran to the end, False if abandoned)
+
+    # cue signals, for the stimulus displays and alerts
+    sig_resetStim = pyqtSignal() # signal to indicate a trial ended and the stim should be reset
+    sig_setStimVal = pyqtSignal(int) # signal to indicate the stim image should update to image based on int
+    sig_setStimOn = pyqtSignal() # signal to indicate the stim image should show active and green border
+    sig_setStimOff = pyqtSignal() # signal to indicate the stim image should show active and red border
+    sig_progressUpdate = pyqtSignal(float) # signal to update the progress bar, value between 0 and 1
+    sig_alert = pyqtSignal(bool) # signal to play the pick up (True) or put down (False) alert
+
+    display_skip_interval = 0.5 # longest time in s between display frames while overloaded
+    quality_interval = 0.25 # shortest time in s between signal quality updates, lengthened while the pipeline is behind
+
+    # initialise values
+    stimVal = 1 # current stim value
+    repetition = 1 # current repetition value
+    state = State.INACTIVE # state for trial state machine
+
+    current_task = 0 # counter for trials, 0 before the first task, tasks of the protocol are numbered from 1
+
+    results_dir = None # directory for storage, None until a participant session is opened
+    enabled_recording = False # toggle to indicate recording allowed
+    in_task = False # flag for whether a trial is in progress
+
+    recorder = None # writes the files of the current task
+    journal = None # write-ahead journal of the participant session, used to recover after a crash
+    catalog = None # catalog of the results folder, each task is added as it completes (see Catalog.py)
+    durability = Durability.FLUSH # how hard recordings are pushed to disk, see Journal.py
+    checkpoint_interval = 1.0 # seconds between journal checkpoints during a task
+    compress_recording = False # save the task EMG compressed as <task>.emgz (see Compression.py) rather than csv
+
+    # cue timing, clock times for when the current cue was scheduled and when it was actually made
+    cue_planned = None
+    cue_fired = None
+
+    # storage for incoming IT variables
+    it_reading = None # IT reading waiting to be saved with the next EMG packet
+
+    polling = True # periodic IT reads on the sensors, on at power up
+
+    calibration = DEFAULT_PROFILE # AD5933 calibration of the connected board, loaded when it connects (see Calibration.py)
+    calibration_run = None # CalibrationRun while calibrating the board
+    polling_before_calibration = False
+
+    debugging_save = False
+    cue_display_wait = 0 # seconds each cue's label transition is held waiting for the display to report its paint, set while the participant window is in another process (see SharedDisplay.py)
+
+    load = Load.NORMAL # load on the live pipeline at the last batch
+    rest_labels = () # labels of a packet outside a task
+    frames_drawn = 0
+    frames_skipped = 0
+
+    # stream_address, if given, publishes the decoded data to other processes, "host:port" or "local:<name>" (see Streaming.py)
+    # clock times the schedule, the device and the timers (see Clock.py), a VirtualClock runs sessions in simulated time (see Simulator.py --virtual)
+    def __init__(self, protocol, stream_address=None, clock=REAL_CLOCK, *args, **kwargs):
+
+        super(AcquisitionEngine, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.AcquisitionEngine")
+
+        self.protocol = protocol # the tasks to run, each with its precompiled schedule
+        self.clock = clock
+        self.sampling = protocol.sampling # EMG sampling of the device, the protocol's until the device reports its own when it connects
+
+        self.link = SerialLink(protocol.sampling, clock)
+        self.link.sig_emgDataReady.connect(self.sig_emgDataReady)
+        self.link.sig_emgBlockReady.connect(self.newEMGData)
+        self.link.sig_impTempReady.connect(self.impTempDataReady)
+        self.link.sig_portNotification.connect(self.portNotification)
+        self.link.sig_deviceNotification.connect(self.deviceNotification)
+        self.link.sig_serialError.connect(self.sig_serialError)
+        self.link.sig_batchDone.connect(self.batchDone)
+        self.link.sig_samplingChanged.connect(self.samplingChanged)
+        
+        # overload policies of the sinks (see Pipeline.py). Recording is given every packet in order, spilling the intake queue to disk if needed.
+        # Displays are given every packet but redraws are skipped once overloaded, after the load warning has been raised, at up to display_skip_interval apart
+        self.display_throttle = Throttle(0, self.display_skip_interval, Load.OVERLOADED)
+        self.quality_throttle = Throttle(self.quality_interval, 4 * self.quality_interval)
+
+        # signal quality of each sensor, measured on every packet (or batch of packets processed together). Changes of its flags are saved with the recording so bad segments can be excluded from training
+        self.quality = QualityMonitor(self.sampling.sample_rate, self.sampling.channels)
+        self.quality_saved = False # whether the flags have been saved since the task started
+
+        # set up a timer for 1 second, which on timeout sends the command to ask the arduino to confirm the sensor precense
+        self.poll_sen_timer = clock.timer()
+        self.poll_sen_timer.setInterval(1000)
+        self.poll_sen_timer.timeout.connect(self.checkForSensors)
+
+        # setup the scheduler for running a task. All rest, activity and IT read events of a task are computed up front by the protocol, and timed from the task start
+        self.scheduler = TrialScheduler(clock)
+        self.scheduler.sig_event.connect(self.processTask)
+
+        # label stream of the current task. Each stimulus transition is converted to a device sample index using a model of the sample times, so samples are labelled exactly rather than per packet
+        self.sample_clock = SampleClock(self.sampling.sample_rate)
+        self.labeller = Labeller(self.sample_clock)
+
+        # impedance sweeps, made in place of the IT reads of tasks with it_sweep set or on request. IT readings are passed to the sweep while it runs
+        self.sweep = ImpedanceSweep(self.link, clock)
+        self.sweep.sig_done.connect(self.sweepDone)
+
+        self.publisher = None
+        if stream_address is not None:
+            self.publisher = StreamPublisher(self.sampling.channels, self.sampling.sample_rate, [g.name for g in protocol.grips], self)
+            if self.publisher.listen(stream_address):
+                self.sig_emgLabelled.connect(self.publisher.publishEMG)
+                self.sig_impTempReady.connect(self.publisher.publishIT)
+            else:
+                self.publisher = None
+
+    # begin looking for the device, once all clients are connected to the signals. If simulate is given a simulated device is run at that speed instead
+    def start(self, simulate=None):
+        self.link.postInit()
+        if simulate is not None:
+            self.link.simulate(simulate)
+        else:
+            self.link.testSerialPorts() # first scan now rather than after the polling interval
+
+    # close the port and the stream, e.g. on program exit. Any running task is left to be recovered from the journal
+    def close(self):
+        self.link.closePort()
+        self.link.intake.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.catalog is not None:
+            self.catalog.close()
+
+    # callback for port notifications. If the arduino is connected, load its calibration and begin the polling timer for the sensors
+    def portNotification(self, noti):
+        self.sig_portNotification.emit(noti)
+        if noti == "Arduino Connected":
+            self.calibration = loadProfile(self.link.board_serial)
+            self.sig_calibrationChanged.emit(self.calibration.describe())
+            self.poll_sen_timer.start()
+
+    # callback when the device connects, with the Sampling its EMG packets follow. The parts of the engine set up for a sample rate are remade for it if it changed
+    def samplingChanged(self, sampling):
+        if sampling == self.sampling:
+            return
+        if self.in_task: # a task's samples all have the same rate
+            self.reset()
+        self.sampling = sampling
+        self.quality = QualityMonitor(sampling.sample_rate, sampling.channels)
+        self.sample_clock = SampleClock(sampling.sample_rate)
+        self.labeller = Labeller(self.sample_clock)
+        if self.publisher is not None:
+            self.publisher.setStream(sampling.channels, sampling.sample_rate)
+        self.sig_samplingChanged.emit(sampling)
+
+    # callback for device notifications. If the sensors are both there, end the polling and emit the ready signal, which unlocks the program for recording
+    def deviceNotification(self, noti):
+        self.sig_deviceNotification.emit(noti)
+        if noti == "Connected":
+            self.poll_sen_timer.stop()
+            self.sig_sensorsReady.emit()
+
+    # function to store signal emit command on timer finish for checking sensor state on arduino
+    def checkForSensors(self):
+        self.link.sendCommand(cmds.CHECK_SEN)
+
+    # abandon any running task, its files are set aside and it is run again when next started, e.g. after losing the connection
+    def reset(self):
+        if self.in_task: # reset current task back 1 if we lost connection during the task
+            self.scheduler.stop()
+            self.endRecording()
+            if self.journal is not None and not self.debugging_save:
+                self.journal.taskAbandoned(self.current_task, self.taskFileName(), "reset")
+                setAsideTask(self.results_dir.absolutePath(), self.taskFileName()) # the task is run again with new files
+            self.in_task = False
+            self.sig_resetStim.emit()
+            self.sig_taskEnded.emit(self.current_task, False)
+            self.enabled_recording = False
+            self.current_task -= 1
+        self.sweep.stop()
+        if self.calibration_run is not None:
+            self.calibration_run.stop()
+        self.quality.reset() # the signal is measured afresh once reconnected
+
+    # used in a debugging environment which ignores certain program flow rules. While on, the EMG is recorded to debugging.csv in the participant folder, without the journal,
+    # and so are any tasks started
+    def toggleDebugging(self):
+        if self.in_task or self.results_dir is None:
+            self.logger.warning("Debugging saves need a participant folder and no task running")
+            return
+        self.debugging_save = not self.debugging_save
+        if self.debugging_save:
+            self.recorder = TaskRecorder(self.results_dir.absolutePath(), self.taskFileName(), None, self.durability, self.checkpoint_interval, self.compress_recording, self.sampling.sample_rate, self.clock)
+            self.sample_clock.reset()
+            self.labeller.reset()
+            self.quality_saved = False
+            self.enabled_recording = True
+        else:
+            self.endRecording()
+        self.logger.info(f"Debugging saves {'on' if self.debugging_save else 'off'}")
+
+    # open the session of a participant, creating their folder or continuing one that exists from where its journal shows it got to. An interrupted task is recovered and set aside first
+    # returns the number of the next task to run
+    def openParticipant(self, pid):
+        dir = QDir()
+        if not dir.exists(RESULTS_DIR): # ensure we have a results folder
+            dir.mkdir(RESULTS_DIR)
+        dir.cd(RESULTS_DIR) # change to results folder
+        path = dir.absoluteFilePath("PID" + pid)
+        resume_task = 1
+        if dir.exists("PID" + pid):
+            status = sessionStatus(path, self.protocol)
+            self.journal = SessionJournal(path, self.durability)
+            if status is not None:
+                resume_task = status.resume_task
+                if status.unfinished is not None:
+                    recoverUnfinished(path, status, self.journal)
+        else:
+            dir.mkdir("PID" + pid)
+            self.journal = SessionJournal(path, self.durability)
+        dir.cd("PID" + pid)
+        self.results_dir = dir
+        if self.catalog is None:
+            self.catalog = Catalog(RESULTS_DIR, self.protocol)
+        self.participant = int(pid)
+        self.current_task = resume_task - 1 # the next task started is the one to resume at
+        if self.current_task > 0:
+            self.logger.info(f"Resuming at task {resume_task}")
+        self.setImpPolling(False) # disable the periodic IT read on the sensors
+        self.sig_sessionOpened.emit(path, resume_task)
+        return resume_task
+
+    # whether a participant session is open with tasks still to run
+    def tasksRemaining(self):
+        return self.results_dir is not None and self.current_task < len(self.protocol.tasks)
+
+    # turn the periodic IT read on the sensors on or off
+    def setImpPolling(self, on):
+        self.link.sendCommand(cmds.START_IMP_PER if on else cmds.STOP_IMP_PER)
+        self.polling = on
+
+    # start the next task of the protocol
+    def startNextTask(self):
+        self.setImpPolling(False) # just to be sure, stop periodic (it shouldn't be running due to the controls preventing a start while running)
+        self.in_task = True # flag we are in a trial
+        self.current_task += 1 # update the trial counter
+        task = self.protocol.tasks[self.current_task-1]
+        for command in task.commands: # AD5933 set up for this task
+            self.link.sendCommand(command)
+        self.endRecording() # a debugging recording made outside the task is closed
+        journal = None if self.debugging_save else self.journal
+        self.recorder = TaskRecorder(self.results_dir.absolutePath(), self.taskFileName(), journal, self.durability, self.checkpoint_interval, self.compress_recording, self.sampling.sample_rate, self.clock)
+        if journal is not None:
+            journal.taskStarted(self.current_task, task.name, task.file, self.sampling)
+        self.link.drainAll() # packets received before the start may still be waiting if the pipeline is behind, they do not belong to this task
+        self.sample_clock.reset() # sample indices count from the task start, i.e. they are the row numbers of the task file
+        self.labeller.reset()
+        self.quality_saved = False # the first packet saves the flags the task starts with
+        self.enabled_recording = True
+        self.stimVal = None # forces the first rest event to send the grip to the display
+        self.sig_taskStarted.emit(self.current_task, task.name)
+        self.scheduler.start(task.schedule) # the first rest event fires immediately, showing the first grip
+
+    # call back function for each event of the task schedule as it falls due. planned and actual are the clock times the event was due and was run
+    def processTask(self, event, planned, actual):
+        self.cue_planned = planned
+        self.cue_fired = actual
+
+        if event.phase == Phase.END: # check if we have completed the trial, reset variables if so
+            self.cue_fired = None
+            self.stimVal = 1
+            self.sig_resetStim.emit()
+            self.link.drainAll() # packets received before the end may still be waiting if the pipeline is behind, they belong to this task
+            recorder = self.recorder
+            self.endRecording()
+            if self.journal is not None and not self.debugging_save:
+                self.journal.taskEnded(self.current_task, self.taskFileName(), self.sample_clock.samples)
+                task = self.protocol.tasks[self.current_task-1]
+                source_path = recorder.path(extension=".emgz" if self.compress_recording else ".csv")
+                self.catalog.addTask(self.participant, self.current_task, task.name, task.file, source_path, self.sampling.sample_rate, recorder.index())
+            self.in_task = False
+            self.scheduler.stop()
+            self.sig_taskEnded.emit(self.current_task, True)
+            return
+
+        if event.phase == Phase.IT_READ: # a reaction delay after an activity period, request an IT read or a sweep
+            self.cue_fired = None
+            if self.protocol.tasks[self.current_task-1].it_sweep:
+                self.startSweep()
+            else:
+                self.getImpAndTemp()
+            return
+
+        if event.phase == Phase.ACTIVE: # start of an activity period
+            self.sig_alert.emit(True) # play the pickup alert
+            self.state = State.STIM_ON # set state to activity period
+            self.recordTransition(event.stim, actual)
+            self.sig_setStimOn.emit() # update the stimulus display
+
+        elif event.phase == Phase.REST: # start of a rest period
+            if event.offset > 0:
+                self.sig_alert.emit(False) # play the put down alert, not needed for the rest that starts the task
+            self.state = State.STIM_OFF # set state to rest period
+            self.recordTransition(0, actual)
+            self.repetition = event.repetition
+            if event.stim != self.stimVal: # if we have moved on to the next grip
+                self.stimVal = event.stim
+                self.sig_setStimVal.emit(self.stimVal) # send the updated grip value to the display
+            self.sig_setStimOff.emit() # reset the stim image to red border for rest
+            self.sig_progressUpdate.emit(event.progress) # update the progress bar
+        self.logger.info(f"Stim val = {self.stimVal}, {self.state}") # log the trial progress state
+
+    # stop recording and close the task files
+    def endRecording(self):
+        self.enabled_recording = False
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    # add a transition to the label stream at the time it was made, it is moved to when the cue was displayed once that is known
+    def recordTransition(self, label, t):
+        self.labeller.addTransition(t, label, self.cue_display_wait)
+
+    # callback when the participant display has painted a cue. Records how late the timer fired and how long the display took to switch, so cue onset labels can be corrected
+    # headless there is no display, transitions are labelled from when the timer fired and no cues are saved
+    def stimDisplayed(self, t):
+        if self.cue_fired is None: # not a timed cue
+            return
+        timer_latency = (self.cue_fired - self.cue_planned)*1000
+        display_latency = (t - self.cue_fired)*1000
+        self.cue_fired = None
+        self.logger.info(f"Cue latency: timer {timer_latency:.2f} ms, display {display_latency:.2f} ms")
+        self.labeller.adjustLast(t) # the participant sees the transition when the cue is painted
+        if self.enabled_recording:
+            self.recorder.writeCue(self.stimVal, self.state.name, timer_latency, display_latency)
+
+    # name of the file the current task is saved to, without extension
+    def taskFileName(self):
+        if self.debugging_save: # check if we are doing a real or debug save
+            return "debugging"
+        return self.protocol.tasks[self.current_task-1].file
+
+    # callback function from the schedule to send an IT read request command to the device
+    def getImpAndTemp(self):
+        self.link.sendCommand(cmds.IMP_TMP)
+
+    # begin an impedance sweep of the electrodes, the result is saved with the task if recording and passed on by sig_sweepReady
+    def startSweep(self):
+        if not self.sweep.start():
+            self.logger.warning("Impedance sweep requested while one is running")
+
+    # callback for a completed impedance sweep
+    def sweepDone(self, result):
+        if self.enabled_recording:
+            self.recorder.writeSweep(result)
+        self.sig_sweepReady.emit(result)
+
+    # begin calibrating the connected board against loads (ReferenceLoads) at frequencies, readings times each. Periodic IT reads are stopped until the calibration ends.
+    # Returns the CalibrationRun, whose measure(i) is called once load i is connected. Raises CalibrationError if a calibration cannot be made now
+    def startCalibration(self, loads, frequencies=(IT_FREQUENCY,), readings=None):
+        if self.in_task or self.calibration_run is not None:
+            raise CalibrationError("a task or calibration is running")
+        self.calibration_run = CalibrationRun(self.link, self.link.board_serial or "unknown", loads, frequencies, readings, self.clock)
+        self.polling_before_calibration = self.polling
+        if self.polling:
+            self.setImpPolling(False)
+        self.logger.info(f"Calibrating board {self.link.board_serial} with {len(loads)} loads at {len(frequencies)} frequencies")
+        return self.calibration_run
+
+    # use a fitted calibration profile from now on, saving it for the board
+    def applyCalibration(self, profile):
+        path = profile.save(CALIBRATION_DIR)
+        self.logger.info(f"Saved {profile.describe()} to {path}")
+        self.calibration = profile
+        self.sig_calibrationChanged.emit(profile.describe())
+        self.endCalibration()
+
+    # end calibrating, whether or not a profile was applied
+    def endCalibration(self):
+        if self.calibration_run is None:
+            return
+        self.calibration_run.stop()
+        self.calibration_run = None
+        if self.polling_before_calibration:
+            self.setImpPolling(True)
+
+    # callback on receipt of new EMG data from the Arduino, a list of EMGPackets received one after another. Normally one, while catching up or on a virtual clock many,
+    # which are labelled, measured and saved together
+    def newEMGData(self, packets):
+        lengths = [packet.samples.shape[1] for packet in packets]
+        data_i = packets[0].samples if len(packets) == 1 else np.concatenate([packet.samples for packet in packets], axis=1)
+        recv_time = packets[-1].recv_time
+        changed = self.quality.addPacket(data_i)
+        if self.enabled_recording: # check if we are recording
+            recv_times = [packet.recv_time for packet in packets]
+            firsts = self.sample_clock.addPackets(lengths, recv_times)
+            labels, transitions = self.labeller.labelPacket(firsts[0], data_i.shape[1], recv_time) # class of each sample from the label stream
+            labels = frozen(labels)
+            for t, label, index in transitions:
+                self.recorder.writeTransition(t, label, index)
+            it_values = []
+            if self.it_reading is not None: # check if we have outstanding IT data to save
+                it_values = itValues(self.it_reading) # concatenate all the IT data
+                self.it_reading = None # clear the recorded IT data
+            self.recorder.writePackets(recv_times, lengths, data_i, labels, it_values) # save to the task file, IT values are added to the first row of the first packet
+            for c in (changed if self.quality_saved else range(self.quality.channels)):
+                self.recorder.writeQuality(recv_time, c, self.quality.flags[c], self.quality.scores[c], firsts[-1])
+            self.quality_saved = True
+            if self.recorder.checkpointDue():
+                self.recorder.checkpoint(self.current_task, self.stimVal, self.state.name, self.repetition, self.sample_clock.samples)
+            ends = np.cumsum(lengths).tolist()
+            for packet, first, start, end in zip(packets, firsts, [0] + ends, ends):
+                self.sig_emgLabelled.emit(packet._replace(first=first, labels=labels[start:end]))
+        else:
+            for packet, l in zip(packets, lengths):
+                if len(self.rest_labels) != l:
+                    self.rest_labels = frozen(np.zeros(l, dtype=np.int64)) # shared by every packet outside a task, it cannot be changed
+                self.sig_emgLabelled.emit(packet._replace(first=None, labels=self.rest_labels)) # rest outside a task
+        if len(changed) > 0 or self.quality_throttle.ready(self.clock.now()):
+            self.sig_qualityUpdate.emit(self.quality.scores.tolist(), self.quality.flags.tolist())
+
+    # callback after each batch of packets is processed. Tracks the load on the pipeline from the packets still waiting, and signals a display frame if one is due
+    def batchDone(self):
+        load = self.link.intake.load()
+        if load != self.load:
+            depth = self.link.intake.depth()
+            if load.value > self.load.value:
+                self.logger.warning(f"Live pipeline {load.name}, {depth} packets waiting")
+            else:
+                self.logger.info(f"Live pipeline {load.name}, {depth} packets waiting")
+            self.load = load
+            self.display_throttle.setLoad(load)
+            self.quality_throttle.setLoad(load)
+            self.sig_pipelineLoad.emit(load.name, depth)
+        if self.display_throttle.ready(self.clock.now()):
+            self.frames_drawn += 1
+            self.sig_displayFrame.emit()
+        else:
+            self.frames_skipped += 1
+
+    # callback on a raw IT reading from the device, converts it, stores it to be saved with the next EMG packet and passes it on
+    def impTempDataReady(self, imp, temp):
+        if self.calibration_run is not None and self.calibration_run.running: # a reading of a reference load
+            self.calibration_run.addReading(imp)
+            return
+        reading = convertImpTemp(imp, temp, self.calibration, self.sweep.frequency() if self.sweep.running else IT_FREQUENCY)
+        if self.sweep.running: # a reading at one frequency of a sweep, not saved with the EMG
+            self.logger.debug(f"Sweep {imp}")
+            self.sweep.addReading(reading)
+            return
+        imp_i, phase_i, tmp_i = reading.magnitude, reading.phase, reading.temperature
+
+        # store this data in the log for reference and prior testing
+        self.logger.debug(f"{imp}")
+        self.logger.info(f"FCU Temp: {tmp_i[0]}, FCU Imp Sen 1: {int(imp_i[0])}, {int(phase_i[0])} "
+                         f"FCU Imp Sen 2: {int(imp_i[1])}, {int(phase_i[1])}    "
+                         f"ECR Temp: {tmp_i[1]}, ECR Imp Sen 1: {int(imp_i[2])}, {int(phase_i[2])} "
+                         f"ECR Imp Sen 2: {int(imp_i[3])}, {int(phase_i[3])}")
+
+        self.quality.setImpedance(imp_i)
+        self.newImpAndTempData(reading)
+        self.sig_impTempReady.emit(reading)
+
+    # store a new ITReading to be saved with the next EMG packet
+    def newImpAndTempData(self, reading):
+        if self.enabled_recording: # only store if in a trial
+            if self.it_reading is not None: # check and warn if we are not recording fast enough or have an issue clearing the old values
+                self.logger.warning("Lost imp or tmp data to overwrite")
+            self.it_reading = reading # store the new IT data locally for save in above function
+
+# Runs the tasks of a participant session unattended, one after another, for the command line engine
+class HeadlessSession(QObject):
+
+    sig_finished = pyqtSignal() # signal emitted when all the requested tasks are complete, or on interrupt
+
+    def __init__(self, engine, pid, first_task=None, last_task=None, gap=10, *args, **kwargs):
+
+        super(HeadlessSession, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.HeadlessSession")
+
+        self.engine = engine
+        self.pid = pid
+        self.first_task = first_task
+        self.last_task = last_task if last_task is not None else len(engine.protocol.tasks)
+        self.gap = gap
+
+        self.next_timer = engine.clock.timer()
+        self.next_timer.setSingleShot(True)
+        self.next_timer.timeout.connect(self.startNext)
+
+        engine.sig_sensorsReady.connect(self.sensorsReady)
+        engine.sig_serialError.connect(self.serialError)
+        engine.sig_taskEnded.connect(self.taskEnded)
+
+    # sensors connected, at start up or again after losing the connection
+    def sensorsReady(self):
+        if self.engine.results_dir is None:
+            self.engine.openParticipant(self.pid)
+            if self.first_task is not None:
+                if self.first_task - 1 < self.engine.current_task:
+                    self.logger.warning(f"Task {self.first_task} was already recorded, it will be recorded again")
+                self.engine.current_task = self.first_task - 1
+        else:
+            self.engine.setImpPolling(False)
+        self.next_timer.start(0)
+
+    # connection lost, abandon any running task, it is run again once the sensors are back
+    def serialError(self):
+        self.next_timer.stop()
+        if self.engine.in_task:
+            self.logger.warning(f"Connection lost during task {self.engine.current_task}, it will be run again")
+            self.engine.reset()
+
+    def taskEnded(self, number, completed):
+        if completed:
+            self.next_timer.start(int(self.gap * 1000))
+
+    def startNext(self):
+        if self.engine.in_task:
+            return
+        if not self.engine.tasksRemaining() or self.engine.current_task >= self.last_task:
+            self.logger.info("All requested tasks complete")
+            self.sig_finished.emit()
+            QCoreApplication.quit()
+            return
+        self.setAsideRecorded(self.engine.current_task + 1)
+        self.logger.info(f"Starting task {self.engine.current_task + 1} of {self.last_task}")
+        self.engine.startNextTask()
+
+    # a task asked for again by --tasks has its earlier files moved aside, as the recorder appends to any it finds
+    def setAsideRecorded(self, number):
+        path = self.engine.results_dir.absolutePath()
+        file = self.engine.protocol.tasks[number-1].file
+        if any(os.path.exists(os.path.join(path, file + ext)) for ext in [".csv", ".emgz"]):
+            set_aside = setAsideTask(path, file)
+            self.engine.journal.write("task_set_aside", task=number, file=file, set_aside=set_aside)
+            self.logger.info(f"Moved the earlier recording of task {number} to {set_aside}")
+
+    # on Ctrl+C, abandon any running task so it is set aside and run again when the session is resumed
+    def interrupt(self):
+        self.logger.info("Interrupted")
+        self.next_timer.stop()
+        self.engine.reset()
+        self.sig_finished.emit()
+        QCoreApplication.quit()
+
+if __name__ == "__main__":
+    logger = startLogging(console=True)
+    app = QCoreApplication(sys.argv)
+
+    args = sys.argv[1:]
+    options = {}
+    for name in ["--pid", "--tasks", "--gap", "--stream", "--simulate"]:
+        if name in args:
+            i = args.index(name)
+            options[name] = args[i+1] if i + 1 < len(args) else ""
+            del args[i:i+2]
+    compress = "--compress" in args
+    if compress:
+        args.remove("--compress")
+    if not options.get("--pid", "").isdigit():
+        print("usage: python Engine.py [protocol] --pid <n> [--tasks <first>[-<last>]] [--gap <s>] [--stream <address>] [--compress] [--simulate <speed>]")
+        sys.exit(2)
+
+    protocol_path = args[0] if len(args) > 0 else DEFAULT_PROTOCOL
+    try:
+        protocol = loadProtocol(protocol_path)
+    except ProtocolError as e:
+        logger.error(f"Invalid protocol: {e}")
+        sys.exit(1)
+    first_task, last_task = None, None
+    if "--tasks" in options:
+        first, _, last = options["--tasks"].partition("-")
+        first_task = int(first)
+        last_task = int(last) if last else first_task
+
+    AcquisitionEngine.compress_recording = compress
+    engine = AcquisitionEngine(protocol, options.get("--stream"))
+    if "--stream" in options and engine.publisher is None:
+        sys.exit(1)
+    session = HeadlessSession(engine, options["--pid"], first_task, last_task, float(options.get("--gap", 10)))
+
+    # Python only handles Ctrl+C between Qt events, a timer keeps the interpreter running often enough to notice it
+    signal.signal(signal.SIGINT, lambda *a: session.interrupt())
+    interrupt_timer = QTimer()
+    interrupt_timer.timeout.connect(lambda: None)
+    interrupt_timer.start(200)
+
+    engine.start(float(options["--simulate"]) if "--simulate" in options else None)
+    logger.info(f"Engine started in {(time.perf_counter() - startup_tic)*1000:.1f} ms, waiting for the device")
+    app.exec_()
+    engine.close()
@@ -0,0 +1,187 @@
+# Impedance sweep of the electrodes, and the fit of an electrode-skin equivalent circuit to it
+# The single IT read is made at one AD5933 excitation frequency (IT_FREQUENCY). A sweep reads at each frequency of SWEEP_FREQUENCIES in turn, sending SET_AD_FREQ_ then IMP_TMP and moving on
+# once the reading arrives, then sets the sensors back to IT_FREQUENCY. The readings go through the same IMP and TMP frames and conversion as single reads (Engine.convertImpTemp),
+# using the board's calibration at each frequency where its profile has one (see Calibration.py), and the sweep runs the same against the rig or the simulated device.
+# The readings are collected into an array of complex impedance (electrodes, frequencies) and a model fitted to every electrode at once:
+#   "rrc"  - R-RC, a series resistance with a resistance and capacitance in parallel: Z = Rs + Rp / (1 + jw Rp C)
+#   "cole" - Cole, Z = Rinf + (R0 - Rinf) / (1 + (jw tau)^alpha), alpha < 1 giving the depressed arc of real electrode-skin contacts
+# The fit is Levenberg-Marquardt on transformed parameters (logs, and the logit of alpha) so they stay in range, minimising the error relative to the measured impedance.
+# The residuals, Jacobians and normal equations of all electrodes are batched into arrays and solved together, so a fit takes a few ms and a sweep fits easily in the rest between activations
+
+import logging
+from collections import namedtuple
+
+import numpy as np
+from PyQt5.QtCore import *
+
+from Clock import REAL_CLOCK
+from Commands import cmds
+from Schema import IT_FREQUENCY, SWEEP_FREQUENCIES
+
+# names of the parameters of each model, in the order of the fitted parameters
+MODEL_PARAMETERS = {"rrc": ["Rs", "Rp", "C"], "cole": ["Rinf", "R0", "tau", "alpha"]}
+
+# the fit of a model to each electrode. parameters is (electrodes, parameters) in the order of MODEL_PARAMETERS, rms the rms error relative to the measured impedance of each electrode
+ModelFit = namedtuple('ModelFit', ['model', 'parameters', 'rms', 'iterations'])
+
+# a completed sweep. time is the clock time it ended, frequencies in Hz, readings the ITReading at each frequency, impedance complex ohms (electrodes, frequencies), fit a ModelFit
+SweepResult = namedtuple('SweepResult', ['time', 'frequencies', 'readings', 'impedance', 'fit'])
+
+# complex impedance (electrodes, frequencies) from the ITReadings of a sweep, magnitudes in ohms and phases in degrees
+def sweepImpedance(readings):
+    magnitude = np.array([r.magnitude for r in readings]).T
+    phase = np.deg2rad(np.array([r.phase for r in readings]).T)
+    return magnitude * np.exp(1j * phase)
+
+# model impedance (electrodes, frequencies) for transformed parameters u (electrodes, parameters) at angular frequencies w
+def modelImpedance(model, u, w):
+    if model == "rrc":
+        rs, rp, c = np.exp(u).T[:, :, None]
+        return rs + rp / (1 + 1j * w * rp * c)
+    r_inf, dr, tau = np.exp(u[:, :3]).T[:, :, None]
+    alpha = 1 / (1 + np.exp(-u[:, 3:])) # (electrodes, 1)
+    return r_inf + dr / (1 + (1j * w * tau)**alpha)
+
+# model parameters (electrodes, parameters) from transformed ones, and back
+def toParameters(model, u):
+    p = np.exp(u)
+    if model == "cole":
+        p[:, 1] += p[:, 0] # R0 = Rinf + dR
+        p[:, 3] = 1 / (1 + np.exp(-u[:, 3]))
+    return p
+
+def fromParameters(model, p):
+    p = np.array(p, dtype=np.float64)
+    if model == "cole":
+        alpha = np.clip(p[:, 3], 1e-3, 1 - 1e-3)
+        p[:, 1] = np.maximum(p[:, 1] - p[:, 0], 1e-3 * p[:, 1])
+        p[:, 3] = 1
+        u = np.log(p)
+        u[:, 3] = np.log(alpha / (1 - alpha))
+        return u
+    return np.log(p)
+
+# starting parameters (electrodes, parameters) read off the data: the high and low frequency resistance from the real part at each end of the sweep,
+# and the time constant from the frequency of the largest capacitive reactance
+def initialGuess(model, w, z):
+    r_inf = np.maximum(z[:, -1].real, 1.0)
+    r_0 = np.maximum(z[:, 0].real, 1.01 * r_inf)
+    tau = 1 / w[np.argmax(-z.imag, axis=1)]
+    if model == "rrc":
+        return fromParameters(model, np.stack([r_inf, r_0 - r_inf, tau / (r_0 - r_inf)], axis=1))
+    return fromParameters(model, np.stack([r_inf, r_0, tau, np.full(len(z), 0.8)], axis=1))
+
+# residuals (electrodes, 2 * frequencies), the real and imaginary error relative to the measured magnitude
+def residuals(model, u, w, z, scale):
+    e = (modelImpedance(model, u, w) - z) / scale
+    return np.concatenate([e.real, e.imag], axis=1)
+
+# fit model ("rrc" or "cole") to the complex impedance z (electrodes, frequencies) measured at frequencies (Hz), all electrodes together. Returns a ModelFit
+def fitModel(frequencies, z, model="cole", max_iterations=100, tolerance=1e-10):
+    w = 2 * np.pi * np.asarray(frequencies, dtype=np.float64)
+    z = np.atleast_2d(np.asarray(z, dtype=np.complex128))
+    scale = np.maximum(np.abs(z), 1e-9)
+    u = initialGuess(model, w, z)
+    n, p = u.shape
+    damping = np.full(n, 1e-3) # Levenberg-Marquardt damping of each electrode
+    r = residuals(model, u, w, z, scale)
+    cost = np.sum(r**2, axis=1)
+    active = np.ones(n, dtype=bool) # electrodes still improving
+    step = 1e-6
+    iterations = 0
+    while iterations < max_iterations and active.any():
+        iterations += 1
+        # forward difference Jacobian (electrodes, residuals, parameters), one batched model evaluation per parameter
+        jacobian = np.empty((n, r.shape[1], p))
+        for k in range(p):
+            du = u.copy()
+            du[:, k] += step
+            jacobian[:, :, k] = (residuals(model, du, w, z, scale) - r) / step
+        jtj = np.einsum('nri,nrj->nij', jacobian, jacobian)
+        jtr = np.einsum('nri,nr->ni', jacobian, r)
+        a = jtj + damping[:, None, None] * (np.eye(p) * np.diagonal(jtj, axis1=1, axis2=2)[:, None, :] + 1e-12 * np.eye(p))
+        delta = np.linalg.solve(a, -jtr[:, :, None])[:, :, 0]
+        trial = np.where(active[:, None], u + delta, u)
+        trial_r = residuals(model, trial, w, z, scale)
+        trial_cost = np.sum(trial_r**2, axis=1)
+        better = active & np.isfinite(trial_cost) & (trial_cost < cost)
+        improvement = np.where(better, (cost - trial_cost) / np.maximum(cost, 1e-300), 0)
+        u[better] = trial[better]
+        r[better] = trial_r[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 3, np.minimum(damping * 4, 1e10))
+        active &= ~((better & (improvement < tolerance)) | (damping >= 1e10) | (cost < 1e-20))
+    return ModelFit(model, toParameters(model, u), np.sqrt(cost / w.size), iterations)
+
+class ImpedanceSweep(QObject):
+
+    sig_done = pyqtSignal(object) # signal emitted when a sweep completes, a SweepResult
+
+    model = "cole" # model fitted to each sweep, see MODEL_PARAMETERS
+    reading_timeout = 2000 # ms to wait for the reading at a frequency before the sweep is abandoned
+
+    # commands are sent through link (a SerialLink), the timeout is timed by clock (see Clock.py)
+    def __init__(self, link, clock=REAL_CLOCK, frequencies=SWEEP_FREQUENCIES, *args, **kwargs):
+
+        super(ImpedanceSweep, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.ImpedanceSweep")
+
+        self.link = link
+        self.clock = clock
+        self.frequencies = list(frequencies) # a subset of SWEEP_FREQUENCIES
+        self.readings = [] # readings of the running sweep so far
+        self.running = False
+
+        self.timer = clock.timer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.timeout)
+
+    # set the excitation frequency of the sensors
+    def setFrequency(self, frequency):
+        self.link.sendCommand(cmds[f"SET_AD_FREQ_{SWEEP_FREQUENCIES.index(frequency) + 1}"])
+
+    # begin a sweep, returns False if one is already running
+    def start(self):
+        if self.running:
+            return False
+        self.running = True
+        self.readings = []
+        self.started = self.clock.now()
+        self.request()
+        return True
+
+    # frequency of the reading awaited
+    def frequency(self):
+        return self.frequencies[len(self.readings)]
+
+    # ask for the reading at the next frequency
+    def request(self):
+        self.setFrequency(self.frequencies[len(self.readings)])
+        self.link.sendCommand(cmds.IMP_TMP)
+        self.timer.start(self.reading_timeout)
+
+    # abandon a running sweep, e.g. when the connection is lost
+    def stop(self):
+        self.timer.stop()
+        self.running = False
+
+    def timeout(self):
+        self.logger.warning(f"No reading at {self.frequencies[len(self.readings)]} Hz, sweep abandoned")
+        self.stop()
+        self.setFrequency(IT_FREQUENCY)
+
+    # callback for each converted ITReading while the sweep is running
+    def addReading(self, reading):
+        self.readings.append(reading)
+        if len(self.readings) < len(self.frequencies):
+            self.request()
+            return
+        self.stop()
+        self.setFrequency(IT_FREQUENCY) # single reads are made at this frequency again
+        impedance = sweepImpedance(self.readings)
+        tic = self.clock.now()
+        fit = fitModel(self.frequencies, impedance, self.model)
+        self.logger.info(f"Sweep of {len(self.frequencies)} frequencies in {(tic - self.started)*1000:.0f} ms, {fit.model} fit in {fit.iterations} iterations, "
+                         f"rms error {', '.join(f'{e:.1%}' for e in fit.rms)}")
+        self.sig_done.emit(SweepResult(self.clock.now(), self.frequencies, self.readings, impedance, fit))
@@ -0,0 +1,168 @@
+# Write-ahead journal of a participant session, used to recover if the program dies part way through a task
+# session.journal in the participant folder is append only, one JSON entry per line: the start (with the EMG sampling) and end of each task, and periodic checkpoints of the task, stimulus state,
+# sample count and size of the task file (the segment being recorded). A line torn by a crash is ignored on reading.
+# On restart an unfinished task is found from the journal, its file repaired by truncating any partial row (or chunk, if compressed), and the session can be resumed from the correct task
+
+import json
+import logging
+import os
+import time
+from enum import Enum
+
+from Compression import repairFile
+
+# How hard the recording is pushed to disk
+# BUFFERED - files are flushed only at checkpoints, a crash may lose the data since the last checkpoint
+# FLUSH    - every packet is flushed to the OS as it is written, so only a crash of the OS or power loss can lose data
+# FSYNC    - as FLUSH, plus files are fsynced at every checkpoint so data up to the last checkpoint survives power loss. Never done per packet
+Durability = Enum('Durability', ['BUFFERED', 'FLUSH', 'FSYNC'])
+
+JOURNAL_NAME = "session.journal"
+
+class SessionJournal:
+
+    def __init__(self, results_path, durability):
+        self.logger = logging.getLogger("app_logger.SessionJournal")
+        self.durability = durability
+        path = os.path.join(results_path, JOURNAL_NAME)
+        torn = os.path.exists(path) and repairSegment(path) > 0 # a line torn by a crash would otherwise be joined to the next entry
+        self.f = open(path, 'a')
+        if torn:
+            self.logger.warning("Removed torn final entry from journal")
+
+    # append an entry, the journal is always flushed so it is never behind the files it describes
+    def write(self, entry_type, **fields):
+        fields["type"] = entry_type
+        fields["time"] = time.time()
+        self.f.write(json.dumps(fields) + "\n")
+        self.f.flush()
+        if self.durability == Durability.FSYNC:
+            os.fsync(self.f.fileno())
+
+    # the EMG sampling (see Schema.py) is recorded with each task, its files have no header to hold it
+    def taskStarted(self, index, name, file, sampling):
+        self.write("task_start", task=index, name=name, file=file, sample_rate=sampling.sample_rate, channels=sampling.channels, packet_samples=sampling.samples)
+
+    def checkpoint(self, index, file, stim, state, repetition, samples, offset):
+        self.write("checkpoint", task=index, file=file, stim=stim, state=state, repetition=repetition, samples=samples, offset=offset)
+
+    def taskEnded(self, index, file, samples):
+        self.write("task_end", task=index, file=file, samples=samples)
+
+    # a task stopped without completing while the program kept running, e.g. the connection was lost
+    def taskAbandoned(self, index, file, reason):
+        self.write("task_abandoned", task=index, file=file, reason=reason)
+
+    def close(self):
+        self.f.close()
+
+# read the entries of a journal, an incomplete final line (torn by a crash) is skipped
+def readJournal(results_path):
+    path = os.path.join(results_path, JOURNAL_NAME)
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.getLogger("app_logger.SessionJournal").warning(f"Skipping unreadable journal entry: {line.strip()}")
+    return entries
+
+# the EMG sample rate each task file was recorded at, from its last task_start entry. Files whose journal does not record it (from before the sampling was recorded) are left out
+def taskSampleRates(results_path):
+    rates = {}
+    for e in readJournal(results_path):
+        if e["type"] == "task_start" and "sample_rate" in e:
+            rates[e["file"]] = e["sample_rate"]
+    return rates
+
+# truncate a file after its last complete row, returns the number of bytes removed
+def repairSegment(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0: # step back through the file to find the last newline
+            start = max(0, end - 4096)
+            f.seek(start)
+            idx = f.read(end - start).rfind(b"\n")
+            if idx > -1:
+                end = start + idx + 1
+                break
+            end = start
+        f.truncate(end)
+    return size - end
+
+# move the files of an interrupted task aside, so when it is run again it starts with new files. Returns the new name
+def setAsideTask(results_path, file):
+    n = 1
+    while any(os.path.exists(os.path.join(results_path, f"{file}_incomplete_{n}{ext}")) for ext in [".csv", ".emgz"]):
+        n += 1
+    new_file = f"{file}_incomplete_{n}"
+    for name in ["", "_labels", "_cues", "_quality", "_sweep", "_sweep_fit"]:
+        for ext in [".csv", ".emgz"]:
+            path = os.path.join(results_path, file + name + ext)
+            if os.path.exists(path):
+                os.replace(path, os.path.join(results_path, new_file + name + ext))
+    return new_file
+
+class SessionStatus:
+
+    def __init__(self, resume_task, completed, unfinished, unfinished_task, unfinished_samples):
+        self.resume_task = resume_task # protocol task number (from 1) to resume at, len(tasks) + 1 if all are complete
+        self.completed = completed # file names of completed tasks
+        self.unfinished = unfinished # file name of the task that was running when the program stopped, or None
+        self.unfinished_task = unfinished_task # its task number as journaled
+        self.unfinished_samples = unfinished_samples # samples recorded for it at the last checkpoint
+
+# examine the journal of an existing participant folder without changing anything. Returns None if there is no journal
+def sessionStatus(results_path, protocol):
+    entries = readJournal(results_path)
+    if len(entries) == 0:
+        return None
+    files = [t.file for t in protocol.tasks]
+    completed = []
+    running = None # the last task_start entry not followed by an end
+    last = None # file of the last task started
+    last_ended = False # whether it was completed
+    checkpoint = None
+    for e in entries:
+        if e["type"] == "task_start":
+            running = e
+            last = e["file"]
+            last_ended = False
+            checkpoint = None
+        elif e["type"] == "checkpoint":
+            checkpoint = e
+        elif e["type"] in ("task_end", "task_abandoned", "task_recovered"):
+            if e["type"] == "task_end":
+                last_ended = True
+                if e["file"] not in completed:
+                    completed.append(e["file"])
+            running = None
+
+    # resume at the last task started if it did not complete, otherwise the task after it
+    if last is not None and last in files:
+        resume_task = files.index(last) + (2 if last_ended else 1)
+    else:
+        resume_task = 1
+    if running is None:
+        return SessionStatus(resume_task, completed, None, None, 0)
+    return SessionStatus(resume_task, completed, running["file"], running["task"], checkpoint["samples"] if checkpoint is not None else 0)
+
+# repair the files of the unfinished task of a session and set them aside so the task can be run again. Returns the name the files were moved to
+def recoverUnfinished(results_path, status, journal):
+    logger = logging.getLogger("app_logger.SessionJournal")
+    bytes_removed = repairSegment(os.path.join(results_path, status.unfinished + ".csv"))
+    bytes_removed += repairFile(os.path.join(results_path, status.unfinished + ".emgz")) # a compressed recording is cut after its last complete chunk
+    for suffix in ["_labels", "_cues", "_quality", "_sweep", "_sweep_fit"]:
+        repairSegment(os.path.join(results_path, status.unfinished + suffix + ".csv"))
+    set_aside = setAsideTask(results_path, status.unfinished)
+    journal.write("task_recovered", task=status.unfinished_task, file=status.unfinished, set_aside=set_aside, bytes_removed=bytes_removed)
+    logger.warning(f"Task {status.unfinished} was unfinished ({status.unfinished_samples} samples at last checkpoint), removed {bytes_removed} bytes of partial row, moved to {set_aside}")
+    return set_aside
@@ -0,0 +1,102 @@
+# Sample level labelling of the recorded EMG
+# The host only knows when a packet was read from the port, not when each sample in it was taken. SampleClock models the device sample times from the packet receive times,
+# so each stimulus transition can be converted to the index of the first sample taken after it, and Labeller labels the samples of each packet exactly, even part way through a packet
+
+import numpy as np
+
+class SampleClock:
+
+    window = 40 # packets (about 1 s at 500 Hz) over which the receive latency is tracked
+
+    # sample_rate is the nominal device rate in Hz, used until enough packets are seen to fit the device clock against the host clock
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.reset()
+
+    # start counting samples from 0, e.g. at the start of a task
+    def reset(self):
+        self.samples = 0 # number of samples received so far, i.e. the index of the first sample of the next packet
+        self.period = 1 / self.sample_rate
+        self.sums = np.zeros(5) # running sums for the least squares fit of receive time against sample index (n, sx, sy, sxx, sxy)
+        self.t_ref = None # receive time of the first packet, the fit is made relative to this to keep the sums well conditioned
+        self.ends = np.zeros(self.window) # index of the last sample of recent packets
+        self.recvs = np.zeros(self.window) # receive time of recent packets
+        self.count = 0 # packets seen
+
+    # add consecutive packets of lengths samples received at recv_times, returns the index of the first sample of each
+    def addPackets(self, lengths, recv_times):
+        ends = self.samples + np.cumsum(lengths)
+        firsts = (ends - lengths).tolist()
+        self.samples = int(ends[-1])
+        ends = ends - 1
+        recv_times = np.asarray(recv_times, dtype=np.float64)
+        slots = (self.count + np.arange(len(ends)))[-self.window:] % self.window
+        self.ends[slots] = ends[-self.window:]
+        self.recvs[slots] = recv_times[-self.window:]
+        self.count += len(ends)
+        # the device clock may run slightly fast or slow against the host, fit the period once there are a few seconds of packets
+        if self.t_ref is None:
+            self.t_ref = recv_times[0]
+        y = recv_times - self.t_ref
+        self.sums += [len(ends), ends.sum(), y.sum(), (ends*ends).sum(), (ends*y).sum()]
+        n_p, sx, sy, sxx, sxy = self.sums
+        if self.count > 100 and n_p*sxx - sx*sx > 0:
+            self.period = (n_p*sxy - sx*sy) / (n_p*sxx - sx*sx)
+        return firsts
+
+    # host time of sample index 0. A packet can only be delayed between the last sample being taken and being read, never early,
+    # so the packet with the smallest delay over the recent window gives the best estimate (the lower envelope of receive time against sample index)
+    def origin(self):
+        m = min(self.count, self.window)
+        return np.min(self.recvs[:m] - self.ends[:m]*self.period)
+
+    # fractional sample index taken at a host perf_counter time
+    def sampleAt(self, t):
+        return (t - self.origin()) / self.period
+
+class Labeller:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.reset()
+
+    # clear the label stream, e.g. at the start of a task. Samples before the first transition are labelled rest (0)
+    def reset(self):
+        self.times = [] # host time of each transition
+        self.labels = [] # class from each transition
+        self.indices = [] # first sample index of each resolved transition
+        self.resolved = 0 # number of transitions converted to a sample index
+        self.hold_until = None # host time until which the last transition is held waiting for adjustLast, None if not held
+
+    # add a transition made at host time t. If hold is given, the transition is not converted to a sample index for up to hold seconds, waiting for adjustLast with the time it was displayed,
+    # for a display reporting its cues later than the packets that follow them (see SharedDisplay.py)
+    def addTransition(self, t, label, hold=0):
+        self.times.append(t)
+        self.labels.append(label)
+        self.hold_until = t + hold if hold > 0 else None
+
+    # move the most recent unresolved transition to host time t, used once the cue is known to have been displayed
+    def adjustLast(self, t):
+        if len(self.times) > self.resolved:
+            self.times[-1] = t
+            self.hold_until = None
+
+    # label a packet, or consecutive packets, of n samples starting at sample index first, the last received at host time recv_time
+    # Transitions made before the packet was received are converted to sample indices (fixed from then on) and returned as (time, label, index), so the label stream can be saved with them
+    def labelPacket(self, first, n, recv_time):
+        new = []
+        while self.resolved < len(self.times) and self.times[self.resolved] <= recv_time:
+            if self.resolved == len(self.times) - 1 and self.hold_until is not None and recv_time < self.hold_until:
+                break
+            index = max(int(np.ceil(self.clock.sampleAt(self.times[self.resolved]))), first) # first sample taken at or after the transition, which was not made before the samples already labelled were received
+            if len(self.indices) > 0:
+                index = max(index, self.indices[-1]) # the model can shift slightly between packets, keep transitions in order
+            self.indices.append(index)
+            new.append((self.times[self.resolved], self.labels[self.resolved], index))
+            self.resolved += 1
+        indices = np.arange(first, first + n)
+        pos = np.searchsorted(self.indices, indices, side='right') - 1 # last transition at or before each sample
+        labels = np.zeros(n, dtype=np.int64)
+        has_label = pos >= 0
+        labels[has_label] = np.asarray(self.labels[:self.resolved], dtype=np.int64)[pos[has_label]]
+        return labels, new
@@ -1,28 +1,35 @@
-# Window to host all Widgets for the GUI
+# Window to host all Widgets for the GUI, a client of the acquisition engine (see Engine.py) which runs the device, the trials and the recording
 # Controls routing of all signals withing the program
 # Ensures the program has warnings to prevent accidental early closure before experiment is complete, or all data is not saved
+# The EMG display, and optionally the participant window, can run in a separate process fed through shared memory (see SharedDisplay.py), so their redraws cannot delay the acquisition
 
 import logging
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
+from CalibrationWindow import CalibrationWindow
 from Controls import ControlsWidget
 from EMGDisplay import EMGDisplayWidget
+from Engine import AcquisitionEngine
 from ProgressDisplay import ProgressDisplayWidget
-from SerialCom import SerialComWidget
+from SpectrumDisplay import SpectrumDisplayWidget
 from StimulusDisplay import StimulusDisplayWidget
 from ParticipantWindow import ParticipantWindowWidget
+from SharedDisplay import DisplayServer
 from UtilDisplay import UtilDisplayWidget
 
+import time
 from time import sleep
 
 class MainWindow(QMainWindow):
 
-    packet_size = 50 # defines the size of the expeted EMG packet from the Arduino host board
-    max_packets = 200 # defines the maximum number of packets for display on the real time display
+    display_seconds = 10 # seconds of EMG shown on the real time display
     
-    def __init__(self, *args, **kwargs):
+    # stream_address, if given, publishes the decoded data to other processes, "host:port" or "local:<name>" (see Streaming.py)
+    # simulate, if given, runs from a simulated device at that speed rather than the rig (see Simulator.py)
+    # display_process, if given, runs the EMG display ("emg") or the EMG display and the participant window ("participant") in a separate process
+    def __init__(self, protocol, stream_address=None, simulate=None, display_process=None, *args, **kwargs):
     
         super(MainWindow, self).__init__(*args, **kwargs)
         
@@ -31,55 +38,96 @@ class MainWindow(QMainWindow):
         self.logger = logging.getLogger("app_logger.MainWindow")
         
         # setup all widget used in the program, assign to an array for iteration access
+        self.engine = AcquisitionEngine(protocol, stream_address, parent=self)
+        if stream_address is not None and self.engine.publisher is None:
+            QMessageBox.warning(self, "Stream not started", f"Could not publish the stream on {stream_address}, see the log")
+        
         self.logger.info("Setting up widgets.")
-        self.cw  = ControlsWidget()
-        self.edw = EMGDisplayWidget(self.packet_size, self.max_packets)
+        tic = time.perf_counter()
+        self.display = None
+        if display_process is not None:
+            self.display = DisplayServer(protocol, self.engine.sampling, self.display_seconds, display_process == "participant", parent=self)
+        self.cw  = ControlsWidget(protocol)
+        self.edw = EMGDisplayWidget(self.engine.sampling, self.display_seconds) if self.display is None else None # sized for the protocol's sampling, and again if the device connects with another
+        self.spw = SpectrumDisplayWidget(self.engine.sampling.sample_rate)
         self.pdw = ProgressDisplayWidget()
-        self.scw = SerialComWidget(self.packet_size)
-        self.sdw = StimulusDisplayWidget()
+        self.sdw = StimulusDisplayWidget(protocol)
         self.udw = UtilDisplayWidget()
-        self.pww = ParticipantWindowWidget()
+        self.pww = ParticipantWindowWidget(protocol) if display_process != "participant" else None
+        self.logger.info(f"Widgets constructed in {(time.perf_counter() - tic)*1000:.1f} ms")
         
-        self.widgets_l = [self.cw, self.edw, self.pdw, self.scw, self.sdw, self.udw, self.pww]
+        self.widgets_l = [w for w in [self.cw, self.edw, self.spw, self.pdw, self.sdw, self.udw, self.pww] if w is not None]
         
-        # setup all signals between the widgets. These primarily are sourced from the control widget to indicate updates during the trial, or from the Serial Com widget sending data or command responses. More detail on signals provided in signal source widgets.
+        # setup all signals between the engine and the widgets. These primarily are sourced from the engine to indicate updates during the trial or data from the device, and from the control widget to run the session. More detail on signals provided in signal source classes.
         self.logger.info("Setting up signals.")
+        # engine trial signals, to the participant window here or in the display process
+        participant_stim = self.pww.sdw if self.pww is not None else self.display
+        participant_progress = self.pww.pdw if self.pww is not None else self.display
+        self.engine.sig_resetStim.connect(self.sdw.resetStim) 
+        self.engine.sig_resetStim.connect(participant_stim.resetStim)
+        self.engine.sig_progressUpdate.connect(self.pdw.progressUpdate)
+        self.engine.sig_progressUpdate.connect(participant_progress.progressUpdate)
+        self.engine.sig_setStimOff.connect(self.sdw.setStimOff)
+        self.engine.sig_setStimOff.connect(participant_stim.setStimOff)
+        self.engine.sig_setStimOn.connect(self.sdw.setStimOn)
+        self.engine.sig_setStimOn.connect(participant_stim.setStimOn)
+        self.engine.sig_setStimVal.connect(self.sdw.setStimVal)
+        self.engine.sig_setStimVal.connect(participant_stim.setStimVal)
+        self.engine.sig_alert.connect(self.cw.playAlert)
+        self.engine.sig_sessionOpened.connect(self.cw.sessionOpened)
+        self.engine.sig_taskStarted.connect(self.cw.taskStarted)
+        self.engine.sig_taskEnded.connect(self.cw.taskEnded)
+        
+        # engine device signals. The display process draws at its own frame rate, it is only given the samples
+        if self.edw is not None:
+            self.engine.sig_emgDataReady.connect(self.edw.insertNewData)
+            self.engine.sig_displayFrame.connect(self.edw.displayUpdate)
+            self.engine.sig_samplingChanged.connect(self.edw.setSampling)
+            self.engine.sig_sensorsReady.connect(self.edw.sensorsReady)
+            self.engine.sig_taskStarted.connect(self.edw.taskStarted)
+        else:
+            self.engine.sig_emgDataReady.connect(self.display.insertNewData)
+            self.engine.sig_samplingChanged.connect(self.display.setSampling)
+            self.engine.sig_taskStarted.connect(self.display.taskStarted)
+        self.engine.sig_emgDataReady.connect(self.spw.insertNewData)
+        self.engine.sig_displayFrame.connect(self.spw.displayUpdate)
+        self.engine.sig_pipelineLoad.connect(self.udw.setPipelineLoad)
+        self.engine.sig_qualityUpdate.connect(self.udw.setQuality)
+        self.engine.sig_impTempReady.connect(self.udw.setImpTempData)
+        self.engine.sig_sweepReady.connect(self.udw.setSweep)
+        self.engine.sig_calibrationChanged.connect(self.udw.setCalibration)
+        self.engine.sig_samplingChanged.connect(self.spw.setSampling)
+        self.engine.sig_deviceNotification.connect(self.udw.setDeviceNotification)
+        self.engine.sig_portNotification.connect(self.udw.setComNotification)
+        self.engine.sig_serialError.connect(self.udw.serialError)
+        self.engine.sig_sensorsReady.connect(self.cw.sensorsReady)
+        
         # control widget signals
-        self.cw.sig_resetStim.connect(self.sdw.resetStim) 
-        self.cw.sig_resetStim.connect(self.pww.sdw.resetStim)
-        self.cw.sig_progressUpdate.connect(self.pdw.progressUpdate)
-        self.cw.sig_progressUpdate.connect(self.pww.pdw.progressUpdate)
-        self.cw.sig_sendCommand.connect(self.scw.sendCommand)
-        self.cw.sig_setStimOff.connect(self.sdw.setStimOff)
-        self.cw.sig_setStimOff.connect(self.pww.sdw.setStimOff)
-        self.cw.sig_setStimOn.connect(self.sdw.setStimOn)
-        self.cw.sig_setStimOn.connect(self.pww.sdw.setStimOn)
-        self.cw.sig_setStimVal.connect(self.sdw.setStimVal)
-        self.cw.sig_setStimVal.connect(self.pww.sdw.setStimVal)
-        self.cw.sig_toggleParticipantVisibility.connect(self.edw.setVisible)
-        
-        # serial com widget signals
-        self.scw.sig_emgDataReady.connect(self.cw.newEMGData)
-        self.scw.sig_emgDataReady.connect(self.edw.insertNewData)
-        self.scw.sig_impTempReady.connect(self.udw.setImpTempData)
-        self.scw.sig_deviceNotification.connect(self.udw.setDeviceNotification)
-        self.scw.sig_portNotification.connect(self.udw.setComNotification)
-        self.scw.sig_serialError.connect(self.udw.serialError)
-        
-        # utility display widget signals. In these cases data from the serial port is processed as part of the utility display before it is sent on for saving or alternate display
-        self.udw.sig_sensorsReady.connect(self.cw.sensorsReady)
-        self.udw.sig_sensorsReady.connect(self.edw.sensorsReady)
-        self.udw.sig_sendCommand.connect(self.scw.sendCommand)
-        self.udw.sig_impTempReady.connect(self.cw.newImpAndTempData)
+        self.cw.sig_openParticipant.connect(self.engine.openParticipant)
+        self.cw.sig_startNextTask.connect(self.engine.startNextTask)
+        self.cw.sig_setImpPolling.connect(self.engine.setImpPolling)
+        self.cw.sig_toggleDebugging.connect(self.engine.toggleDebugging)
+        self.cw.sig_toggleParticipantVisibility.connect(self.edw.setVisible if self.edw is not None else self.display.setEmgVisible)
+        self.cw.sig_toggleSpectrumVisibility.connect(self.spw.setVisible)
+        self.cw.sig_calibrate.connect(self.openCalibration)
+        
+        # stimulus display signals. Cue latency is measured on the participant's display as that is the one they respond to. In the display process its paints are reported after
+        # the packets that follow them may have arrived, so the engine holds each cue's transition until the paint is reported
+        participant_stim.sig_stimDisplayed.connect(self.engine.stimDisplayed)
+        if self.pww is None:
+            self.engine.cue_display_wait = DisplayServer.cue_wait
         
         
         # simple layout management to assemble the final screen as observed
         self.logger.info("Setting up layout.")
         layout_t = QHBoxLayout()
         layout_t.addWidget(self.sdw)
-        layout_t.addWidget(self.edw)
+        if self.edw is not None:
+            layout_t.addWidget(self.edw)
+        layout_t.addWidget(self.spw)
+        self.spw.setVisible(False) # shown from the controls
         widget_t = QWidget()
-        widget_t.setLayout(layout_t) # top: put the stimulus and emg displays side by side 
+        widget_t.setLayout(layout_t) # top: put the stimulus, emg and spectrum displays side by side 
         
         layout_b = QHBoxLayout()
         layout_b.addWidget(self.udw)
@@ -101,9 +149,11 @@ class MainWindow(QMainWindow):
         # call postInit on all wdigets which allows for any setup that is reliant on knowledge of other widgets instantiated in the program
         for w in self.widgets_l:
             w.postInit()
+        self.engine.start(simulate)
         
         # maximise the participant window (reduced layout) and centre on screen
-        self.pww.showMaximized()
+        if self.pww is not None:
+            self.pww.showMaximized()
         centre = QDesktopWidget().availableGeometry().center() 
         rect = self.frameGeometry()
         rect.moveCenter(centre)
@@ -111,9 +161,14 @@ class MainWindow(QMainWindow):
         
     # pass through function for a reset state    
     def resetSoftware(self):
+        self.engine.reset()
         for w in self.widgets_l:
             w.resetSoftware()
         
+    # open the impedance calibration window, modal so no task can be started while calibrating
+    def openCalibration(self):
+        CalibrationWindow(self.engine, self).exec()
+        
     # Override close action on X press to provide a check requiring confirmation before closing the program
     def closeEvent(self, evnt):
         self.evnt = evnt
@@ -131,9 +186,12 @@ class MainWindow(QMainWindow):
     def closeCatchAction(self, button):
         if button.text() == "&Yes":
             
-            self.scw.closePort()
+            self.engine.close()
+            if self.display is not None:
+                self.display.close()
             sleep(0.1) # leave time for close down actions
-            self.pww.close()
+            if self.pww is not None:
+                self.pww.close()
             super(MainWindow, self).closeEvent(self.evnt)
         else:
             self.evnt.ignore()
@@ -0,0 +1,64 @@
+# EMG packets passed between the stages of the program (serial link, engine, displays, recorder, stream)
+# An EMGPacket is immutable: a namedtuple whose samples (and labels, once added by the engine) are read only NumPy arrays, so every slot connected to a signal sees the same data
+# and none can change it for the others. Packets are passed by reference in pyqtSignal(object) signals, PyQt does not convert or copy them.
+# A slot that needs to change the data must copy it first (e.g. samples.copy() or samples.tolist())
+#
+# The sample arrays are views of buffers drawn from a PacketPool. A buffer is reused once nothing refers to it any more, i.e. every packet (and any other view) made from it
+# has been dropped, so buffers are recycled without any stage having to give them back, and a stage may keep packets as long as it needs (e.g. the display keeps the last 200).
+# The pool fills a buffer through its own array of it, and packets see it through a read only memoryview, so neither they nor any view of them (or their base) can be made writeable.
+# Whether a buffer is free is told from its reference count, which relies on CPython freeing objects as soon as nothing refers to them
+
+import sys
+from collections import deque, namedtuple
+
+import numpy as np
+
+# seq counts packets from the device since the program started, recv_time is the perf_counter time it was read from the port,
+# samples is (channels, samples) uint16, first is the index of its first sample in the task and labels the class of each sample (both None until labelled by the engine)
+EMGPacket = namedtuple('EMGPacket', ['seq', 'recv_time', 'samples', 'first', 'labels'])
+
+# a read only array of values, for metadata added to a packet after it is made. An array of the dtype is made read only in place, so must not be changed elsewhere
+def frozen(values, dtype=None):
+    array = np.asarray(values, dtype=dtype)
+    array.flags.writeable = False
+    return array
+
+class PacketPool:
+
+    max_buffers = 1024 # buffers kept for reuse, beyond this (packets held for a long time) new buffers are left to the garbage collector
+    scan = 4 # buffers checked for reuse before a new one is made
+
+    def __init__(self, channels, samples):
+        self.shape = (channels, samples)
+        self.buffers = deque() # oldest handed out first, packets are generally released in the order they were made
+        self.seq = 0
+        self.allocated = 0 # buffers created, for checking the pool is recycling
+
+    # a buffer not referred to by any packet, or a new one if none of the oldest few are free. Buffers still in use are moved to the back so one held for a long time does not block the rest.
+    # A buffer is a pair (writer, reader): the pool's writeable (channels, samples) array and the flat read only array every packet's samples are a view of
+    def acquire(self):
+        for i in range(min(self.scan, len(self.buffers))):
+            if sys.getrefcount(self.buffers[0][1]) == 2: # only the pair and the getrefcount argument refer to the reader (CPython reference counting)
+                buffer = self.buffers.popleft()
+                self.buffers.append(buffer)
+                return buffer
+            self.buffers.rotate(-1)
+        data = bytearray(2 * self.shape[0] * self.shape[1])
+        buffer = (np.frombuffer(data, dtype=np.uint16).reshape(self.shape), np.frombuffer(memoryview(data).toreadonly(), dtype=np.uint16))
+        self.allocated += 1
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buffer)
+        return buffer
+
+    # a packet from the payload of an EMG packet as sent by the Arduino, big endian uint16 samples with the channels alternating.
+    # The buffers follow the length of the packets, which changes when the device's sampling is set (see Schema.py), so those already made for the old length are dropped
+    def fromWire(self, payload, recv_time):
+        length = len(payload) // (2 * self.shape[0])
+        if length != self.shape[1]:
+            self.shape = (self.shape[0], length)
+            self.buffers.clear()
+        writer, reader = self.acquire()
+        writer[...] = np.frombuffer(payload, dtype='>u2').reshape(-1, self.shape[0]).T
+        samples = reader.reshape(self.shape)
+        self.seq += 1
+        return EMGPacket(self.seq, recv_time, samples, None, None)
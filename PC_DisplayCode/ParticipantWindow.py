@@ -11,7 +11,7 @@ from StimulusDisplay import StimulusDisplayWidget
 
 class ParticipantWindowWidget(QWidget):
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, protocol, *args, **kwargs):
     
         super(ParticipantWindowWidget, self).__init__(*args, **kwargs)
         self.setWindowFlags(Qt.WindowTitleHint | Qt.WindowMaximizeButtonHint) # grey out the minimise and close options on the window to prevent closing or hiding this by accident during experiment
@@ -21,7 +21,7 @@ class ParticipantWindowWidget(QWidget):
         
         # instantiate a stimulus and progress display widget
         self.logger.info("Setting up widgets.")
-        self.sdw = StimulusDisplayWidget()
+        self.sdw = StimulusDisplayWidget(protocol)
         self.pdw = ProgressDisplayWidget()
         
         # Signals for the sub widgets here are still setup by the MainWindow __init__ function 
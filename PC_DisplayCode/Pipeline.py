@@ -0,0 +1,138 @@
+# Live pipeline from the device thread to the main thread, with explicit handling of overload
+# The serial (or simulated) device thread puts each raw packet on a PacketQueue rather than emitting a queued signal per packet, so a backlog is visible and bounded rather than growing in the Qt event queue.
+# The main thread is notified once while packets are waiting and drains them in batches, leaving the event loop free between batches. Each sink of the decoded data has an overload policy:
+#   SPILL    - every packet is delivered in order, nothing is ever dropped. Once memory_packets are waiting further packets are written to a spill file and read back in order (recording)
+#   SKIP     - every packet is delivered but redraws are skipped while overloaded, the display catches up in one frame (displays)
+#   THROTTLE - updates are made at an interval that lengthens while behind and recovers once caught up (feature computation)
+# Watermarks on the depth of the queue give the load, reported before any frames are skipped so the operator is warned while there is still time to act
+
+import logging
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from enum import Enum
+
+EMG_PACKET, IT_PACKET = range(2) # kinds of packet on the queue, EMG is the 100 byte payload of an EMG packet, IT the 16 bytes of an IMP packet followed by the 4 bytes of the TMP packet
+
+Overload = Enum('Overload', ['SPILL', 'SKIP', 'THROTTLE'])
+Load = Enum('Load', ['NORMAL', 'BEHIND', 'OVERLOADED', 'SPILLING']) # in increasing order, see PacketQueue watermarks
+
+SPILL_RECORD = struct.Struct("<BdI") # kind, receive time, payload length, then the payload
+
+class PacketQueue:
+
+    behind_packets = 10 # packets waiting (0.5 s at 20 packets/s) at which the pipeline is reported behind
+    overloaded_packets = 100 # packets waiting (5 s) at which the pipeline is reported overloaded, displays skip frames from here
+    memory_packets = 2000 # packets held in memory (100 s), beyond this they are spilled to disk
+
+    def __init__(self):
+        self.logger = logging.getLogger("app_logger.PacketQueue")
+        self.lock = threading.Lock()
+        self.memory = deque() # (kind, payload, recv_time) oldest first
+        self.spill = None # spill file, created when first needed. Packets in it are all newer than those in memory
+        self.spilled = 0 # packets in the spill file not yet read back
+        self.read_pos = 0
+        self.write_pos = 0
+        self.notify_pending = False # set when the consumer has been notified and has not yet emptied the queue
+        self.total_spilled = 0
+        self.max_depth = 0
+
+    # add a packet, called from the device thread. Returns True if the consumer needs notifying, i.e. it is not already due to drain the queue
+    def put(self, kind, payload, recv_time):
+        return self.putMany(kind, [payload], [recv_time])
+
+    # add packets of one kind received one after another, as put
+    def putMany(self, kind, payloads, recv_times):
+        with self.lock:
+            for payload, recv_time in zip(payloads, recv_times):
+                if self.spilled > 0 or len(self.memory) >= self.memory_packets:
+                    self.spillPacket(kind, payload, recv_time)
+                else:
+                    self.memory.append((kind, bytes(payload), recv_time))
+            self.max_depth = max(self.max_depth, len(self.memory) + self.spilled)
+            notify = not self.notify_pending
+            self.notify_pending = True
+            return notify
+
+    def spillPacket(self, kind, payload, recv_time):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix="mmd_spill_")
+            self.logger.warning(f"{len(self.memory)} packets waiting, spilling to disk")
+        self.spill.seek(self.write_pos)
+        self.spill.write(SPILL_RECORD.pack(kind, recv_time, len(payload)) + bytes(payload))
+        self.write_pos = self.spill.tell()
+        self.spilled += 1
+        self.total_spilled += 1
+
+    # take up to n packets, oldest first, called from the main thread. Spilled packets are read back as memory frees
+    def take(self, n):
+        with self.lock:
+            if len(self.memory) < n and self.spilled > 0:
+                self.readBack(self.memory_packets - len(self.memory))
+            items = [self.memory.popleft() for i in range(min(n, len(self.memory)))]
+            if len(self.memory) == 0 and self.spilled == 0:
+                self.notify_pending = False # the next put notifies again
+            return items
+
+    def readBack(self, n):
+        self.spill.seek(self.read_pos)
+        for i in range(min(n, self.spilled)):
+            kind, recv_time, length = SPILL_RECORD.unpack(self.spill.read(SPILL_RECORD.size))
+            self.memory.append((kind, self.spill.read(length), recv_time))
+            self.spilled -= 1
+        self.read_pos = self.spill.tell()
+        if self.spilled == 0: # all read back, start the file again
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.read_pos = self.write_pos = 0
+            self.logger.info(f"Spilled packets read back, {self.total_spilled} spilled in total")
+
+    def depth(self):
+        with self.lock:
+            return len(self.memory) + self.spilled
+
+    # load from the number of packets waiting
+    def load(self):
+        with self.lock:
+            depth = len(self.memory) + self.spilled
+            if self.spilled > 0:
+                return Load.SPILLING
+        if depth >= self.overloaded_packets:
+            return Load.OVERLOADED
+        if depth >= self.behind_packets:
+            return Load.BEHIND
+        return Load.NORMAL
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+# Rate limit for SKIP and THROTTLE sinks. The interval between updates is min_interval below from_load, then doubles (from at least 0.1 s) for each level of load from there up to max_interval
+class Throttle:
+
+    def __init__(self, min_interval, max_interval, from_load=Load.BEHIND):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.from_load = from_load
+        self.interval = min_interval
+        self.last = 0
+        self.skipped = 0 # updates skipped since the last one made
+
+    def setLoad(self, load):
+        if load.value < self.from_load.value:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, max(self.min_interval, 0.05) * 2**(load.value - self.from_load.value + 1))
+
+    # whether an update is due now, counting it as skipped if not
+    def ready(self, now=None):
+        now = time.perf_counter() if now is None else now
+        if now - self.last >= self.interval:
+            self.last = now
+            self.skipped = 0
+            return True
+        self.skipped += 1
+        return False
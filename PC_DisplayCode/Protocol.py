@@ -0,0 +1,143 @@
+# Loader for experiment protocol files, defining the tasks run by the controls so a new study does not need code edits
+# A protocol is a JSON file (see Protocols/sEMG-MMD.json) containing:
+#   name        - protocol name, written to the log
+#   rest_image  - asset shown between tasks and after the final activation of a task
+#   grips       - list of {"name", "image_off", "image_on"}. The class label recorded for a grip is its position in this list (from 1)
+#   defaults    - task settings used where a task does not give its own
+#   tasks       - list of tasks in the order they are run, each {"name"} plus any settings overriding the defaults
+#   sample_rate - EMG sample rate in Hz the device is set to when it connects, up to 1000 with a whole number of microseconds per sample (default 500)
+#   packet_samples - samples of each channel in an EMG packet from the device, 5 to 100 (default 25)
+# Task settings:
+#   file              - results file name (default: name with "." replaced by "_")
+#   grips             - names of the grips performed, in order (default: all grips)
+#   repetitions       - repetitions of each grip
+#   time_off_ms       - rest before each activation, includes time for the IT read
+#   time_on_ms        - activation time
+#   reaction_delay_ms - delay after an activation before the IT read, to allow for participant adjustment
+#   it_read           - when to read IT: "activation" (after every activation), "grip" (after the last repetition of each grip) or "none"
+#   ad_range          - AD5933 output range option (1-4) set at the task start, or null to leave unchanged
+#   ad_pga            - AD5933 gain (1 or 5) set at the task start, or null to leave unchanged
+#   it_sweep          - true to make an impedance sweep across frequencies at each IT read rather than a single reading (see ImpedanceSweep.py), default false
+# The file is validated once on load and each task compiled into the schedule the controls run
+
+import json
+import logging
+import os
+from collections import namedtuple
+
+from AssetCache import assetPath
+from Commands import cmds
+from Scheduler import buildSchedule
+from Schema import DEFAULT_SAMPLING, MAX_SAMPLE_RATE, PACKET_SAMPLES, Sampling, validSampling
+
+DEFAULT_PROTOCOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Protocols", "sEMG-MMD.json")
+
+IT_READ_MODES = ["activation", "grip", "none"]
+AD_RANGES = [1, 2, 3, 4]
+AD_PGAS = [1, 5]
+
+TASK_SETTINGS = ["file", "grips", "repetitions", "time_off_ms", "time_on_ms", "reaction_delay_ms", "it_read", "ad_range", "ad_pga", "it_sweep"]
+
+Grip = namedtuple('Grip', ['name', 'image_off', 'image_on'])
+Task = namedtuple('Task', ['name', 'file', 'stims', 'repetitions', 'time_off', 'time_on', 'reaction_delay', 'it_read', 'it_sweep', 'commands', 'schedule'])
+
+# raised when a protocol file cannot be read or is not valid, the message describes the problem
+class ProtocolError(Exception):
+    pass
+
+class Protocol:
+
+    def __init__(self, name, rest_image, grips, tasks, sampling=DEFAULT_SAMPLING, path=None):
+        self.name = name
+        self.rest_image = rest_image
+        self.grips = grips
+        self.tasks = tasks
+        self.sampling = sampling # EMG Sampling asked of the device (see Schema.py)
+        self.path = path # file the protocol was loaded from, for other processes to load it (see SharedDisplay.py)
+
+# read, validate and compile a protocol file
+def loadProtocol(path=DEFAULT_PROTOCOL):
+    logger = logging.getLogger("app_logger.Protocol")
+    try:
+        with open(path) as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ProtocolError(f"Could not read protocol {path}: {e}")
+
+    check(isinstance(raw, dict), "protocol must be a JSON object")
+    for key in ["name", "rest_image", "grips", "tasks"]:
+        check(key in raw, f"protocol is missing \"{key}\"")
+
+    check(isinstance(raw["grips"], list) and len(raw["grips"]) > 0, "\"grips\" must be a non-empty list")
+    grips = []
+    for i, g in enumerate(raw["grips"]):
+        check(isinstance(g, dict) and all(isinstance(g.get(k), str) for k in Grip._fields), f"grip {i+1} must have string \"name\", \"image_off\" and \"image_on\"")
+        grips.append(Grip(g["name"], g["image_off"], g["image_on"]))
+    grip_names = [g.name for g in grips]
+    check(len(set(grip_names)) == len(grip_names), "grip names must be unique")
+
+    # missing images are only warned about, the display shows nothing for them but the data is still valid
+    for image in [raw["rest_image"]] + [g.image_off for g in grips] + [g.image_on for g in grips]:
+        if not os.path.exists(assetPath(image)):
+            logger.warning(f"Protocol image {image} not found in assets")
+
+    defaults = raw.get("defaults", {})
+    check(isinstance(defaults, dict), "\"defaults\" must be an object")
+    check(isinstance(raw["tasks"], list) and len(raw["tasks"]) > 0, "\"tasks\" must be a non-empty list")
+    tasks = []
+    for t in raw["tasks"]:
+        check(isinstance(t, dict) and isinstance(t.get("name"), str), "each task must be an object with a string \"name\"")
+        unknown = set(t) - set(TASK_SETTINGS) - {"name"}
+        check(len(unknown) == 0, f"task {t['name']} has unknown settings {sorted(unknown)}")
+        settings = dict(defaults)
+        settings.update(t)
+        tasks.append(compileTask(settings, grip_names))
+
+    sampling = Sampling(raw.get("sample_rate", DEFAULT_SAMPLING.sample_rate), DEFAULT_SAMPLING.channels, raw.get("packet_samples", DEFAULT_SAMPLING.samples))
+    check(validSampling(sampling.sample_rate, sampling.samples), f"\"sample_rate\" must be an integer up to {MAX_SAMPLE_RATE} Hz dividing 1000000, and \"packet_samples\" an integer from {PACKET_SAMPLES[0]} to {PACKET_SAMPLES[1]}")
+
+    names = [t.name for t in tasks]
+    files = [t.file for t in tasks]
+    check(len(set(names)) == len(names), "task names must be unique")
+    check(len(set(files)) == len(files), "task file names must be unique")
+
+    protocol = Protocol(raw["name"], raw["rest_image"], grips, tasks, sampling, path)
+    logger.info(f"Loaded protocol {protocol.name} from {path}: {len(grips)} grips, {len(tasks)} tasks, EMG at {sampling.sample_rate} Hz")
+    return protocol
+
+# validate the settings of one task and compile its schedule and set up commands
+def compileTask(settings, grip_names):
+    name = settings["name"]
+    for key in ["repetitions", "time_off_ms", "time_on_ms", "reaction_delay_ms"]:
+        check(isinstance(settings.get(key), int) and not isinstance(settings[key], bool) and settings[key] > 0, f"task {name}: \"{key}\" must be a positive integer")
+    check(settings["reaction_delay_ms"] < settings["time_off_ms"], f"task {name}: \"reaction_delay_ms\" must be shorter than \"time_off_ms\"")
+    it_read = settings.get("it_read", "activation")
+    check(it_read in IT_READ_MODES, f"task {name}: \"it_read\" must be one of {IT_READ_MODES}")
+    it_sweep = settings.get("it_sweep", False)
+    check(isinstance(it_sweep, bool), f"task {name}: \"it_sweep\" must be true or false")
+
+    task_grips = settings.get("grips", grip_names)
+    check(isinstance(task_grips, list) and len(task_grips) > 0, f"task {name}: \"grips\" must be a non-empty list")
+    for g in task_grips:
+        check(g in grip_names, f"task {name}: unknown grip \"{g}\"")
+    stims = [grip_names.index(g) + 1 for g in task_grips]
+
+    commands = []
+    ad_range = settings.get("ad_range")
+    if ad_range is not None:
+        check(ad_range in AD_RANGES, f"task {name}: \"ad_range\" must be one of {AD_RANGES} or null")
+        commands.append(cmds[f"SET_AD_RANGE_{ad_range}"])
+    ad_pga = settings.get("ad_pga")
+    if ad_pga is not None:
+        check(ad_pga in AD_PGAS, f"task {name}: \"ad_pga\" must be one of {AD_PGAS} or null")
+        commands.append(cmds[f"SET_AD_PGA_{ad_pga}"])
+
+    file = settings.get("file", name.replace(".", "_"))
+    check(isinstance(file, str) and len(file) > 0 and not any(c in file for c in '\\/:*?"<>|'), f"task {name}: \"file\" must be a valid file name")
+
+    schedule = buildSchedule(stims, settings["repetitions"], settings["time_off_ms"], settings["time_on_ms"], settings["reaction_delay_ms"], it_read)
+    return Task(name, file, stims, settings["repetitions"], settings["time_off_ms"], settings["time_on_ms"], settings["reaction_delay_ms"], it_read, it_sweep, commands, schedule)
+
+def check(condition, message):
+    if not condition:
+        raise ProtocolError(message)
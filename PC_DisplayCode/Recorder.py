@@ -0,0 +1,195 @@
+# Recorder for the files of one task within a participant results folder
+# <task>.csv holds the EMG samples with their labels and any IT readings, <task>_labels.csv the label stream of stimulus transitions with the sample they apply from, <task>_cues.csv the measured cue latencies,
+# <task>_quality.csv the signal quality flags of each sensor whenever they change (see SignalQuality.py), <task>_sweep.csv the readings of any impedance sweeps and <task>_sweep_fit.csv the model fitted
+# to each electrode (see ImpedanceSweep.py)
+# Files are opened with "a" to ensure we are appending not overwritting data, and kept open for the task. How often they are pushed to disk is set by the durability (see Journal.py),
+# with the session journal recording a checkpoint of the task state and file size each time they are synced
+# If compressed, the EMG is saved to <task>.emgz (see Compression.py) instead of the csv. Its chunks are written when full and at each checkpoint, so with any durability a crash can lose the data since the last checkpoint
+# The recorder keeps an index of what it wrote, the packets with their byte offsets, the transitions, IT readings and quality changes, which the catalog takes when the task ends (see Catalog.py)
+
+import csv
+import functools
+import io
+import os
+import time
+import numpy as np
+from PyQt5.QtCore import QDateTime
+
+from Catalog import TaskIndex
+from Clock import REAL_CLOCK
+from Compression import EmgzWriter
+from Journal import Durability
+from Schema import itValues
+
+TIMESTAMP_FORMAT = "yyyy-MM-dd hh-mm-ss-zzz"
+
+# reference point to convert perf_counter times (used for all timing in the program) to wall clock time for the files
+_epoch_ms = QDateTime.currentMSecsSinceEpoch()
+_epoch_perf = time.perf_counter()
+
+# wall clock time in s since the epoch for a perf_counter time
+def wallTime(perf_time):
+    return _epoch_ms/1000 + (perf_time - _epoch_perf)
+
+# wall clock time in ms since the epoch for a perf_counter time
+def wallTimeMs(perf_time):
+    return int(round(_epoch_ms + (perf_time - _epoch_perf)*1000))
+
+# wall clock time stamp string for a perf_counter time
+def wallTimeString(perf_time):
+    second, ms = divmod(wallTimeMs(perf_time), 1000)
+    return _secondString(second) + "%03d" % ms
+
+# time stamp strings of a list of perf_counter times
+def wallTimeStrings(perf_times):
+    second, ms = np.divmod(np.round(_epoch_ms + (np.asarray(perf_times) - _epoch_perf)*1000).astype(np.int64), 1000)
+    return [_secondString(s) + "%03d" % m for s, m in zip(second.tolist(), ms.tolist())]
+
+# time stamp of a whole second up to the milliseconds, shared by the packets received within it
+@functools.lru_cache(maxsize=16)
+def _secondString(second):
+    return QDateTime.fromMSecsSinceEpoch(second * 1000).toString(TIMESTAMP_FORMAT[:-3])
+
+# csv cells ",<value>" of every uint16 sample value, made on first use, so rows are put together by indexing rather than formatting each sample
+@functools.lru_cache(maxsize=1)
+def _sampleCells():
+    return np.array([f",{v}" for v in range(65536)], dtype=object)
+
+class TaskRecorder:
+
+    # journal may be None, e.g. for debugging saves, in which case no checkpoints are recorded. Checkpoints are timed by clock (see Clock.py)
+    def __init__(self, results_path, task_name, journal=None, durability=Durability.FLUSH, checkpoint_interval=1.0, compressed=False, sample_rate=500, clock=REAL_CLOCK):
+        self.results_path = results_path
+        self.task_name = task_name
+        self.journal = journal
+        self.durability = durability
+        self.checkpoint_interval = checkpoint_interval # seconds between checkpoints
+        self.files = {} # open file and csv writer by file suffix
+        self.emgz = EmgzWriter(self.path(extension=".emgz"), 2, sample_rate) if compressed else None
+        self.clock = clock
+        self.last_checkpoint = clock.now()
+        self.sweeps = 0 # impedance sweeps saved
+        self.samples = 0 # samples written, the index of the next sample
+        self.packet_index, self.packet_time, self.packet_offset = [], [], []
+        self.transition_index, self.transition_label = [], []
+        self.it_index, self.it_values = [], []
+        self.quality = [] # (index, channel, flags) of each quality change
+
+    def path(self, suffix="", extension=".csv"):
+        return self.results_path + "/" + self.task_name + suffix + extension
+
+    def openFile(self, suffix):
+        if suffix not in self.files:
+            f = open(self.path(suffix), 'a', newline='')
+            self.files[suffix] = (f, csv.writer(f))
+        return self.files[suffix]
+
+    def appendRows(self, suffix, rows):
+        f, writer = self.openFile(suffix)
+        writer.writerows(rows)
+        if self.durability != Durability.BUFFERED:
+            f.flush()
+
+    # rows already formatted as csv text, which must be ASCII so its length is its size in the file
+    def appendText(self, suffix, text):
+        f, writer = self.openFile(suffix)
+        f.write(text)
+        if self.durability != Durability.BUFFERED:
+            f.flush()
+
+    # consecutive packets of EMG data read at perf_counter times recv_times, lengths samples each, with the class of each sample and any IT values to save with the first packet.
+    # csv rows are [time stamp, sensor 1, sensor 2, class, IT values...], put together from the text of each cell rather than through a csv writer, as that is most of the time taken to record.
+    # The time stamp is on the first row of each packet and the IT values on the first row, with the cells below them in that packet left empty
+    def writePackets(self, recv_times, lengths, channels, labels, it_values):
+        firsts = self.samples + np.cumsum([0] + lengths[:-1])
+        starts = (firsts - self.samples).tolist() # row of each packet within these
+        if len(it_values) > 0:
+            self.it_index.append(self.samples)
+            self.it_values.append(it_values)
+        self.packet_index += firsts.tolist()
+        self.packet_time += [wallTime(t) for t in recv_times]
+        self.samples += len(labels)
+        if self.emgz is not None:
+            for i, (t, start, l) in enumerate(zip(recv_times, starts, lengths)):
+                self.packet_offset.append(self.tell())
+                self.emgz.append(channels[:, start:start+l], labels[start:start+l], wallTimeMs(t), it_values if i == 0 else [])
+            return
+        classes, inverse = np.unique(labels, return_inverse=True)
+        cells = _sampleCells()
+        lines = cells[channels[0]] + cells[channels[1]] + np.array([f",{c}\r\n" for c in classes.tolist()], dtype=object)[inverse]
+        for start, stamp in zip(starts, wallTimeStrings(recv_times)):
+            lines[start] = stamp + lines[start]
+        if len(it_values) > 0:
+            text = io.StringIO()
+            csv.writer(text).writerow(lines[0][:-2].split(",") + list(it_values))
+            lines[0] = text.getvalue()
+            lines[1:lengths[0]] = [line[:-2] + "," * len(it_values) + "\r\n" for line in lines[1:lengths[0]]]
+        # each packet is written at the size of the file so far plus the length of the packets before it
+        packets = ["".join(lines[start:end].tolist()) for start, end in zip(starts, starts[1:] + [len(lines)])]
+        offset = self.tell()
+        self.packet_offset += (offset + np.cumsum([0] + [len(text) for text in packets[:-1]])).tolist()
+        self.appendText("", "".join(packets))
+
+    # a stimulus transition at perf_counter time t, with the index of the first sample (row of the task file) it applies to
+    def writeTransition(self, t, label, index):
+        self.transition_index.append(index)
+        self.transition_label.append(label)
+        self.appendRows("_labels", [[wallTimeString(t), label, index]])
+
+    # signal quality flags and score of a channel from the packet received at perf_counter time t, index is the first sample of that packet
+    def writeQuality(self, t, channel, flags, score, index):
+        self.quality.append((index, channel, int(flags)))
+        self.appendRows("_quality", [[wallTimeString(t), channel, int(flags), f"{score:.0f}", index]])
+
+    # an impedance sweep, a SweepResult. Sweep rows are [time stamp, sweep number, frequency in Hz, IT values...] for each frequency,
+    # fit rows [time stamp, sweep number, electrode (0-3), model, parameters..., rms relative error] for each electrode
+    def writeSweep(self, result):
+        self.sweeps += 1
+        stamp = wallTimeString(result.time)
+        self.appendRows("_sweep", [[stamp, self.sweeps, f] + itValues(r) for f, r in zip(result.frequencies, result.readings)])
+        self.appendRows("_sweep_fit", [[stamp, self.sweeps, e, result.fit.model] + [f"{v:.6g}" for v in p] + [f"{rms:.4f}"] for e, (p, rms) in enumerate(zip(result.fit.parameters, result.fit.rms))])
+
+    # timer and display latency in ms of a cue shown to the participant
+    def writeCue(self, stim, state, timer_latency, display_latency):
+        self.appendRows("_cues", [[QDateTime.currentDateTime().toString(TIMESTAMP_FORMAT), stim, state, f"{timer_latency:.3f}", f"{display_latency:.3f}"]])
+
+    def checkpointDue(self):
+        return self.clock.now() - self.last_checkpoint >= self.checkpoint_interval
+
+    # push the files to disk as far as the durability requires, then journal the task state and the size of the task file at this point
+    def checkpoint(self, index, stim, state, repetition, samples):
+        self.last_checkpoint = self.clock.now()
+        self.sync()
+        if self.journal is not None:
+            self.journal.checkpoint(index, self.task_name, stim, state, repetition, samples, self.tell())
+
+    # size of the task file so far, the offset the next packet is written at. A compressed packet is at the offset of the chunk it is buffered for, which is written there when full
+    def tell(self):
+        if self.emgz is not None:
+            return self.emgz.tell()
+        if "" in self.files:
+            return self.files[""][0].tell()
+        return os.path.getsize(self.path()) if os.path.exists(self.path()) else 0
+
+    # what was written of the task, a TaskIndex
+    def index(self):
+        return TaskIndex(self.samples, self.packet_index, self.packet_time, self.packet_offset, self.transition_index, self.transition_label, self.it_index, self.it_values, self.quality)
+
+    def sync(self):
+        files = [f for f, writer in self.files.values()]
+        if self.emgz is not None:
+            self.emgz.flush() # ends the current chunk
+            files.append(self.emgz.f)
+        for f in files:
+            f.flush()
+            if self.durability == Durability.FSYNC:
+                os.fsync(f.fileno())
+
+    def close(self):
+        self.sync()
+        for f, writer in self.files.values():
+            f.close()
+        self.files = {}
+        if self.emgz is not None:
+            self.emgz.close() # logs the compression achieved
+            self.emgz = None
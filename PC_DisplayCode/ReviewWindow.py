@@ -0,0 +1,238 @@
+# Window for reviewing a recorded participant session, no device needs to be attached
+# Opens a participant results folder through SessionStore and shows it with the same EMG and stimulus displays used during the experiment
+# The EMG is drawn from the min/max pyramids, so any time range, from the whole session down to single samples, is drawn from about max_points bins
+# Label transitions and IT readings are marked on the plots, the stimulus display shows the cue the participant saw at the playhead, and the session can be played back at an adjustable speed
+
+import logging
+from datetime import datetime
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+
+import numpy as np
+
+from EMGDisplay import EMGDisplayWidget
+from Journal import taskSampleRates
+from SessionStore import SessionStore
+from StimulusDisplay import StimulusDisplayWidget
+
+class ReviewWindow(QMainWindow):
+
+    max_points = 2000 # bins drawn across the width of the graphs
+    max_markers = 200 # markers are not drawn when more than this many are in view, they would cover the EMG
+    frame_interval = 40 # ms between playback updates
+    speeds = [0.25, 0.5, 1, 2, 4, 8, 16, 64] # playback speeds, times real time
+    spans = [("Whole session", "session"), ("Whole task", "task"), ("10 min", 600), ("1 min", 60), ("10 s", 10), ("1 s", 1), ("0.1 s", 0.1)] # time range choices in seconds, the graphs can also be zoomed with the mouse
+
+    store = None # the open session
+    playhead = 0 # playhead time in seconds from the session start
+    span = 10 # seconds shown, kept when following the playhead
+    cue = None # (stim, on) currently shown on the stimulus display
+
+    # each task is reviewed at the sample rate it was recorded at, from the session journal
+    def __init__(self, protocol, *args, **kwargs):
+
+        super(ReviewWindow, self).__init__(*args, **kwargs)
+
+        self.setWindowTitle("MMD Session Review")
+
+        self.logger = logging.getLogger("app_logger.ReviewWindow")
+
+        self.protocol = protocol
+
+        self.logger.info("Setting up widgets.")
+        self.edw = EMGDisplayWidget(protocol.sampling, self.span)
+        self.edw.setReviewMode()
+        self.sdw = StimulusDisplayWidget(protocol)
+        self.pbo = QPushButton("Open Participant") # opens a participant results folder
+        self.cbt = QComboBox() # jumps to the start of a task
+        self.cbz = QComboBox() # time range shown
+        self.cbs = QComboBox() # playback speed
+        self.pbp = QPushButton("Play") # toggles playback
+        self.pbp.setCheckable(True)
+        self.ss = QSlider(Qt.Horizontal) # scrubs the playhead through the session, in samples
+        self.li = QLabel("No session open") # details at the playhead
+        for name, span in self.spans:
+            self.cbz.addItem(name)
+        for speed in self.speeds:
+            self.cbs.addItem(f"x{speed:g}")
+        self.cbs.setCurrentIndex(self.speeds.index(1))
+        self.setControlsEnabled(False)
+
+        # playback timer, advances the playhead by the speed times the interval each tick
+        self.play_timer = QTimer()
+        self.play_timer.setInterval(self.frame_interval)
+
+        self.logger.info("Setting up signals.")
+        self.pbo.clicked.connect(self.openSession)
+        self.cbt.activated.connect(self.taskSelected)
+        self.cbz.activated.connect(self.spanSelected)
+        self.pbp.toggled.connect(self.playToggled)
+        self.ss.valueChanged.connect(self.sliderMoved)
+        self.play_timer.timeout.connect(self.playStep)
+        self.edw.sig_timeRangeChanged.connect(self.timeRangeChanged)
+
+        self.logger.info("Setting up layout.")
+        layout_t = QHBoxLayout()
+        layout_t.addWidget(self.sdw)
+        layout_t.addWidget(self.edw)
+        widget_t = QWidget()
+        widget_t.setLayout(layout_t) # top: stimulus and emg displays side by side as in the main window
+
+        layout_b = QHBoxLayout()
+        layout_b.addWidget(self.pbo)
+        layout_b.addWidget(QLabel("Task:"))
+        layout_b.addWidget(self.cbt)
+        layout_b.addWidget(QLabel("Show:"))
+        layout_b.addWidget(self.cbz)
+        layout_b.addWidget(QLabel("Speed:"))
+        layout_b.addWidget(self.cbs)
+        layout_b.addWidget(self.pbp)
+        widget_b = QWidget()
+        widget_b.setLayout(layout_b)
+
+        layout = QVBoxLayout()
+        layout.addWidget(widget_t)
+        layout.addWidget(self.ss)
+        layout.addWidget(self.li)
+        layout.addWidget(widget_b)
+        widget = QWidget()
+        widget.setLayout(layout)
+
+        self.logger.info("Finalising.")
+        self.setCentralWidget(widget)
+
+    def setControlsEnabled(self, enabled):
+        for w in [self.cbt, self.cbz, self.cbs, self.pbp, self.ss]:
+            w.setEnabled(enabled)
+
+    # open a participant folder, asking for it if no path is given. Review files are built on the first open of a folder, which takes a few seconds for a full session
+    def openSession(self, path=None):
+        if not path:
+            path = QFileDialog.getExistingDirectory(self, "Open Participant", "Results")
+            if not path:
+                return
+        self.pbp.setChecked(False)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            store = SessionStore(path, taskSampleRates(path))
+        finally:
+            QApplication.restoreOverrideCursor()
+        if len(store) == 0:
+            QMessageBox.warning(self, "Empty session", f"No recorded tasks found in {path}")
+            return
+        self.store = store
+        self.setWindowTitle(f"MMD Session Review - {QDir(path).dirName()}")
+        self.cbt.clear()
+        for task in store.tasks:
+            self.cbt.addItem(task.name)
+        self.ss.blockSignals(True) # the playhead is set below
+        self.ss.setRange(0, len(store) - 1)
+        self.ss.blockSignals(False)
+        self.setControlsEnabled(True)
+        self.taskSelected(0)
+
+    # move to the start of a task and show it in full
+    def taskSelected(self, i):
+        start, end = self.store.times[i], self.store.times[i+1]
+        self.cbz.setCurrentIndex(1)
+        self.setPlayhead(start)
+        self.edw.setTimeRange(start, end)
+
+    # show a time range around the playhead, the whole task it is in or the whole session
+    def spanSelected(self, i):
+        span = self.spans[i][1]
+        if span == "session":
+            self.edw.setTimeRange(0, self.store.duration())
+        elif span == "task":
+            self.taskSelected(self.store.locate(self.store.sampleAt(self.playhead))[0])
+        else:
+            self.edw.setTimeRange(self.playhead - span/2, self.playhead + span/2)
+
+    def sliderMoved(self, value):
+        self.setPlayhead(float(self.store.timeAt(value)), True)
+
+    def playToggled(self, checked):
+        self.pbp.setText("Pause" if checked else "Play")
+        if checked:
+            self.play_timer.start()
+        else:
+            self.play_timer.stop()
+
+    def playStep(self):
+        t = self.playhead + self.speeds[self.cbs.currentIndex()] * self.frame_interval / 1000
+        if t >= self.store.duration():
+            self.pbp.setChecked(False)
+            return
+        self.setPlayhead(t, True)
+
+    # move the playhead to time t, if follow is set the shown range moves with it once it reaches the edge of the graphs
+    def setPlayhead(self, t, follow=False):
+        self.playhead = min(max(t, 0), float(self.store.timeAt(len(self.store) - 1)))
+        self.edw.setPlayhead(self.playhead)
+        self.ss.blockSignals(True)
+        self.ss.setValue(self.store.sampleAt(self.playhead))
+        self.ss.blockSignals(False)
+        if follow:
+            start, end = self.edw.graphs[0].getViewBox().viewRange()[0]
+            if self.playhead < start or self.playhead > end:
+                self.edw.setTimeRange(self.playhead - self.span*0.1, self.playhead + self.span*0.9)
+        self.updateCue()
+
+    # show the stimulus the participant saw at the playhead. During a rest the next grip to be performed is shown off, as in the experiment
+    def updateCue(self):
+        task_i, index = self.store.locate(self.store.sampleAt(self.playhead))
+        task = self.store.tasks[task_i]
+        label = task.labelAt(index)
+        if label != 0:
+            cue = (label, True)
+        else:
+            after = task.transition_label[np.searchsorted(task.transition_index, index, side='right'):]
+            upcoming = after[after != 0]
+            cue = (int(upcoming[0]), False) if len(upcoming) > 0 else (0, False)
+        if cue != self.cue: # the display repaints on every call, only update it on a change
+            self.cue = cue
+            if cue[0] == 0:
+                self.sdw.resetStim()
+            else:
+                self.sdw.setStimVal(cue[0])
+                if cue[1]:
+                    self.sdw.setStimOn()
+                else:
+                    self.sdw.setStimOff()
+
+        # details at the playhead: task, time in task, wall clock time of the packet, class and the last IT reading
+        rate = self.store.rates[task_i]
+        text = f"Task {task.name}, {index / rate:.3f} s, {self.labelName(label)}"
+        packet = np.searchsorted(task.packet_index, index, side='right') - 1
+        if packet >= 0:
+            text += f", recorded {datetime.fromtimestamp(task.packet_time[packet]).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}"
+        reading = np.searchsorted(task.it_index, index, side='right') - 1
+        if reading >= 0:
+            values = task.it_values[reading]
+            text += f"\nLast IT reading ({(index - task.it_index[reading]) / rate:.1f} s ago): " + ", ".join(f"{v:g}" for v in values[~np.isnan(values)])
+        self.li.setText(text)
+
+    def labelName(self, label):
+        if 0 < label <= len(self.protocol.grips):
+            return self.protocol.grips[label-1].name
+        return "Rest" if label == 0 else f"Class {label}"
+
+    # callback when the shown time range changes, redraws the EMG and markers for the range from the coarsest pyramid level that keeps max_points of detail
+    def timeRangeChanged(self, start, end):
+        if self.store is None:
+            return
+        self.span = end - start
+        a = max(0, self.store.sampleAt(start) - 1)
+        b = min(len(self.store), self.store.sampleAt(end) + 2)
+        for ch in range(2):
+            x, lo, hi = self.store.envelope(ch, a, b, self.max_points)
+            self.edw.setEnvelope(ch, self.store.timeAt(x), lo, hi)
+        markers = []
+        indices, labels = self.store.transitions(a, b)
+        for index, label in zip(indices, labels):
+            markers.append((float(self.store.timeAt(index)), self.labelName(int(label)), 'g' if label != 0 else 'r'))
+        indices, values = self.store.itReadings(a, b)
+        for index in indices:
+            markers.append((float(self.store.timeAt(index)), "IT", 'c'))
+        self.edw.setMarkers(markers if len(markers) <= self.max_markers else [])
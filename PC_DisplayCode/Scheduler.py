@@ -0,0 +1,86 @@
+# Trial scheduler, runs the events of a task from a precomputed schedule
+# Every deadline is an offset from a single monotonic start time, so latency in handling one event does not push back those after it (as re-arming a single shot timer after each callback did)
+# Planned and actual times are logged for every event and passed on with it, so the recorder can label data with when transitions really happened
+# Times are taken from a clock (see Clock.py), perf_counter time unless the scheduler is given a virtual clock
+
+import logging
+from collections import namedtuple
+from enum import Enum
+from PyQt5.QtCore import *
+
+from Clock import REAL_CLOCK
+
+Phase = Enum('Phase', ['REST', 'ACTIVE', 'IT_READ', 'END'])
+
+# One scheduled event. offset is in ms from the task start, stim and repetition are the grip the event belongs to, progress is the fraction of activations completed
+ScheduleEvent = namedtuple('ScheduleEvent', ['offset', 'phase', 'stim', 'repetition', 'progress'])
+
+# Build the schedule of a task. Each grip (stim value) is performed for a number of repetitions, each repetition being a rest then an active period.
+# IT reads are requested a reaction delay after an active period ends, allowing the participant to settle; after every activation, after the last repetition of each grip, or never (it_read "activation", "grip", "none").
+# The task ends after a final rest. The stim of a rest event is the grip shown during that rest, i.e. the next grip to be performed (0, the rest image, after the final activation)
+def buildSchedule(stims, repetitions, time_off, time_on, reaction_delay, it_read="activation"):
+    activations = [(stim, rep) for stim in stims for rep in range(1, repetitions+1)]
+    events = [ScheduleEvent(0, Phase.REST, stims[0], 1, 0)]
+    t = 0
+    for i, (stim, rep) in enumerate(activations):
+        t += time_off
+        events.append(ScheduleEvent(t, Phase.ACTIVE, stim, rep, i/len(activations)))
+        t += time_on
+        next_stim, next_rep = activations[i+1] if i+1 < len(activations) else (0, 1)
+        events.append(ScheduleEvent(t, Phase.REST, next_stim, next_rep, (i+1)/len(activations)))
+        if it_read == "activation" or (it_read == "grip" and rep == repetitions):
+            events.append(ScheduleEvent(t + reaction_delay, Phase.IT_READ, stim, rep, (i+1)/len(activations)))
+    events.append(ScheduleEvent(t + time_off, Phase.END, 0, 1, 1))
+    return sorted(events, key=lambda e: e.offset) # stable, so events at the same offset keep their build order
+
+class TrialScheduler(QObject):
+
+    sig_event = pyqtSignal(object, float, float) # signal emitted for each event as it falls due (event, planned clock time, actual clock time)
+
+    def __init__(self, clock=REAL_CLOCK, *args, **kwargs):
+
+        super(TrialScheduler, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.TrialScheduler")
+
+        self.events = []
+        self.index = 0 # index of the next event to fire
+        self.clock = clock
+        self.t0 = None # clock time of the task start, all deadlines are relative to this
+
+        self.timer = clock.timer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.fire)
+
+    # begin running a schedule, events at offset 0 fire immediately
+    def start(self, events):
+        self.events = events
+        self.index = 0
+        self.t0 = self.clock.now()
+        self.logger.info(f"Starting schedule of {len(events)} events, {events[-1].offset/1000:.1f} s")
+        self.fire()
+
+    # abandon the running schedule
+    def stop(self):
+        self.timer.stop()
+        self.events = []
+        self.index = 0
+
+    def isRunning(self):
+        return self.index < len(self.events)
+
+    def plannedTime(self, event):
+        return self.t0 + event.offset/1000
+
+    # callback on timer expiry. Fires every event now due (more than one if the event loop was held up), then arms the timer for the next deadline
+    def fire(self):
+        while self.index < len(self.events) and self.plannedTime(self.events[self.index]) <= self.clock.now():
+            event = self.events[self.index]
+            self.index += 1
+            planned = self.plannedTime(event)
+            actual = self.clock.now()
+            self.logger.info(f"{event.phase.name} stim {event.stim} rep {event.repetition}: planned +{event.offset} ms, actual +{(actual - self.t0)*1000:.1f} ms ({(actual - planned)*1000:+.2f} ms)")
+            self.sig_event.emit(event, planned, actual) # may stop the schedule, which ends the loop
+        if self.index < len(self.events):
+            # with a real clock the timer can expire just before the deadline, in which case the loop above fires nothing and it is armed again until the event is due
+            self.clock.startAt(self.timer, self.plannedTime(self.events[self.index]))
@@ -0,0 +1,114 @@
+# Definition of the serial protocol between the PC and the Arduino host (see ArduinoCode/ExperimentProgram.ino), shared by the serial parser, the simulator, the engine, the displays and the recorders
+# Frames from the device are a 4 byte header, a fixed number of big endian values and a 4 byte footer. Responses to commands are text between the REP header and footer.
+# Commands to the device are "<", the command code, any argument, ">" and a newline, and each command has the response the device gives to it.
+# The EMG sample rate and frame length are negotiated when the port opens: the device replies to OPEN with its sampling, and the PC sends OPEN again with the sampling it wants if that differs.
+# The reply to that gives the sampling the device then uses, and the EMG frames that follow it are of that length
+# Each FrameSpec carries precompiled structs for its payload and the whole frame, so packing or unpacking is one call, and decoded data is held in namedtuples (no per instance dict)
+
+import struct
+from collections import namedtuple
+from enum import Enum, IntEnum
+
+# count values of struct value_type in the payload, payload and frame are the structs of the payload alone and of the whole frame, size is the frame size in bytes
+FrameSpec = namedtuple('FrameSpec', ['name', 'header', 'footer', 'count', 'value_type', 'payload', 'frame', 'size'])
+
+def frameSpec(name, header, footer, count, value_type):
+    payload = struct.Struct(f">{count}{value_type}")
+    frame = struct.Struct(f">{len(header)}s{count}{value_type}{len(footer)}s")
+    return FrameSpec(name, header, footer, count, value_type, payload, frame, frame.size)
+
+# EMG sampling of the device: sample rate in Hz, channels, and samples of each channel in an EMG frame. The device reports it in its reply to OPEN and OPEN can set it (see below)
+Sampling = namedtuple('Sampling', ['sample_rate', 'channels', 'samples'])
+
+EMG_CHANNELS = 2
+EMG_SAMPLES = 25 # samples of each channel in an EMG frame, 50 ms at 500 Hz
+DEFAULT_SAMPLING = Sampling(500, EMG_CHANNELS, EMG_SAMPLES) # the sampling at power up, and the only one of firmware replying to OPEN with a bare "HI"
+MAX_SAMPLE_RATE = 1000 # Hz, both sensors are read each sample with a 400 us wait between them
+PACKET_SAMPLES = (5, 100) # least and most samples of each channel in an EMG frame, limited by the device's buffer and by the parser, whose fifo must hold an IMP frame
+
+# frame of EMG samples, 12 bit ADC samples with the channels alternating [1,2,1,2,etc]
+def emgFrame(samples, channels=EMG_CHANNELS):
+    return frameSpec('EMG', b"EMG:", b":GME", channels * samples, 'H')
+
+EMG = emgFrame(EMG_SAMPLES) # frame of DEFAULT_SAMPLING
+IMP = frameSpec('IMP', b"IMP:", b":PMI", 8, 'H') # AD5933 real and imaginary values (signed, sent as unsigned) of the two electrodes of each sensor
+TMP = frameSpec('TMP', b"TMP:", b":PMT", 2, 'H') # MAX30205 temperature of each sensor, 1/256 C per count. Always sent straight after an IMP frame
+FRAMES = [EMG, IMP, TMP]
+REP_HEADER = b"REP:"
+REP_FOOTER = b":PER"
+
+# a whole frame of the values given, e.g. for the simulated device
+def packFrame(spec, values):
+    return spec.frame.pack(spec.header, *values, spec.footer)
+
+# the values of a payload starting at offset of a buffer
+def unpackPayload(spec, buffer, offset=0):
+    return spec.payload.unpack_from(buffer, offset)
+
+Response = Enum('Response', ['NONE', 'REP', 'IT']) # what the device sends back to a command: nothing, a REP frame, or an IMP and TMP frame
+
+# replies lists the texts of a REP response
+Command = namedtuple('Command', ['name', 'response', 'replies'])
+
+COMMANDS = [ # in the order of the command codes, as the UNI_ enum of the Arduino code
+    Command('OPEN', Response.REP, ["HI"]), # confirm the port is open and running our program, the reply gives the EMG sampling (see helloSampling). Followed by "<rate>,<samples>" it sets the sampling first
+    Command('CHECK_SEN', Response.REP, ["Y", "1", "2", "N"]), # both sensors present, only sensor 1 or 2, or neither
+    Command('IMP_TMP', Response.IT, []), # impedance and temperature read
+    Command('STOP_IMP_PER', Response.NONE, []), # stop periodic impedance and temperature reads
+    Command('START_IMP_PER', Response.NONE, []), # start periodic impedance and temperature reads
+    Command('SET_AD_RANGE_1', Response.NONE, []), # AD5933 output range and gain
+    Command('SET_AD_RANGE_2', Response.NONE, []),
+    Command('SET_AD_RANGE_3', Response.NONE, []),
+    Command('SET_AD_RANGE_4', Response.NONE, []),
+    Command('SET_AD_PGA_1', Response.NONE, []),
+    Command('SET_AD_PGA_5', Response.NONE, []),
+    Command('SET_REF_SW_IMP', Response.NONE, []), # reference switch to the AD5933 or the EMG subsystem
+    Command('SET_REF_SW_EMG', Response.NONE, []),
+] + [Command(f'SET_AD_FREQ_{i}', Response.NONE, []) for i in range(1, 9)] # AD5933 excitation frequency, option i of SWEEP_FREQUENCIES
+
+SWEEP_FREQUENCIES = [1000, 2000, 5000, 10000, 20000, 30000, 50000, 100000] # Hz, of the SET_AD_FREQ_ commands in order (ad_freq_khz of the Arduino code)
+IT_FREQUENCY = 1000 # Hz, AD5933 excitation frequency of the single IT reads, the sensors' setting at power up (AD5933_FREQUENCY_MAIN of the sensor firmware), which an impedance sweep sets again when it ends (see ImpedanceSweep.py)
+
+cmds = IntEnum('cmds', [c.name for c in COMMANDS], start=0)
+cmd_wait_response = max(code for code, c in enumerate(COMMANDS) if c.response == Response.REP) # the commands up to this code are answered with a REP frame, kept for Commands.py
+INVALID_COMMAND = 255 # unused by the device, sent in place of an invalid command and ignored
+
+# the bytes sent for a command code, followed by any argument as text (which must not contain "<" or ">")
+def packCommand(code, argument=""):
+    return b"<" + bytes([code]) + argument.encode() + b">\n"
+
+# the OPEN command setting the EMG sampling of the device
+def packOpen(sample_rate, samples):
+    return packCommand(cmds.OPEN, f"{sample_rate},{samples}")
+
+# whether the device can sample at sample_rate with samples of each channel per frame. The sample period must be a whole number of microseconds
+def validSampling(sample_rate, samples):
+    return (all(isinstance(v, int) and not isinstance(v, bool) for v in (sample_rate, samples)) and 0 < sample_rate <= MAX_SAMPLE_RATE and 1000000 % sample_rate == 0
+            and PACKET_SAMPLES[0] <= samples <= PACKET_SAMPLES[1])
+
+# the Sampling given by a reply to OPEN, "HI:<rate>,<channels>,<samples>", or DEFAULT_SAMPLING for a bare "HI". None if the reply is not to OPEN
+def helloSampling(reply):
+    if reply == "HI":
+        return DEFAULT_SAMPLING
+    if not reply.startswith("HI:"):
+        return None
+    try:
+        return Sampling(*(int(v) for v in reply[3:].split(",")))
+    except (TypeError, ValueError):
+        return None
+
+# whether the device answers a command code with a REP frame
+def expectsReply(code):
+    return code < len(COMMANDS) and COMMANDS[code].response == Response.REP
+
+# An impedance and temperature reading, each field a tuple: raw AD5933 values (8), calculated magnitudes in ohms (4, two electrodes per sensor), calculated phases in degrees (4), temperatures in C (2)
+ITReading = namedtuple('ITReading', ['raw', 'magnitude', 'phase', 'temperature'])
+IT_PAYLOAD = IMP.payload.size + TMP.payload.size # an IT packet on the intake queue is the IMP payload followed by the TMP payload
+
+# raw AD5933 and MAX30205 values of an IT packet
+def decodeIT(payload):
+    return unpackPayload(IMP, payload), unpackPayload(TMP, payload, IMP.payload.size)
+
+# the values of a reading in one list, as saved with the EMG
+def itValues(reading):
+    return [v for field in reading for v in field]
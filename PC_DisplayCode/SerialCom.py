@@ -1,60 +1,64 @@
-# Widget to host COM port to Arduino Host
-# Has no display elements, runs a QObject based threaded Serial Port and handles singals for generating data when requested for tasks
+# Link to the COM port of the Arduino Host, part of the acquisition engine (see Engine.py)
+# Has no display elements, and no dependency on QtWidgets so it can run headless. Runs a QObject based threaded Serial Port and handles singals for generating data when requested for tasks
 
 import logging
 from PyQt5.QtCore import *
-from PyQt5.QtWidgets import *
-from PyQt5.QtGui import *
 from PyQt5.QtSerialPort import *
 
 import time
 
-from Commands import cmds, cmd_wait_response
+from Clock import REAL_CLOCK
+from Commands import cmds
+from Packets import PacketPool
+from Schema import DEFAULT_SAMPLING, EMG, EMG_CHANNELS, IMP, TMP, REP_HEADER, REP_FOOTER, INVALID_COMMAND, decodeIT, emgFrame, expectsReply, helloSampling, packCommand, packOpen
+from Pipeline import EMG_PACKET, IT_PACKET, PacketQueue
 
-class SerialComWidget(QWidget):
+class SerialLink(QObject):
 
-    sig_emgDataReady = pyqtSignal(list) # signal emitted on reciept of new EMG packet
-    sig_impTempReady = pyqtSignal(list, list) # signal emitted on reciept of new IT packet
+    sig_emgDataReady = pyqtSignal(object) # signal emitted on reciept of new EMG packet, an immutable EMGPacket (see Packets.py) passed by reference
+    sig_emgBlockReady = pyqtSignal(object) # signal emitted after sig_emgDataReady of consecutive EMG packets taken in one batch, with the list of them, so they can be processed together
+    sig_impTempReady = pyqtSignal(object, object) # signal emitted on reciept of new IT packet, tuples of the raw AD5933 and MAX30205 values (see Schema.py)
     sig_portNotification = pyqtSignal(str)      # signal for errors/warnings/info on the com port
     sig_deviceNotification = pyqtSignal(str)    # signal for errors/warnings/info on the Arduino or Sensors
     sig_sendCommand = pyqtSignal(bytearray) # signal for sending commands to the Serial thread
     sig_cmdResponse = pyqtSignal(str) # signal emitted when the Arduino responds to a command from elsewhere in the software
     sig_serialError = pyqtSignal() # signal emitted if there is an error on the serial port
+    sig_batchDone = pyqtSignal() # signal emitted after each batch of packets taken from the intake queue is processed
+    sig_samplingChanged = pyqtSignal(object) # signal emitted when the device connects, with the Sampling (see Schema.py) its EMG packets now follow
     
     max_command = len(cmds) 
     
     command_chars = 4 
     
+    drain_batch = 20 # packets processed per pass of the event loop while catching up, so timers and the display still run
     
+    board_serial = None # USB serial number of the connected Arduino, which its impedance calibration is saved under (see Calibration.py)
     
-    def __init__(self, packet_size, *args, **kwargs):
+    sampling = DEFAULT_SAMPLING # EMG sampling of the connected device, as it last reported
+    configuring = False # True while waiting for the device to reply to setting its sampling
     
-        super(SerialComWidget, self).__init__(*args, **kwargs)
+    # sampling is the EMG Sampling (see Schema.py) asked of the device when it connects. Timers and the simulated device run on clock (see Clock.py)
+    def __init__(self, sampling=DEFAULT_SAMPLING, clock=REAL_CLOCK, *args, **kwargs):
+    
+        super(SerialLink, self).__init__(*args, **kwargs)
         
-        self.packet_size = packet_size
+        self.requested = sampling
+        self.clock = clock
         
         self.open = False
         
-        self.logger = logging.getLogger("app_logger.SerialComWidget")
-        
-        # has none of the standard QT things seen here as this is a widgetless widget
-        self.logger.info("Setting up widgets.")
-        
-        
-        self.logger.info("Setting up signals.")
-        
-        
-        self.logger.info("Setting up layout.")
+        self.logger = logging.getLogger("app_logger.SerialLink")
         
         # setup timer to poll for ports to open
-        self.com_timer = QTimer()
+        self.com_timer = clock.timer()
         self.com_timer.timeout.connect(self.testSerialPorts)
         self.com_timer.setInterval(5000) # poll every 5 seconds
         self.com_timer.start()
         
         self.emg_data = [] # storage variable for incoming EMG
         
-        self.logger.info("Finalising.")
+        self.intake = PacketQueue() # packets from the device thread waiting to be processed (see Pipeline.py)
+        self.pool = PacketPool(sampling.channels, sampling.samples) # recycled buffers for the decoded EMG (see Packets.py)
         
     # initialise the software with the port closed    
     def postInit(self):
@@ -69,58 +73,89 @@ class SerialComWidget(QWidget):
             #print(x.productIdentifier()) # use these lines to identiy product and vendor IDs for any used arduinos
             #print(x.vendorIdentifier())
             if (x.productIdentifier() == 94 or x.productIdentifier() == 32858 or x.productIdentifier() == 32855) and x.vendorIdentifier() == 9025: # if port matches a known Arduino
-                self.com_timer.stop() # stop the polling timer
-                self.serial_thread = QThread() # instantiate a QThread 
-                self.serial_obj = SerialObject(x, 115200, (self.command_chars*2)+(self.packet_size*2)) # create our serial object that contains the com port, passing the com object through
-                # connect necessary signals from both the thread, the object, and the widget to permit information passing between the threads
-                self.serial_thread.finished.connect(self.threadFinished) 
-                self.serial_obj.sig_emgDataReady.connect(self.emgDataReady)
-                self.serial_obj.sig_impAndTempDataReady.connect(self.impTmpDataReady)
-                self.serial_obj.sig_cmdResponse.connect(self.procCMDResponse)
-                self.serial_obj.sig_serialError.connect(self.procSerialError)
-                self.sig_sendCommand.connect(self.serial_obj.sendCommand)
-                self.serial_obj.moveToThread(self.serial_thread) # put the serial object onto the thread so it runs in the threads exec loop not the UI exec loop
                 self.logger.info("Starting serial thread to Arduino")
-                self.serial_thread.start() # begin the thread
+                self.attachDevice(SerialObject(x, 115200, EMG.size, self.intake), x.serialNumber()) # create our serial object that contains the com port, passing the com object through
                 
-                self.open = True
-                self.sig_portNotification.emit("Opened") # alert that the port is open
-                self.sendCommand(cmds.OPEN) # confirm that the arduino is running our program by requesting a known response
-
-    tic = 0 # for timing
-    
-    # callback on EMG packet passed through from the thread. Converts the single bytearray into two lists of unsigned int16 data [0,4095] = [0 V, 3.3 V]
-    def emgDataReady(self, emg_array : bytearray):
-        self.logger.debug(f"Time since last emg recv: {time.perf_counter() - self.tic}") # confirm real time running in log
-        self.tic = time.perf_counter()
-        bin_data = [] # create an array of paired byte values that form each emg sample
-        for i in range(0, 100, 2):
-            bin_data.append([emg_array[i], emg_array[i+1]])
+    # run a simulated device in place of the Arduino (see Simulator.py), speed times the real data rate
+    def simulate(self, speed=1):
+        from Simulator import SimulatedDevice # only needed for testing
+        self.logger.info(f"Starting simulated device at x{speed:g}")
+        self.attachDevice(SimulatedDevice(self.intake, speed, clock=self.clock), SimulatedDevice.serial_number)
         
-        comb_data = [] # shift the first byte by 8 bits and OR with the second to get the 16-bit value of the sample
-        for i in range(len(bin_data)):
-            comb_data.append(bin_data[i][0] << 8 | bin_data[i][1])
-            
-        # split the data into those from sensor 1 and 2 (samples are stored alternately [1,2,1,2,etc] by the arduino)
-        self.sensor_data_0 = []
-        self.sensor_data_1 = [] 
-        for i in range(0, len(comb_data), 2):
-            self.sensor_data_0.append(comb_data[i])
-            self.sensor_data_1.append(comb_data[i+1])
+    # run the device object, a SerialObject or SimulatedDevice, on its own thread. On a virtual clock a simulated device runs on this thread instead, driven by the clock
+    # serial_number identifies the board
+    def attachDevice(self, device, serial_number=None):
+        self.com_timer.stop() # stop the polling timer
+        self.serial_obj = device
+        self.board_serial = serial_number
+        self.configuring = False
+        # connect necessary signals from both the thread, the object, and the widget to permit information passing between the threads
+        self.serial_obj.sig_packetsReady.connect(self.drain)
+        self.serial_obj.sig_cmdResponse.connect(self.procCMDResponse)
+        self.serial_obj.sig_serialError.connect(self.procSerialError)
+        self.sig_sendCommand.connect(self.serial_obj.sendCommand)
+        if self.clock.threaded:
+            self.serial_thread = QThread() # instantiate a QThread 
+            self.serial_thread.finished.connect(self.threadFinished) 
+            self.serial_obj.moveToThread(self.serial_thread) # put the serial object onto the thread so it runs in the threads exec loop not the UI exec loop
+            self.serial_thread.started.connect(self.serial_obj.start)
+            self.serial_thread.start() # begin the thread
+        else:
+            self.serial_thread = None
+            self.serial_obj.start()
         
-        self.sig_emgDataReady.emit([self.sensor_data_0, self.sensor_data_1]) # emit the data to the program
+        self.open = True
+        self.sig_portNotification.emit("Opened") # alert that the port is open
+        self.sendCommand(cmds.OPEN) # confirm that the arduino is running our program by requesting a known response
         
-    # callback on IT packet passed through from the thread, converts to unsigned int16 values from bytearray
-    def impTmpDataReady(self, imp_array : bytearray, temp_array : bytearray):
-        self.imp_data = [] # as with EMG, shift the first byte by 8 bits and OR with the second byte
-        for i in range(0, len(imp_array), 2):
-            self.imp_data.append(imp_array[i] << 8 | imp_array[i+1])
-        self.temp_data = [] # as with EMG, shift the first byte by 8 bits and OR with the second byte
-        for i in range(0, len(temp_array), 2):
-            self.temp_data.append(temp_array[i] << 8 | temp_array[i+1])
+    # callback when the device thread has put packets on the intake queue. Processes a batch, and if more are waiting comes back for them on the next pass of the event loop.
+    # On a virtual clock nothing else runs until the packets are processed, so all those waiting are taken together
+    def drain(self):
+        batch = self.drain_batch if self.clock.threaded else max(self.drain_batch, self.intake.depth())
+        if self.processPackets(self.intake.take(batch)) == batch:
+            self.clock.singleShot(0, self.drain)
+        self.sig_batchDone.emit()
+            
+    # process everything waiting on the intake queue now, e.g. so a task's data is all recorded before its files are closed. Packets arriving meanwhile are left for drain.
+    # A simulated device on a virtual clock sends its packets in blocks, so first sends those due by now
+    def drainAll(self):
+        if not self.clock.threaded and self.open:
+            self.serial_obj.flush()
+        waiting = self.intake.depth()
+        while waiting > 0:
+            done = self.processPackets(self.intake.take(min(waiting, self.drain_batch)))
+            if done == 0:
+                break
+            waiting -= done
+        self.sig_batchDone.emit()
         
-        self.sig_impTempReady.emit(self.imp_data, self.temp_data)
+    # decode packets taken from the intake queue in order, returns the number processed. Each run of EMG packets between IT readings is passed on as a block
+    def processPackets(self, items):
+        block = []
+        for kind, payload, recv_time in items:
+            if kind == EMG_PACKET:
+                block.append(self.emgDataReady(payload, recv_time))
+                continue
+            if len(block) > 0:
+                self.sig_emgBlockReady.emit(block)
+                block = []
+            self.sig_impTempReady.emit(*decodeIT(payload))
+        if len(block) > 0:
+            self.sig_emgBlockReady.emit(block)
+        return len(items)
+
+    tic = 0 # for timing
     
+    # callback on EMG packet passed through from the thread. Converts the single bytearray into the unsigned int16 samples [0,4095] = [0 V, 3.3 V] of each sensor,
+    # stored alternately [1,2,1,2,etc] big endian by the arduino, in a buffer from the pool. Returns the EMGPacket
+    def emgDataReady(self, emg_array : bytearray, recv_time : float):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Time since last emg recv: {time.perf_counter() - self.tic}") # confirm real time running in log
+            self.tic = time.perf_counter()
+        packet = self.pool.fromWire(emg_array, recv_time)
+        self.sig_emgDataReady.emit(packet) # emit the data to the program
+        return packet
+        
     # callback on thread finish, reset the polling timer and emit a signal to alert the port closed
     def threadFinished(self):
         if self.open:
@@ -136,22 +171,50 @@ class SerialComWidget(QWidget):
     
     # Callback on reciept of command signal from other widgets, sends the command to the serial thread
     def sendCommand(self, command):
-        command_o = [60, 255, 62, 10] # 255 will be unused in scheme and ignored, 60 & 62 are start end markers for control "<" & ">"
-        if command >= 255: # checks for valid commands
+        code = INVALID_COMMAND # will be unused in scheme and ignored, the command is wrapped in "<" & ">" start end markers (see Schema.py)
+        if command >= INVALID_COMMAND: # checks for valid commands
             self.logger.error("Serial control recieved command out of scope")        
         elif command > self.max_command:
             self.logger.error("Serial control recieved valid value but out of range")
             
         else:
-            command_o[1] = command
+            code = command
             
-        self.sig_sendCommand.emit(bytearray(command_o))
+        self.sig_sendCommand.emit(bytearray(packCommand(code)))
+        
+    # ask the device to sample at sample_rate with samples of each channel per EMG packet, answered by a reply to OPEN
+    def configure(self, sample_rate, samples):
+        self.configuring = True
+        self.sig_sendCommand.emit(bytearray(packOpen(sample_rate, samples)))
+        
+    # callback on the device's reply to OPEN, which gives its sampling. If that is not the sampling requested the device is asked once to change it,
+    # and the device is connected once its sampling is settled
+    def helloReceived(self, resp, sampling):
+        if sampling != self.requested and not self.configuring:
+            if resp == "HI":
+                self.logger.warning(f"Device firmware cannot set its sampling, using {sampling.sample_rate} Hz with {sampling.samples} samples per packet")
+            else:
+                self.logger.info(f"Setting device sampling to {self.requested.sample_rate} Hz with {self.requested.samples} samples per packet")
+                self.configure(self.requested.sample_rate, self.requested.samples)
+                return
+        elif sampling != self.requested:
+            self.logger.warning(f"Device refused sampling at {self.requested.sample_rate} Hz with {self.requested.samples} samples per packet, using {sampling.sample_rate} Hz with {sampling.samples}")
+        self.configuring = False
+        if sampling.channels != EMG_CHANNELS:
+            self.logger.error(f"Device has {sampling.channels} EMG channels, {EMG_CHANNELS} are needed")
+            self.sig_portNotification.emit("Unsupported Device")
+            return
+        self.sampling = sampling
+        self.logger.info(f"Device sampling at {sampling.sample_rate} Hz with {sampling.samples} samples per packet")
+        self.sig_samplingChanged.emit(sampling)
+        self.sig_portNotification.emit("Arduino Connected")
         
     # Callback on reciept of response to issued command. 
     def procCMDResponse(self, resp):
-        # If the response is to our polling command emit a common port notification, if not emit the response to the other widgets to process
-        if resp == "HI":
-            self.sig_portNotification.emit("Arduino Connected")
+        # If the response is to our polling command emit a common port notification once the sampling is settled, if not emit the response to the other widgets to process
+        sampling = helloSampling(resp)
+        if sampling is not None:
+            self.helloReceived(resp, sampling)
         if resp == "N":
             self.sig_deviceNotification.emit("Sensors Disconnected")
         if resp == "Y":
@@ -166,13 +229,13 @@ class SerialComWidget(QWidget):
     def procSerialError(self):
         self.sig_serialError.emit()
         self.com_timer.start()
-        self.serial_thread.quit()
+        if self.serial_thread is not None:
+            self.serial_thread.quit()
 
 # SerialObject class containing the serial port. Permits a way to move the Serial port onto a seperate thread to the UI
 class SerialObject(QObject):
 
-    sig_emgDataReady = pyqtSignal(bytearray) # signal emitted when an EMG packet is recieved
-    sig_impAndTempDataReady = pyqtSignal(bytearray, bytearray) # signal emitted when an IT packet is recieved
+    sig_packetsReady = pyqtSignal() # signal emitted when packets are put on the intake queue and it is not already waiting to be drained (see Pipeline.py)
     sig_cmdResponse = pyqtSignal(str) # signal emitted when a command response is recieved
     sig_serialError = pyqtSignal() # signal emitted if the Serial port has an error
     
@@ -180,9 +243,12 @@ class SerialObject(QObject):
     
     wait_for_response = False # Flag applied when a sent command expects a response from the Arduino
     
-    def __init__(self, com_port_info, baud_rate, array_size):
+    # EMG and IT packets are put on intake, a PacketQueue, with the perf_counter time they were read
+    # array_size is the size of the EMG frame, the parser's fifo is resized when the device's sampling changes
+    def __init__(self, com_port_info, baud_rate, array_size, intake):
         # initialise the serial port settings
         super(SerialObject, self).__init__()
+        self.intake = intake
         self.array_size = array_size
         self.logger = logging.getLogger("app_logger.SerialThread")
         self.baud_rate = baud_rate
@@ -201,6 +267,10 @@ class SerialObject(QObject):
             self.serial_port.clear() # flush the buffer
             self.serial_port.setDataTerminalReady(True) # begin coms
         
+    # called on the serial thread once it is running, the port is already open
+    def start(self):
+        pass
+        
     def close(self):
         self.logger.info("Closing COM port")
         self.serial_port.close()
@@ -212,28 +282,36 @@ class SerialObject(QObject):
             self.data_queue.extend(data_i) # place the new byte on our fifo
             
             # parse the fifo buffer, search for the expected markers of an EMG, IMP or TMP packet, with appropriate space between the header and footer. If found, we know the byte inbetween form our data packet and we can emit these
-            if self.data_queue[0:4] == bytearray(b"EMG:") and self.data_queue[-4:] == bytearray(b":GME"):
-                self.sig_emgDataReady.emit(self.data_queue[4:-4])            
-            elif self.data_queue[0:4] == bytearray(b"IMP:") and self.data_queue[20:24] == bytearray(b":PMI"):
-                self.lastImp = self.data_queue[4:20]
-            elif self.data_queue[0:4] == bytearray(b"TMP:") and self.data_queue[8:12] == bytearray(b":PMT"):
-                self.sig_impAndTempDataReady.emit(self.lastImp, self.data_queue[4:8])
+            # the frame layouts are defined in Schema.py, the fifo is the size of an EMG frame
+            if self.data_queue[0:4] == EMG.header and self.data_queue[-4:] == EMG.footer:
+                if self.intake.put(EMG_PACKET, self.data_queue[4:-4], time.perf_counter()):
+                    self.sig_packetsReady.emit()
+            elif self.data_queue[0:4] == IMP.header and self.data_queue[IMP.size-4:IMP.size] == IMP.footer:
+                self.lastImp = self.data_queue[4:IMP.size-4]
+            elif self.data_queue[0:4] == TMP.header and self.data_queue[TMP.size-4:TMP.size] == TMP.footer and self.lastImp is not None:
+                if self.intake.put(IT_PACKET, self.lastImp + self.data_queue[4:TMP.size-4], time.perf_counter()): # IT goes through the same queue as the EMG so it stays in order with it
+                    self.sig_packetsReady.emit()
             
             if self.wait_for_response: 
-                idx = self.data_queue.find(bytearray(b"REP:")) # if we know we are expecting a response, look for the REP header and footer to identify the packet
+                idx = self.data_queue.find(REP_HEADER) # if we know we are expecting a response, look for the REP header and footer to identify the packet
                 if idx > -1:
-                    idx_end = self.data_queue.find(bytearray(b":PER")) # as responses are variable size we must locate the end programatically rather than manually as before
+                    idx_end = self.data_queue.find(REP_FOOTER) # as responses are variable size we must locate the end programatically rather than manually as before
                     if idx_end > -1:
                         response = self.data_queue[idx+4:idx_end].decode('utf-8') # take the data within. Responses are always strings, so decode with utf-8 to get the string meaning rather than a bytearray
                         print(f"response: {response}")
                         self.sig_cmdResponse.emit(response) # emit the response
                         self.wait_for_response = False
-                        for i in range(idx_end+4):
-                            self.data_queue[i] = 0 # delete the footer from the buffer so we don't find this response again
+                        sampling = helloSampling(response)
+                        if sampling is not None: # EMG frames after a reply to OPEN follow the sampling it gives, the fifo is remade at their size (the reply ends the fifo, nothing is lost)
+                            self.array_size = emgFrame(sampling.samples, sampling.channels).size
+                            self.data_queue = bytearray(self.array_size)
+                        else:
+                            for i in range(idx_end+4):
+                                self.data_queue[i] = 0 # delete the footer from the buffer so we don't find this response again
  
     # callback on reciept of a command from the other widgets. Writes the command to the serial port
     def sendCommand(self, command):
-        if command[1] <= cmd_wait_response:
+        if expectsReply(command[1]):
             self.wait_for_response = True
         if self.serial_port.write(command) < 1:
             self.logger.error(f"Command not written to Serial port, attempted command: {command}")
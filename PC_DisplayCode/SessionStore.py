@@ -0,0 +1,278 @@
+# Random access reader for recorded participant sessions
+# The task csv files of a participant folder are converted once, on first open, to a fixed-record binary layout in the "review" folder of the participant folder:
+#   <task>.npy        - one RECORD per sample (sensor 1, sensor 2, class), memory mapped so any window or channel is read as a view of the file without loading it
+#   <task>_index.npz  - sample index and values of every label transition and IT reading, and the sample index and wall time of every packet
+#   <task>_pyr<k>.npy - min/max pyramid level k, each bin holding the [min, max] of each channel over PYRAMID_FACTOR**k samples
+# so a window of any length, from the whole session down to single samples, is drawn from a bounded number of points. The files are rebuilt if the task recording is newer
+# Tasks recorded compressed (<task>.emgz, see Compression.py) are read the same way, decoded chunk by chunk
+# A session is the tasks placed end to end, indexed by sample and timed by the sample rate each task was recorded at, which need not be the same for all of them
+
+import csv
+import logging
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+
+from Compression import EmgzReader
+from Schema import DEFAULT_SAMPLING
+
+REVIEW_DIR = "review"
+RECORD = np.dtype([('ch0', '<u2'), ('ch1', '<u2'), ('label', '<u1')])
+CHANNELS = ['ch0', 'ch1']
+PYRAMID_FACTOR = 8 # samples (or bins of the level below) per bin
+PYRAMID_MIN_BINS = 256 # no more levels are built once a level is this small
+CHUNK_ROWS = 1 << 16 # rows converted at a time, a multiple of PYRAMID_FACTOR
+REVIEW_VERSION = 2 # saved in the index, review files of another version are rebuilt (version 1 pyramids of compressed recordings were misaligned)
+
+_TIME_FORMAT = "%Y-%m-%d %H-%M-%S-%f" # Recorder.TIMESTAMP_FORMAT for strptime, %f takes the milliseconds
+
+# the tasks recorded in a participant folder (csv or emgz), in the order they were named (1_1, 1_2, ... 1_10). Label, cue, quality, sweep and set aside files are excluded
+def taskFiles(results_path):
+    names = set()
+    for f in os.listdir(results_path):
+        name, ext = os.path.splitext(f)
+        if ext not in [".csv", ".emgz"] or name.endswith("_labels") or name.endswith("_cues") or name.endswith("_quality") or name.endswith("_sweep") or name.endswith("_sweep_fit") or "_incomplete_" in name:
+            continue
+        names.add(name)
+    return sorted(names, key=lambda n: [int(p) if p.isdigit() else p for p in re.split(r"(\d+)", n)])
+
+# save an array so a reader never sees a partly written file
+def _saveArray(path, array):
+    with open(path + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+# reduce [min, max] bins of shape (n, channels, 2) by PYRAMID_FACTOR, the last bin may cover fewer
+def _reduce(bins):
+    full = len(bins) // PYRAMID_FACTOR * PYRAMID_FACTOR
+    blocks = [np.stack([bins[:full, :, 0].reshape(-1, PYRAMID_FACTOR, bins.shape[1]).min(1),
+                        bins[:full, :, 1].reshape(-1, PYRAMID_FACTOR, bins.shape[1]).max(1)], axis=2)]
+    if full < len(bins):
+        tail = bins[full:]
+        blocks.append(np.stack([tail[:, :, 0].min(0), tail[:, :, 1].max(0)], axis=1)[np.newaxis])
+    return np.concatenate(blocks)
+
+# number of samples in a task csv and a generator reading it in chunks of CHUNK_ROWS, each (first sample, records, [(packet sample, wall time s)], [(sample, IT values)])
+def _csvChunks(path):
+    with open(path, 'rb') as f:
+        rows = f.read().count(b"\n") # complete rows only, a partial last row is ignored
+    return rows, _readCsv(path, rows)
+
+def _readCsv(path, rows):
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        for start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - start)
+            chunk = np.zeros(n, dtype=RECORD)
+            packets, it = [], []
+            for i in range(n):
+                row = next(reader)
+                if row[0] != "": # first row of a packet
+                    packets.append((start + i, datetime.strptime(row[0], _TIME_FORMAT).timestamp()))
+                chunk[i] = (int(row[1]), int(row[2]), int(row[3]) if row[3] != "" else 0)
+                if len(row) > 4 and row[4] != "":
+                    it.append((start + i, [float(v) for v in row[4:] if v != ""]))
+            yield start, chunk, packets, it
+
+# number of samples in a compressed task recording and a generator reading it chunk by chunk, as _csvChunks
+def _emgzChunks(path):
+    reader = EmgzReader(path)
+    return len(reader), _readEmgz(reader)
+
+def _readEmgz(reader):
+    for c in reader.chunks():
+        records = np.zeros(len(c.labels), dtype=RECORD)
+        records['ch0'] = c.channels[0]
+        records['ch1'] = c.channels[1]
+        records['label'] = c.labels
+        yield c.first, records, [(i, t/1000) for i, t in c.packets], [(i, [float(v) for v in text.split(",") if v != ""]) for i, text in c.it]
+
+class TaskRecording:
+
+    def __init__(self, results_path, name):
+        self.logger = logging.getLogger("app_logger.SessionStore")
+        self.name = name
+        self.source_path = os.path.join(results_path, name + ".csv")
+        if not os.path.exists(self.source_path):
+            self.source_path = os.path.join(results_path, name + ".emgz")
+        self.review_path = os.path.join(results_path, REVIEW_DIR)
+        if self.isStale():
+            self.build()
+        self.records = np.load(self.path(".npy"), mmap_mode='r')
+        with np.load(self.path("_index.npz")) as index:
+            self.transition_index = index["transition_index"] # first sample of each label transition
+            self.transition_label = index["transition_label"]
+            self.it_index = index["it_index"] # sample each IT reading was saved with
+            self.it_values = index["it_values"] # one row per reading, NaN where a reading has fewer values
+            self.packet_index = index["packet_index"] # first sample of each packet
+            self.packet_time = index["packet_time"] # wall time of each packet, seconds since the epoch
+        self.pyramid = []
+        k = 1
+        while os.path.exists(self.path(f"_pyr{k}.npy")):
+            self.pyramid.append(np.load(self.path(f"_pyr{k}.npy"), mmap_mode='r'))
+            k += 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def path(self, suffix):
+        return os.path.join(self.review_path, self.name + suffix)
+
+    def isStale(self):
+        if not os.path.exists(self.path("_index.npz")): # written last, so present only if the build completed
+            return True
+        with np.load(self.path("_index.npz")) as index:
+            if "version" not in index.files or int(index["version"]) != REVIEW_VERSION:
+                return True
+        return os.path.getmtime(self.source_path) > os.path.getmtime(self.path("_index.npz"))
+
+    # convert the task recording to the binary layout and build its index and pyramid
+    def build(self):
+        self.logger.info(f"Building review files for {self.name}")
+        os.makedirs(self.review_path, exist_ok=True)
+        rows, chunks = (_emgzChunks if self.source_path.endswith(".emgz") else _csvChunks)(self.source_path)
+        records = np.lib.format.open_memmap(self.path(".npy.tmp"), mode='w+', dtype=RECORD, shape=(rows,))
+        packets, it = [], []
+        for start, chunk, chunk_packets, chunk_it in chunks:
+            records[start:start+len(chunk)] = chunk
+            packets.extend(chunk_packets)
+            it.extend(chunk_it)
+        # level 1 from the converted records in blocks of CHUNK_ROWS, a multiple of PYRAMID_FACTOR, so every bin covers the samples it should whatever the length of the chunks read
+        # (a compressed recording has a chunk at each checkpoint, of any length)
+        level_1 = []
+        for start in range(0, rows, CHUNK_ROWS):
+            values = np.stack([records[c][start:start+CHUNK_ROWS] for c in CHANNELS], axis=1)
+            level_1.append(_reduce(np.stack([values, values], axis=2)))
+        records.flush()
+        del records
+        os.replace(self.path(".npy.tmp"), self.path(".npy"))
+        it_index = [i for i, v in it]
+        it_values = [v for i, v in it]
+        packet_index = [i for i, t in packets]
+        packet_time = [t for i, t in packets]
+
+        # pyramid, level 1 built with the conversion and each level above from the one below
+        k = 1
+        level = np.concatenate(level_1) if level_1 else np.zeros((0, len(CHANNELS), 2), dtype='<u2')
+        while True:
+            _saveArray(self.path(f"_pyr{k}.npy"), level)
+            if len(level) <= PYRAMID_MIN_BINS:
+                break
+            level = _reduce(level)
+            k += 1
+        while os.path.exists(self.path(f"_pyr{k+1}.npy")): # levels left over from a longer recording
+            os.remove(self.path(f"_pyr{k+1}.npy"))
+            k += 1
+
+        labels = np.load(self.path(".npy"), mmap_mode='r')['label']
+        transition_index = np.flatnonzero(np.diff(labels)) + 1
+        if len(labels) > 0 and labels[0] != 0: # labelled from the first sample, i.e. a transition from rest at 0
+            transition_index = np.concatenate([[0], transition_index])
+        width = max((len(v) for v in it_values), default=0)
+        it_array = np.full((len(it_values), width), np.nan)
+        for i, v in enumerate(it_values):
+            it_array[i, :len(v)] = v
+        with open(self.path("_index.npz.tmp"), 'wb') as f:
+            np.savez(f, version=REVIEW_VERSION, transition_index=transition_index, transition_label=np.asarray(labels[transition_index]),
+                     it_index=np.asarray(it_index, dtype=np.int64), it_values=it_array,
+                     packet_index=np.asarray(packet_index, dtype=np.int64), packet_time=np.asarray(packet_time))
+        os.replace(self.path("_index.npz.tmp"), self.path("_index.npz"))
+        self.logger.info(f"Built {self.name}: {rows} samples, {len(transition_index)} transitions, {len(it_values)} IT readings, {k} pyramid levels")
+
+    # records of samples [start, stop), a view of the mapped file
+    def window(self, start, stop):
+        return self.records[start:stop]
+
+    # one channel ("ch0", "ch1" or "label") of samples [start, stop), a view of the mapped file
+    def channel(self, name, start, stop):
+        return self.records[name][start:stop]
+
+    # class of the sample at index
+    def labelAt(self, index):
+        pos = np.searchsorted(self.transition_index, index, side='right') - 1
+        return int(self.transition_label[pos]) if pos >= 0 else 0
+
+    # (first sample, min, max) of channel ch (0 or 1) over [start, stop) using the finest level that needs at most max_points bins. At level 0 min and max are the samples
+    def envelope(self, ch, start, stop, max_points):
+        k = 0
+        while k < len(self.pyramid) and (stop - start) > max_points * PYRAMID_FACTOR**k:
+            k += 1
+        if k == 0:
+            values = self.records[CHANNELS[ch]][start:stop]
+            return np.arange(start, start + len(values)), values, values
+        size = PYRAMID_FACTOR**k
+        first, last = start // size, -(-stop // size)
+        level = self.pyramid[k-1][first:last, ch]
+        return np.arange(first, first + len(level)) * size, level[:, 0], level[:, 1]
+
+class SessionStore:
+
+    # open every task recorded in a participant folder, building the review files of any that need it. sample_rates is the rate each task file was recorded at
+    # (see Journal.taskSampleRates), tasks not in it are taken to be at the default rate, as recorded before the sampling could be set
+    def __init__(self, results_path, sample_rates):
+        self.logger = logging.getLogger("app_logger.SessionStore")
+        self.results_path = results_path
+        self.tasks = [TaskRecording(results_path, name) for name in taskFiles(results_path)]
+        self.rates = np.array([sample_rates.get(t.name, DEFAULT_SAMPLING.sample_rate) for t in self.tasks], dtype=float) # Hz of each task
+        self.offsets = np.cumsum([0] + [len(t) for t in self.tasks]) # session sample index each task starts at, tasks are placed end to end
+        self.times = np.cumsum([0.0] + [len(t) / rate for t, rate in zip(self.tasks, self.rates)]) # session time in s each task starts at
+        self.logger.info(f"Opened {results_path}: {len(self.tasks)} tasks, {self.duration():.1f} s")
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    # task number (from 0) and sample within it of a session sample index
+    def locate(self, index):
+        task = int(np.clip(np.searchsorted(self.offsets, index, side='right') - 1, 0, max(len(self.tasks) - 1, 0)))
+        return task, index - int(self.offsets[task])
+
+    # length of the session in s
+    def duration(self):
+        return float(self.times[-1])
+
+    # session sample index at session time t in s
+    def sampleAt(self, t):
+        task = int(np.clip(np.searchsorted(self.times, t, side='right') - 1, 0, max(len(self.tasks) - 1, 0)))
+        return int(self.offsets[task]) + int(round((t - self.times[task]) * self.rates[task])) if len(self.tasks) > 0 else 0
+
+    # session time in s of session sample indices (an array or a single index)
+    def timeAt(self, index):
+        task = np.clip(np.searchsorted(self.offsets, index, side='right') - 1, 0, max(len(self.tasks) - 1, 0))
+        return self.times[task] + (index - self.offsets[task]) / self.rates[task]
+
+    # (first sample, min, max) of channel ch over session samples [start, stop), drawn from at most about max_points bins. Windows crossing tasks are joined
+    def envelope(self, ch, start, stop, max_points):
+        start, stop = max(0, start), min(len(self), stop)
+        xs, los, his = [], [], []
+        for i, task in enumerate(self.tasks):
+            a, b = max(start, self.offsets[i]), min(stop, self.offsets[i+1])
+            if a >= b:
+                continue
+            share = max(1, int(max_points * (b - a) / (stop - start)))
+            x, lo, hi = task.envelope(ch, int(a - self.offsets[i]), int(b - self.offsets[i]), share)
+            xs.append(x + self.offsets[i])
+            los.append(lo)
+            his.append(hi)
+        if len(xs) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(xs), np.concatenate(los), np.concatenate(his)
+
+    # session sample index and class of the label transitions in [start, stop)
+    def transitions(self, start, stop):
+        return self._collect(start, stop, "transition_index", "transition_label")
+
+    # session sample index and values of the IT readings in [start, stop)
+    def itReadings(self, start, stop):
+        return self._collect(start, stop, "it_index", "it_values")
+
+    def _collect(self, start, stop, index_name, value_name):
+        indices, values = [], []
+        for i, task in enumerate(self.tasks):
+            index = getattr(task, index_name) + self.offsets[i]
+            keep = (index >= start) & (index < stop)
+            indices.append(index[keep])
+            values.extend(getattr(task, value_name)[keep])
+        return (np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)), values
@@ -0,0 +1,324 @@
+# EMG display, and optionally the participant window, run in a separate process so redrawing never holds up the serial handling and recording (they share the GIL and event loop in one process)
+# The acquisition process writes the samples of every packet into a SampleRing, a block of shared memory, and the display process reads what is new at each of its own frames, so there is no message
+# per packet and nothing the display does (or fails to do) can make the acquisition wait. The ring has one writer for each part and no locks:
+#   samples - a ring of capacity samples per channel written by the acquisition, with a count of samples written stored after them. A reader copies the samples it wants then reads the count again,
+#             dropping any overwritten while it copied, so a display that falls behind by more than the ring skips ahead rather than slowing the writer
+#   sampling - the sample rate and packet length of the device and the count the sampling started at, changed when the device connects with another sampling, guarded by a generation count
+#              read before and after (a seqlock)
+#   events  - a ring of the stimulus and display commands for the display process (stim value, on, off, reset, progress, EMG shown or hidden, task started), as (type, value), written by the acquisition
+#   acks    - a ring of the perf_counter times the participant window painted each cue, written by the display process, so cue latency is measured on the display the participant sees
+# Counts are 64 bit values stored and loaded whole, and are written after the data they publish. perf_counter is the system wide monotonic clock, so its times compare across the two processes.
+# While the participant window is in the display process the engine holds each cue's label transition until its paint is reported (see Labeller), as a cue painted in process is reported at once
+# Run by DisplayServer, not directly: python SharedDisplay.py <ring name> <protocol file> <seconds> [--participant]
+
+import logging
+import os
+import subprocess
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+from PyQt5.QtCore import *
+
+from Schema import Sampling
+
+# header fields, int64
+STATE, CHANNELS, CAPACITY, WRITTEN, GENERATION, SAMPLE_RATE, PACKET_SAMPLES, SAMPLING_START, EVENTS_WRITTEN, ACKS_WRITTEN = range(10)
+HEADER_FIELDS = 16
+CLOSED, RUNNING = range(2)
+
+# events for the display process
+RESET_STIM, STIM_VAL, STIM_ON, STIM_OFF, PROGRESS, EMG_VISIBLE, TASK_STARTED = range(7)
+EVENT_SLOTS = 64
+ACK_SLOTS = 64
+
+class SampleRing:
+
+    # the shared memory block, either created (by the acquisition process) or attached to by name (by the display process)
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        offset = self.header.nbytes
+        self.events = np.ndarray((EVENT_SLOTS, 2), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset += self.events.nbytes
+        self.acks = np.ndarray((ACK_SLOTS,), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset += self.acks.nbytes
+        self.capacity = int(self.header[CAPACITY])
+        self.samples = np.ndarray((int(self.header[CHANNELS]), self.capacity), dtype=np.uint16, buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def create(cls, channels, capacity):
+        size = HEADER_FIELDS*8 + EVENT_SLOTS*2*8 + ACK_SLOTS*8 + channels*capacity*2
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[CHANNELS] = channels
+        header[CAPACITY] = capacity
+        header[STATE] = RUNNING
+        del header # no views may be left on the buffer when it is closed
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name, track=False) # Python 3.13 on, the creator alone removes the block
+        except TypeError:
+            shm = shared_memory.SharedMemory(name)
+            if os.name == "posix": # otherwise the resource tracker of this process removes the block when it exits, while the acquisition process still uses it
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def running(self):
+        return self.header[STATE] == RUNNING
+
+    # append samples (channels, n), then publish them by storing the new count
+    def write(self, samples):
+        written = int(self.header[WRITTEN])
+        n = samples.shape[1]
+        start = written % self.capacity
+        first = min(n, self.capacity - start)
+        self.samples[:, start:start+first] = samples[:, :first]
+        self.samples[:, :n-first] = samples[:, first:] # the part that wraps, if any
+        self.header[WRITTEN] = written + n
+
+    # samples written from position on, (channels, m), with the position to read from next and the number of samples skipped as they were overwritten before they were read
+    def read(self, position):
+        written = int(self.header[WRITTEN])
+        skipped = max(written - self.capacity - position, 0)
+        position += skipped
+        indices = np.arange(position, written) % self.capacity
+        samples = self.samples[:, indices] # a copy
+        overwritten = int(self.header[WRITTEN]) - self.capacity - position # while copying
+        if overwritten > 0:
+            samples = samples[:, overwritten:]
+            skipped += overwritten
+        return samples, written, skipped
+
+    def setSampling(self, sampling):
+        generation = int(self.header[GENERATION])
+        self.header[GENERATION] = generation + 1 # odd while changing
+        self.header[SAMPLE_RATE] = sampling.sample_rate
+        self.header[PACKET_SAMPLES] = sampling.samples
+        self.header[SAMPLING_START] = self.header[WRITTEN]
+        self.header[GENERATION] = generation + 2
+
+    # the Sampling of the samples from the count it started at, with the generation to compare for changes
+    def sampling(self):
+        while True:
+            generation = int(self.header[GENERATION])
+            sample_rate, samples, start = int(self.header[SAMPLE_RATE]), int(self.header[PACKET_SAMPLES]), int(self.header[SAMPLING_START])
+            if generation % 2 == 0 and int(self.header[GENERATION]) == generation:
+                return Sampling(sample_rate, int(self.header[CHANNELS]), samples), start, generation
+
+    def generation(self):
+        return int(self.header[GENERATION])
+
+    def postEvent(self, kind, value=0):
+        written = int(self.header[EVENTS_WRITTEN])
+        self.events[written % EVENT_SLOTS] = (kind, value)
+        self.header[EVENTS_WRITTEN] = written + 1
+
+    # events posted from position on as (type, value), with the position to read from next. Events overwritten before they were read are lost, logged by the caller from the count skipped
+    def readEvents(self, position):
+        written = int(self.header[EVENTS_WRITTEN])
+        skipped = max(written - EVENT_SLOTS - position, 0)
+        events = [(int(self.events[i % EVENT_SLOTS, 0]), float(self.events[i % EVENT_SLOTS, 1])) for i in range(position + skipped, written)]
+        return events, written, skipped
+
+    def postAck(self, t):
+        written = int(self.header[ACKS_WRITTEN])
+        self.acks[written % ACK_SLOTS] = t
+        self.header[ACKS_WRITTEN] = written + 1
+
+    def readAcks(self, position):
+        written = int(self.header[ACKS_WRITTEN])
+        return [float(self.acks[i % ACK_SLOTS]) for i in range(max(position, written - ACK_SLOTS), written)], written
+
+    # mark the ring closed, which tells the display process to exit, and release it. The creator removes the block
+    def close(self):
+        if self.owner:
+            self.header[STATE] = CLOSED
+        del self.header, self.events, self.acks, self.samples
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+# the acquisition side, owning the ring and the display process. Its slots take the engine's signals in place of the EMG display and participant window
+class DisplayServer(QObject):
+
+    sig_stimDisplayed = pyqtSignal(float) # signal emitted when the participant window in the display process has painted a cue, with the perf_counter time it completed
+
+    capacity = 1 << 16 # samples per channel held, 65 s at 1000 Hz
+    cue_wait = 0.2 # longest time in s the engine holds a cue's label transition waiting for its paint to be reported
+    exit_wait = 2 # seconds given to the display process to exit on close before it is killed
+
+    # protocol gives the participant window its images, seconds the EMG shown. participant also runs the participant window in the display process
+    def __init__(self, protocol, sampling, seconds, participant=False, *args, **kwargs):
+
+        super(DisplayServer, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.DisplayServer")
+
+        self.ring = SampleRing.create(sampling.channels, self.capacity)
+        self.ring.setSampling(sampling)
+        self.acks_read = 0
+        command = [sys.executable, os.path.abspath(__file__), self.ring.name, protocol.path, str(seconds)] + (["--participant"] if participant else [])
+        self.process = subprocess.Popen(command)
+        self.logger.info(f"Started display process {self.process.pid} on ring {self.ring.name} ({self.capacity} samples per channel){', with the participant window' if participant else ''}")
+
+    # slot for every EMG packet, copies its samples to the ring. Cue paints reported since the last packet are passed on first, so the engine labels the packet with them
+    def insertNewData(self, packet):
+        self.pollAcks()
+        self.ring.write(packet.samples)
+
+    def pollAcks(self):
+        acks, self.acks_read = self.ring.readAcks(self.acks_read)
+        for t in acks:
+            self.sig_stimDisplayed.emit(t)
+
+    def setSampling(self, sampling):
+        self.ring.setSampling(sampling)
+
+    def setEmgVisible(self, visible):
+        self.ring.postEvent(EMG_VISIBLE, visible)
+
+    # the display's history starts again with each task, from the samples written from now on
+    def taskStarted(self, number, name):
+        self.ring.postEvent(TASK_STARTED, int(self.ring.header[WRITTEN]))
+
+    def resetStim(self):
+        self.ring.postEvent(RESET_STIM)
+
+    def setStimVal(self, stim_val):
+        self.ring.postEvent(STIM_VAL, stim_val)
+
+    def setStimOn(self):
+        self.ring.postEvent(STIM_ON)
+
+    def setStimOff(self):
+        self.ring.postEvent(STIM_OFF)
+
+    def progressUpdate(self, value):
+        self.ring.postEvent(PROGRESS, value)
+
+    # tell the display process to exit and wait for it, then release the ring
+    def close(self):
+        self.ring.header[STATE] = CLOSED
+        try:
+            self.process.wait(self.exit_wait)
+        except subprocess.TimeoutExpired:
+            self.logger.warning(f"Display process {self.process.pid} did not exit, killing it")
+            self.process.kill()
+        self.ring.close()
+
+# the display process side, drawing the ring's samples at its own frame rate and acting on its events
+class DisplayClient(QObject):
+
+    frame_interval = 33 # ms between redraws
+    event_interval = 2 # ms between checks for events, so cues are painted within this of being made
+
+    def __init__(self, ring, protocol, seconds, participant, *args, **kwargs):
+
+        super(DisplayClient, self).__init__(*args, **kwargs)
+
+        from EMGDisplay import EMGDisplayWidget
+        from ParticipantWindow import ParticipantWindowWidget
+
+        self.logger = logging.getLogger("app_logger.DisplayClient")
+
+        self.ring = ring
+        self.parent_pid = os.getppid()
+        sampling, start, self.generation = ring.sampling()
+        self.position = max(start, int(ring.header[WRITTEN]) - ring.capacity)
+        self.events_read = int(ring.header[EVENTS_WRITTEN]) # events from before the process started are of no use
+        self.skipped = 0
+
+        self.edw = EMGDisplayWidget(sampling, seconds)
+        self.edw.setWindowFlags(Qt.WindowTitleHint | Qt.WindowMaximizeButtonHint) # closed with the program, as the participant window
+        self.edw.setWindowTitle("EMG Display")
+        self.edw.postInit()
+        self.edw.resize(800, 600)
+        self.edw.show()
+        self.pww = None
+        if participant:
+            self.pww = ParticipantWindowWidget(protocol)
+            self.pww.postInit()
+            self.pww.sdw.sig_stimDisplayed.connect(ring.postAck)
+            self.pww.showMaximized()
+
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setInterval(self.frame_interval)
+        self.frame_timer.timeout.connect(self.frame)
+        self.frame_timer.start()
+        self.event_timer = QTimer(self)
+        self.event_timer.setTimerType(Qt.PreciseTimer)
+        self.event_timer.setInterval(self.event_interval)
+        self.event_timer.timeout.connect(self.pollEvents)
+        self.event_timer.start()
+
+    # pass the display the samples written since it was last given them, returns the ring count of the first
+    def readRing(self):
+        if self.ring.generation() != self.generation:
+            sampling, start, self.generation = self.ring.sampling()
+            self.edw.setSampling(sampling)
+            self.position = max(self.position, start)
+        samples, position, skipped = self.ring.read(self.position)
+        if skipped > 0:
+            self.skipped += skipped
+            self.logger.warning(f"Display fell behind the ring, {skipped} samples skipped ({self.skipped} in total)")
+        first, self.position = position - samples.shape[1], position
+        return samples, first
+
+    # draw the samples written since the last frame
+    def frame(self):
+        samples, first = self.readRing()
+        if samples.shape[1] > 0:
+            self.edw.insertSamples(samples)
+        self.edw.displayUpdate()
+
+    # act on the events posted since the last check, and exit once the acquisition closes the ring or has gone
+    def pollEvents(self):
+        if not self.ring.running() or (os.name == "posix" and os.getppid() != self.parent_pid):
+            self.logger.info("Acquisition closed, exiting")
+            QCoreApplication.quit()
+            return
+        events, self.events_read, skipped = self.ring.readEvents(self.events_read)
+        if skipped > 0:
+            self.logger.warning(f"{skipped} display events lost")
+        for kind, value in events:
+            if kind == EMG_VISIBLE:
+                self.edw.setVisible(bool(value))
+            elif kind == TASK_STARTED: # value is the ring count the task started at, the samples already read from before it are left out of the new history
+                samples, first = self.readRing()
+                self.edw.taskStarted(0, "")
+                self.edw.insertSamples(samples[:, max(int(value) - first, 0):])
+            elif self.pww is None:
+                continue
+            elif kind == RESET_STIM:
+                self.pww.sdw.resetStim()
+            elif kind == STIM_VAL:
+                self.pww.sdw.setStimVal(int(value))
+            elif kind == STIM_ON:
+                self.pww.sdw.setStimOn()
+            elif kind == STIM_OFF:
+                self.pww.sdw.setStimOff()
+            elif kind == PROGRESS:
+                self.pww.pdw.progressUpdate(value)
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+    from Engine import startLogging
+    from Protocol import loadProtocol
+    startLogging(suffix="_display", prune=False) # a file of its own beside the program's log, which is started first and prunes the old logs
+    app = QApplication(sys.argv)
+    ring = SampleRing.attach(sys.argv[1])
+    client = DisplayClient(ring, loadProtocol(sys.argv[2]), float(sys.argv[3]), "--participant" in sys.argv)
+    app.exec_()
+    del client
+    ring.close()
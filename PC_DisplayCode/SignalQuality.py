@@ -0,0 +1,144 @@
+# Signal quality of each EMG sensor, computed from the live data and the latest impedance readings
+# QualityMonitor keeps the last second of each channel and, for every packet (or batch of packets processed together), measures over it (vectorised over both channels):
+#   CLIPPING  - fraction of samples within clip_margin of the ends of the ADC range
+#   DRIFT     - offset of the baseline (window mean) from mid-scale
+#   MAINS     - fraction of the signal power at the mains frequency and its odd harmonics
+#   FLAT      - peak to peak range so small the sensor is not picking anything up (disconnected, or stuck)
+#   IMPEDANCE - the higher AD5933 magnitude of the sensor's two electrodes
+# Each metric is divided by its threshold so 1 or more is bad. A flag is raised at 1 and cleared below hysteresis, and the score (0 to 100) falls with each metric up to its threshold.
+# Flags are saved to <task>_quality.csv whenever they change, rows are [time stamp, channel, flags, score, index of the first sample they apply to]. Flags describe the window
+# before that sample, goodSamples() reads the file back to a mask of the samples to keep for training, widening each bad segment back by the window
+
+import csv
+import logging
+import os
+from enum import IntFlag
+
+import numpy as np
+
+Quality = IntFlag('Quality', ['CLIPPING', 'DRIFT', 'MAINS', 'FLAT', 'IMPEDANCE']) # bits of the flags, 0 is good
+SENSORS = ["FCU", "ECR"] # EMG channel order, each sensor has two impedance electrodes in the same order in the IT readings
+
+class QualityMonitor:
+
+    window_seconds = 1 # length of signal measured, a whole number of seconds so mains falls exactly on a DFT bin
+    adc_max = 4095
+    clip_margin = 8 # counts from 0 or adc_max counted as clipped
+    clip_fraction = 0.01 # fraction of clipped samples flagged
+    drift_counts = 600 # baseline offset from mid-scale flagged, counts (about 0.5 V)
+    mains_frequency = 50 # Hz
+    mains_harmonics = [1, 3, 5]
+    mains_fraction = 0.2 # fraction of the power at mains flagged
+    flat_counts = 3 # peak to peak range at or below which the channel is flat
+    impedance_ohms = 100e3 # electrode impedance flagged
+    weights = np.array([0.6, 0.4, 0.5, 1.0, 0.5]) # fraction of the score lost to each metric at its threshold, in Quality order
+    hysteresis = 0.8 # a raised flag clears once its metric is below this fraction of the threshold
+    good_score = 75 # scores for the indicator colours, see qualityColour
+    fair_score = 50
+
+    def __init__(self, sample_rate, channels=2):
+        self.logger = logging.getLogger("app_logger.QualityMonitor")
+        self.channels = channels
+        self.size = int(self.window_seconds * sample_rate)
+        # DFT basis at the mains bins. The window is a ring buffer so is circularly shifted, which changes only the phase at a whole bin, so the ring can be used as it is
+        bins = [h * self.mains_frequency * self.window_seconds for h in self.mains_harmonics if h * self.mains_frequency < sample_rate / 2]
+        self.basis = np.exp(-2j * np.pi * np.outer(bins, np.arange(self.size)) / self.size)
+        self.impedance = np.zeros(channels) # highest electrode magnitude of each sensor, 0 until the first reading
+        self.reset()
+
+    # forget the signal, e.g. after the device reconnects. Flags are clear until a full window has been seen
+    def reset(self):
+        self.ring = np.zeros((self.channels, self.size))
+        self.pos = 0
+        self.filled = 0
+        self.flags = np.zeros(self.channels, dtype=np.int64)
+        self.scores = np.full(self.channels, 100.0)
+        self.ratios = np.zeros((self.channels, len(Quality)))
+
+    # latest calibrated impedance magnitudes, in the order of AcquisitionEngine.sig_impTempReady (two electrodes per sensor)
+    def setImpedance(self, imp):
+        self.impedance = np.asarray(imp, dtype=np.float64).reshape(self.channels, -1).max(axis=1)
+
+    # add a packet, or several received together, (a list of samples per channel) and measure the window ending with it. Returns the channels whose flags changed
+    def addPacket(self, data):
+        packet = np.asarray(data, dtype=np.float64)[:, -self.size:] # a batch of packets longer than the window is measured at its end
+        n = packet.shape[1]
+        split = min(n, self.size - self.pos) # written up to the end of the ring, the rest from its start
+        self.ring[:, self.pos:self.pos + split] = packet[:, :split]
+        self.ring[:, :n - split] = packet[:, split:]
+        self.pos = (self.pos + n) % self.size
+        self.filled = min(self.filled + n, self.size)
+        if self.filled < self.size:
+            return []
+
+        ratios = np.empty((self.channels, len(Quality)))
+        clipped = (self.ring <= self.clip_margin) | (self.ring >= self.adc_max - self.clip_margin)
+        ratios[:, 0] = clipped.mean(axis=1) / self.clip_fraction
+        baseline = self.ring.mean(axis=1)
+        ratios[:, 1] = np.abs(baseline - self.adc_max / 2) / self.drift_counts
+        centred = self.ring - baseline[:, None]
+        total = np.sum(centred**2, axis=1) * self.size # Parseval, the sum of |X|^2 over all bins
+        mains = 2 * np.sum(np.abs(self.basis @ centred.T)**2, axis=0) # each bin and its negative frequency
+        ratios[:, 2] = np.divide(mains, total, out=np.zeros(self.channels), where=total > 0) / self.mains_fraction
+        ratios[:, 3] = self.flat_counts / np.maximum(np.ptp(self.ring, axis=1), 0.5)
+        ratios[:, 4] = self.impedance / self.impedance_ohms
+        self.ratios = ratios
+
+        bits = 1 << np.arange(len(Quality))
+        raised = ratios >= 1
+        held = (ratios >= self.hysteresis) & ((self.flags[:, None] & bits) != 0) # flags already raised stay until clear of the threshold
+        flags = ((raised | held) * bits).sum(axis=1)
+        self.scores = 100 * np.prod(1 - self.weights * np.minimum(ratios, 1), axis=1)
+        changed = np.nonzero(flags != self.flags)[0].tolist()
+        for c in changed:
+            new = Quality(int(flags[c]) & ~int(self.flags[c]))
+            if new:
+                self.logger.warning(f"{SENSORS[c]} signal quality {self.scores[c]:.0f}: {flagNames(new)}")
+            elif flags[c] == 0:
+                self.logger.info(f"{SENSORS[c]} signal quality restored, {self.scores[c]:.0f}")
+        self.flags = flags
+        return changed
+
+# names of the flags set, e.g. "CLIPPING|MAINS"
+def flagNames(flags):
+    return "|".join(q.name for q in Quality if q & flags)
+
+# indicator colour for a score, as used in the style sheets of the displays
+def qualityColour(score, monitor=QualityMonitor):
+    if score >= monitor.good_score:
+        return "lightgreen"
+    if score >= monitor.fair_score:
+        return "orange"
+    return "red"
+
+# per sample mask of a recorded task, True for samples to keep, shape (channels, samples). Samples are excluded while any of the exclude flags is set,
+# and for margin samples before (by default the monitor's window, which the flags describe). exclude defaults to all flags. Tasks recorded without a quality file are all kept
+def goodSamples(results_path, task_file, samples, exclude=None, margin=None, sample_rate=500, channels=2):
+    exclude = (1 << len(Quality)) - 1 if exclude is None else int(exclude)
+    margin = int(QualityMonitor.window_seconds * sample_rate) if margin is None else margin
+    keep = np.ones((channels, samples), dtype=bool)
+    path = os.path.join(results_path, task_file + "_quality.csv")
+    if not os.path.exists(path):
+        return keep
+    starts = [[] for c in range(channels)]
+    ends = [[] for c in range(channels)]
+    bad_from = [None] * channels
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 5: # a partial last row of an interrupted task
+                continue
+            c, flags, index = int(row[1]), int(row[2]), int(row[4])
+            bad = (flags & exclude) != 0
+            if bad and bad_from[c] is None:
+                bad_from[c] = index
+            elif not bad and bad_from[c] is not None:
+                starts[c].append(bad_from[c])
+                ends[c].append(index)
+                bad_from[c] = None
+    for c in range(channels):
+        if bad_from[c] is not None:
+            starts[c].append(bad_from[c])
+            ends[c].append(samples)
+        for s, e in zip(starts[c], ends[c]):
+            keep[c, max(0, s - margin):min(e, samples)] = False
+    return keep
@@ -0,0 +1,583 @@
+# Simulated Arduino host, for running the program without the rig and for checking how the live pipeline copes with load
+# SimulatedDevice stands in for SerialObject on the device thread (see SerialLink.simulate): it puts EMG packets on the intake queue at speed times the real rate, and answers the commands the program sends.
+# Sensor 1 is a ramp of the sample count (mod 4096) so a recording can be checked for lost or repeated samples, sensor 2 is noise with a burst of activity every other 2 s (at x1).
+# IT readings are of electrodes following a Cole model (electrodes), or of a reference load (load) while calibrating, at the excitation frequency last set, converted to raw AD5933 values
+# through the board's calibration (calibration), so impedance sweeps and calibrations can be checked
+#
+# Running this file checks the overload policies (see Pipeline.py): a shortened first task of the protocol is recorded from the simulated device, by default at 10 times the real rate,
+# with a slow sink on the main thread for the first part of the task and then recovering, so the intake falls behind far enough to spill to disk and catches up before the task ends.
+# The check fails unless the pipeline reported each load level (BEHIND, OVERLOADED and SPILLING), display frames were skipped, packets were spilled and all read back before the task ended,
+# and the recording holds every packet delivered during the task, in order and without any lost or repeated samples. The queue depth, load levels reached and display frames skipped are reported
+# usage: python Simulator.py [protocol] [--speed <x>] [--seconds <s>] [--sink-delay <ms>] [--slow <s>] [--gui]
+#   --speed      data rate as a multiple of the real rate, default 10
+#   --seconds    length of the recorded task, default 40
+#   --sink-delay time in ms added to the handling of every packet on the main thread while slow, as a slow sink would, to force a backlog. Default 25.
+#                With 0 the pipeline is not loaded and only the recording is checked
+#   --slow       seconds from the task start the sink is slow for, default 60% of the task
+#   --gui        run the full GUI, so the display's policy is included, rather than the engine alone
+#
+# With --virtual the whole session of the protocol is instead run headless on a virtual clock (see Clock.py): the engine, its schedule and timers and the simulated device share simulated time,
+# which jumps from one timer to the next, so a session runs as fast as the data can be processed and every run is identical. The device sends a block of virtual_block seconds of packets at a time,
+# each received at the time it fell due, which the engine labels, measures and records together (signal quality is measured on the last second of each block). Each task's files are checked for:
+#   every sample delivered during the task recorded once and in order
+#   the label stream holding each rest and activation of the schedule, at the sample its offset gives, and the class column of the samples matching it
+#   an IT reading for each IT read of the schedule, saved with the first packet after the device's reply, or for tasks with it_sweep a sweep whose fit matches the simulated electrodes
+#   the catalog the engine added the task to as it completed matching one built by rescanning the files (see Catalog.py), with a repetition for each activation of the schedule
+#   the review files (see SessionStore.py) of the first task, compressed with a chunk at each second as the recorder writes them, matching those of its csv
+# and the session is run repeat times to check the files are the same each time (apart from time stamps), each run having to go at least min-speed times faster than real time
+# usage: python Simulator.py [protocol] --virtual [--tasks <first>[-<last>]] [--repeat <n>] [--sampling <rate>,<samples>] [--min-speed <x>]
+#   --tasks      task numbers to run (from 1), default all
+#   --repeat     number of runs compared, default 2
+#   --sampling   EMG sample rate in Hz and samples per packet to run at in place of the protocol's, which the simulated device is set to when it connects as the Arduino is
+#   --min-speed  session time run per second at the default sampling, below which the check fails, default 1000. The time taken goes with the number of packets,
+#                so at a sampling with more packets per second the floor is lowered in proportion. Starting up is included, so a protocol of a few minutes needs a lower floor
+# With --calibrate the simulated board is instead given its own calibration, and calibrated on a virtual clock against reference loads at every sweep frequency as from the
+# "Calibrate Impedance" control (see Calibration.py). The fitted profile is checked to reproduce the board's calibration, to be saved and read back, and to be used for the readings that follow
+# usage: python Simulator.py [protocol] --calibrate
+# With --soak the protocol's tasks are instead run again and again from the simulated device for a long time, sampling the memory, event loop lag and pipeline latency, and failing if they
+# trend upward (see Soak.py, which describes the options)
+# usage: python Simulator.py [protocol] --soak [--minutes <m>] [--speed <x>] [--interval <s>] [--warmup <m>] [--gui] [--trace] [--report <file>] [--baseline <file>]
+# The checks run in a temporary folder which is deleted afterwards, and exit with 0 if they passed
+
+import csv
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PyQt5.QtCore import *
+
+from Calibration import DEFAULT_PROFILE, loadImpedance
+from Clock import REAL_CLOCK
+from Commands import cmds
+from Pipeline import EMG_PACKET, IT_PACKET
+from Schema import DEFAULT_SAMPLING, IMP, IT_FREQUENCY, SWEEP_FREQUENCIES, TMP, Sampling, validSampling
+
+class SimulatedDevice(QObject):
+
+    sig_packetsReady = pyqtSignal() # as SerialObject
+    sig_cmdResponse = pyqtSignal(str)
+    sig_serialError = pyqtSignal()
+
+    sampling = DEFAULT_SAMPLING # EMG sampling at power up, set by OPEN as on the Arduino
+    configurable = True # False answers OPEN with a bare "HI", as firmware that cannot set its sampling
+    it_delay = 100 # ms the device takes to make an IT reading, at x1
+    electrodes = [[800, 30000, 2e-5, 0.8], [900, 25000, 1e-5, 0.75], [700, 40000, 5e-5, 0.85], [1000, 20000, 3e-5, 0.9]] # Cole model (Rinf, R0, tau, alpha) of FCU sen 1, FCU sen 2, ECR sen 1, ECR sen 2
+    serial_number = "SIMULATED" # board serial number, for its calibration
+    virtual_block = 5.0 # s of packets sent together on a virtual clock, at x1. Packets due before an IT reading or when the program drains the device are sent then
+
+    # packets are timed by clock (see Clock.py), on a virtual clock the device runs on the program's thread
+    def __init__(self, intake, speed=1, seed=0, clock=REAL_CLOCK):
+        super(SimulatedDevice, self).__init__()
+        self.logger = logging.getLogger("app_logger.SimulatedDevice")
+        self.intake = intake
+        self.speed = speed
+        self.clock = clock
+        self.rng = np.random.default_rng(seed)
+        self.sent = 0 # packets sent
+        self.samples = 0 # samples of each channel sent
+        self.running = False
+        self.timer = None
+        self.frequency = IT_FREQUENCY # AD5933 excitation frequency in Hz
+        self.calibration = DEFAULT_PROFILE # the board's true calibration, which readings are made through
+        self.load = None # ReferenceLoad connected across every electrode pair in place of the electrodes, see Calibration.py
+
+    # packets per second at x1
+    def packetRate(self):
+        return self.sampling.sample_rate / self.sampling.samples
+
+    # called on the device thread once it is running
+    def start(self):
+        self.timer = self.clock.timer()
+        self.timer.timeout.connect(self.tick)
+        self.running = True
+        self.restart()
+        self.timer.start()
+
+    # count packets due from now at the current packet rate. On a virtual clock nothing else runs between timer expiries, so packets are sent a block at a time rather than as each falls due
+    def restart(self):
+        if self.clock.threaded:
+            self.timer.setInterval(max(1, int(1000 / (self.packetRate() * self.speed) / 2)))
+        else:
+            self.timer.setInterval(max(1, int(1000 * self.virtual_block / self.speed)))
+        self.t0 = self.clock.now()
+        self.sent_before = self.sent # packets sent before t0
+
+    # may be called from any thread, the timer is stopped on the device thread at its next tick
+    def close(self):
+        self.running = False
+
+    def tick(self):
+        if not self.running:
+            self.timer.stop()
+            return
+        self.flush()
+
+    # send every packet now due, packets are counted from the start time so a late tick catches up rather than slowing the rate.
+    # On a virtual clock each is received at the time it fell due, as it would have been had it been sent then
+    def flush(self):
+        rate = self.packetRate() * self.speed
+        due = self.sent_before + int((self.clock.now() - self.t0) * rate + 1e-6) # rounding error in the clock time must not hold a packet back a tick
+        if due <= self.sent:
+            return
+        numbers = np.arange(self.sent, due)
+        times = np.full(len(numbers), self.clock.now()) if self.clock.threaded else self.t0 + (numbers - self.sent_before + 1) / rate
+        notify = self.intake.putMany(EMG_PACKET, self.packets(len(numbers)), times.tolist())
+        self.sent = due
+        if notify:
+            self.sig_packetsReady.emit()
+
+    # payloads of the next count EMG packets, samples of the two sensors alternating as big endian uint16 as sent by the Arduino
+    def packets(self, count):
+        n = self.sampling.samples
+        index = self.samples + np.arange(count * n)
+        active = (index // (2 * self.sampling.sample_rate)) % 2 == 1
+        active = np.repeat(active[::n], n) # set for each packet by its first sample
+        self.samples += count * n
+        wire = np.empty(2 * count * n, dtype='>u2')
+        wire[0::2] = index % 4096
+        wire[1::2] = np.clip(2048 + self.rng.normal(0, 1, count * n) * np.where(active, 400, 30), 0, 4095)
+        data = wire.tobytes()
+        return [data[i:i + 4 * n] for i in range(0, len(data), 4 * n)]
+
+    # callback for commands from the program, as SerialObject.sendCommand
+    def sendCommand(self, command):
+        if command[1] == cmds.OPEN:
+            if not self.configurable:
+                self.sig_cmdResponse.emit("HI")
+                return
+            argument = bytes(command[2:-2]).decode()
+            if argument != "":
+                self.setSampling(*(int(v) for v in argument.split(",")))
+            self.sig_cmdResponse.emit(f"HI:{self.sampling.sample_rate},{self.sampling.channels},{self.sampling.samples}")
+        elif command[1] == cmds.CHECK_SEN:
+            self.sig_cmdResponse.emit("Y")
+        elif command[1] == cmds.IMP_TMP:
+            self.clock.singleShot(max(1, int(self.it_delay / self.speed)), self.sendImpTemp)
+        elif cmds.SET_AD_FREQ_1 <= command[1] <= cmds.SET_AD_FREQ_8:
+            self.frequency = SWEEP_FREQUENCIES[command[1] - cmds.SET_AD_FREQ_1]
+
+    # sample at sample_rate with samples of each channel per packet, as setSampling of the Arduino. A sampling it could not keep to is ignored
+    def setSampling(self, sample_rate, samples):
+        if not validSampling(sample_rate, samples):
+            return
+        self.sampling = Sampling(sample_rate, self.sampling.channels, samples)
+        if self.running:
+            self.restart()
+
+    # an IT reading, AD5933 real and imaginary values for each sensor (signed int16, sent as unsigned) and MAX30205 temperatures about 36 C, packed as the payloads of the IMP and TMP frames.
+    # The impedance is turned back into raw values by inverting the board's calibration, with a few counts of noise
+    def sendImpTemp(self):
+        if self.running:
+            self.flush() # the EMG packets sent before the reading, which on a virtual clock may not have been sent yet
+        if self.load is not None:
+            z = np.full(4, loadImpedance(self.load, self.frequency))
+        else:
+            r_inf, r_0, tau, alpha = np.array(self.electrodes).T
+            z = r_inf + (r_0 - r_inf) / (1 + (2j * np.pi * self.frequency * tau)**alpha)
+        raw_magnitude, raw_phase = self.calibration.invert(np.abs(z), np.angle(z, deg=True), self.frequency)
+        values = np.empty(8)
+        values[0::2] = raw_magnitude * np.cos(np.deg2rad(raw_phase))
+        values[1::2] = raw_magnitude * np.sin(np.deg2rad(raw_phase))
+        imp = np.round(values + self.rng.normal(0, 2, 8)).astype(np.int16).astype(np.uint16)
+        tmp = np.round(self.rng.normal(36.0, 0.1, 2) / 0.00390625).astype(np.uint16)
+        if self.intake.put(IT_PACKET, IMP.payload.pack(*imp.tolist()) + TMP.payload.pack(*tmp.tolist()), self.clock.now()):
+            self.sig_packetsReady.emit()
+
+# the first task of the protocol cut to seconds long, the events in that time followed by the end of the task
+def shortenedTask(task, seconds):
+    from Scheduler import Phase, ScheduleEvent
+    end = int(seconds * 1000)
+    return task._replace(schedule=[e for e in task.schedule if e.offset < end] + [ScheduleEvent(end, Phase.END, 0, 1, 1)])
+
+# check a recorded task file holds every packet delivered while it ran, returns a list of problems (empty if it passed) and the samples recorded
+def checkRecording(path, packets_delivered, packet_samples):
+    ramp = np.loadtxt(path, delimiter=",", usecols=1, dtype=np.int64, ndmin=1)
+    problems = []
+    gaps = np.nonzero(np.diff(ramp) % 4096 != 1)[0]
+    if len(gaps) > 0:
+        problems.append(f"{len(gaps)} breaks in the sample sequence, first after row {gaps[0]}")
+    if len(ramp) != packets_delivered * packet_samples:
+        problems.append(f"{len(ramp)} samples recorded, {packets_delivered * packet_samples} delivered")
+    return problems, len(ramp)
+
+# check the files of a task run on a virtual clock, where every event happens exactly when scheduled. Returns a list of problems (empty if it passed) and a digest of the data for comparing runs
+def checkTask(results_path, task, packets_delivered, sample_rate, packet_samples=DEFAULT_SAMPLING.samples, it_delay=SimulatedDevice.it_delay):
+    from Scheduler import Phase
+    with open(os.path.join(results_path, task.file + ".csv"), newline='') as f:
+        rows = list(csv.reader(f))
+    with open(os.path.join(results_path, task.file + "_labels.csv"), newline='') as f:
+        transitions = [(int(row[1]), int(row[2])) for row in csv.reader(f)]
+    ramp = np.array([int(row[1]) for row in rows], dtype=np.int64)
+    labels = np.array([int(row[3]) for row in rows], dtype=np.int64)
+    it_rows = [i for i, row in enumerate(rows) if len(row) > 4 and row[4] != ""]
+    sweeps = None
+    if task.it_sweep:
+        from ImpedanceSweep import fromParameters, modelImpedance
+        sweeps, fits = [], []
+        if os.path.exists(os.path.join(results_path, task.file + "_sweep.csv")):
+            with open(os.path.join(results_path, task.file + "_sweep.csv"), newline='') as f:
+                sweeps = [int(row[1]) for row in csv.reader(f)]
+            with open(os.path.join(results_path, task.file + "_sweep_fit.csv"), newline='') as f:
+                fits = list(csv.reader(f))
+
+    problems = []
+    gaps = np.nonzero(np.diff(ramp) % 4096 != 1)[0]
+    if len(gaps) > 0:
+        problems.append(f"{len(gaps)} breaks in the sample sequence, first after row {gaps[0]}")
+    if len(ramp) != packets_delivered * packet_samples:
+        problems.append(f"{len(ramp)} samples recorded, {packets_delivered * packet_samples} delivered")
+
+    # the rest at offset 0 is labelled at the first sample taken once the task started, every other event is placed relative to it
+    cues = [e for e in task.schedule if e.phase in (Phase.REST, Phase.ACTIVE)]
+    expected = [(e.stim if e.phase == Phase.ACTIVE else 0, e.offset) for e in cues]
+    if [l for l, i in transitions] != [l for l, o in expected]:
+        problems.append(f"label stream {[l for l, i in transitions]} does not follow the schedule {[l for l, o in expected]}")
+    elif len(transitions) > 0:
+        start = transitions[0][1]
+        errors = [i - start - o * sample_rate / 1000 for (l, i), (l_e, o) in zip(transitions, expected)]
+        if max(abs(e) for e in errors) > 1:
+            problems.append(f"transitions up to {max(errors, key=abs):+.1f} samples from the schedule")
+        indices = [i for l, i in transitions]
+        pos = np.searchsorted(indices, np.arange(len(labels)), side='right') - 1
+        stream = np.where(pos >= 0, np.array([l for l, i in transitions])[np.maximum(pos, 0)], 0)
+        if not np.array_equal(stream, labels):
+            problems.append(f"{np.count_nonzero(stream != labels)} samples labelled differently from the label stream")
+        # each reading is requested at its IT read event and returned it_delay later, it is saved with the packet received next, whose samples run up to when it was returned
+        reads = [start + (e.offset + it_delay) * sample_rate / 1000 for e in task.schedule if e.phase == Phase.IT_READ]
+        if sweeps is not None:
+            # sweep readings are saved to their own file rather than with the EMG, each sweep's fit should recover the simulated electrodes
+            if len(it_rows) != 0 or sweeps != [n for n in range(1, len(reads) + 1) for f in SWEEP_FREQUENCIES]:
+                problems.append(f"{len(set(sweeps))} sweeps and {len(it_rows)} IT readings saved, {len(reads)} sweeps requested")
+            # Rinf is only loosely set by a sweep ending at 100 kHz, so the fitted curve is compared rather than the parameters
+            w = 2 * np.pi * np.array(SWEEP_FREQUENCIES)
+            for row in fits:
+                simulated = modelImpedance("cole", fromParameters("cole", [SimulatedDevice.electrodes[int(row[2])]]), w)
+                fitted = modelImpedance(row[3], fromParameters(row[3], [[float(v) for v in row[4:-1]]]), w)
+                if np.max(np.abs(fitted / simulated - 1)) > 0.05: # the noise is a few % of the smallest readings
+                    problems.append(f"sweep {row[1]} electrode {row[2]} fitted {row[3]} {row[4:-1]} is more than 5% from the simulated electrode")
+                    break
+        elif len(it_rows) != len(reads):
+            problems.append(f"{len(it_rows)} IT readings saved, {len(reads)} requested")
+        elif any(not -packet_samples <= r - t <= 1 for r, t in zip(it_rows, reads)):
+            problems.append("IT readings not saved with the first packet after they were read")
+
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(",".join(row[1:]).encode())
+    digest.update(repr(transitions).encode())
+    return problems, digest.hexdigest()
+
+# run tasks first_task to last_task of a session headless from the simulated device on a virtual clock, recorded in the working directory. Returns per task (task number, packets delivered),
+# the virtual and wall clock time taken and the sampling the engine ran at
+def runVirtual(protocol, first_task=1, last_task=None):
+    from Clock import VirtualClock
+    from Engine import AcquisitionEngine, HeadlessSession
+    clock = VirtualClock(start=0.0) # the same times every run, so they round the same way
+    engine = AcquisitionEngine(protocol, clock=clock)
+    session = HeadlessSession(engine, "1", first_task, last_task)
+    delivered = [0]
+    engine.sig_emgDataReady.connect(lambda *a: delivered.__setitem__(0, delivered[0] + 1))
+    starts, tasks, finished = {}, [], []
+    engine.sig_taskStarted.connect(lambda number, name: starts.__setitem__(number, delivered[0]))
+    engine.sig_taskEnded.connect(lambda number, completed: tasks.append((number, delivered[0] - starts[number])) if completed else None)
+    session.sig_finished.connect(lambda: finished.append(True))
+    t0, tic = clock.now(), time.perf_counter()
+    engine.start(simulate=1)
+    clock.run(stop=lambda: len(finished) > 0)
+    engine.close()
+    return tasks, clock.now() - t0, time.perf_counter() - tic, engine.sampling
+
+# check the catalog the engine kept during a virtual session against one built by rescanning its files, and that it has each activation of the tasks run. Returns a list of problems
+def checkCatalog(results_dir, protocol, numbers):
+    from Catalog import REPETITION_COLUMNS, TASK_COLUMNS, Catalog
+    live = Catalog(results_dir, protocol)
+    rescan = Catalog(results_dir, protocol, "rescan.sqlite")
+    rescan.build()
+    problems = []
+    live_tasks, rescan_tasks = live.tasks(), rescan.tasks()
+    if [row["task"] for row in live_tasks] != numbers:
+        problems.append(f"the catalog has tasks {[row['task'] for row in live_tasks]}, {numbers} were run")
+    for a, b in zip(live_tasks, rescan_tasks):
+        for column in TASK_COLUMNS:
+            if column == "started" and a[column] is not None and b[column] is not None and abs(a[column] - b[column]) < 1e-3: # the files hold ms
+                continue
+            if column != "modified" and a[column] != b[column]:
+                problems.append(f"task {a['task']} has {column} {a[column]} in the catalog, {b[column]} from its files")
+    live_repetitions, rescan_repetitions = [tuple(row) for row in live.repetitions()], [tuple(row) for row in rescan.repetitions()]
+    if live_repetitions != rescan_repetitions:
+        problems.append(f"the catalog has {len(live_repetitions)} repetitions, {len(rescan_repetitions)} from the files, differing at "
+                        f"{next((REPETITION_COLUMNS[i] for a, b in zip(live_repetitions, rescan_repetitions) for i in range(len(a)) if a[i] != b[i]), 'the end')}")
+    for number in numbers:
+        task = protocol.tasks[number-1]
+        found = len(live.repetitions("task = ?", (number,)))
+        if found != len(task.stims) * task.repetitions:
+            problems.append(f"task {number} has {found} repetitions in the catalog, {len(task.stims) * task.repetitions} were run")
+    live.close()
+    rescan.close()
+    return problems
+
+# check the review files of a task compressed as the recorder compresses it, with a chunk at each checkpoint (of any length), are those of its csv. Returns a list of problems
+def checkCompressedReview(results_path, file, sample_rate):
+    from Compression import compressCsv
+    from SessionStore import TaskRecording
+    folder = os.path.join(results_path, "compressed")
+    os.makedirs(folder, exist_ok=True)
+    shutil.copy(os.path.join(results_path, file + ".csv"), folder)
+    compressCsv(os.path.join(folder, file + ".csv"), sample_rate=sample_rate, chunk_samples=sample_rate)
+    os.remove(os.path.join(folder, file + ".csv"))
+    a, b = TaskRecording(results_path, file), TaskRecording(folder, file)
+    problems = []
+    if not np.array_equal(a.records, b.records):
+        problems.append(f"the compressed recording has {len(b)} samples differing from the {len(a)} of the csv")
+    if len(a.pyramid) != len(b.pyramid):
+        problems.append(f"the compressed recording has {len(b.pyramid)} pyramid levels, the csv {len(a.pyramid)}")
+    for k, (x, y) in enumerate(zip(a.pyramid, b.pyramid), 1):
+        if not np.array_equal(x, y):
+            problems.append(f"pyramid level {k} of the compressed recording ({len(y)} bins) differs from the csv's ({len(x)} bins)")
+    for name in ["transition_index", "transition_label", "it_index", "packet_index"]:
+        if not np.array_equal(getattr(a, name), getattr(b, name)):
+            problems.append(f"the {name} of the compressed recording differs from the csv's")
+    return problems
+
+# run the session repeat times and check each task, and that each run went at least min_speed times real time (for the default packet rate). Returns the exit code
+def virtualCheck(protocol, first_task, last_task, repeat, min_speed=1000):
+    from Engine import startLogging
+    problems, digests = [], []
+    for run in range(repeat):
+        folder = tempfile.mkdtemp(prefix="mmd_virtual_")
+        os.chdir(folder)
+        if run == 0:
+            startLogging().setLevel(logging.INFO) # the per packet debug lines time the host, which is meaningless in virtual time
+        tasks, virtual, wall, sampling = runVirtual(protocol, first_task, last_task)
+        if sampling != protocol.sampling:
+            problems.append(f"run {run+1}: the device was not set to {protocol.sampling}, it sampled with {sampling}")
+        results_path = os.path.join(folder, "Results", "PID1")
+        digests.append([])
+        for number, packets in tasks:
+            task_problems, digest = checkTask(results_path, protocol.tasks[number-1], packets, sampling.sample_rate, sampling.samples)
+            problems += [f"run {run+1} task {number}: {p}" for p in task_problems]
+            digests[-1].append(digest)
+        problems += [f"run {run+1}: {p}" for p in checkCatalog(os.path.join(folder, "Results"), protocol, [number for number, packets in tasks])]
+        if run == 0 and len(tasks) > 0:
+            problems += [f"task {tasks[0][0]} review: {p}" for p in checkCompressedReview(results_path, protocol.tasks[tasks[0][0]-1].file, sampling.sample_rate)]
+        print(f"Run {run+1}: {len(tasks)} tasks at {sampling.sample_rate} Hz, {virtual:.0f} s of session in {wall:.1f} s (x{virtual/wall:.0f})")
+        floor = min_speed * min(1, (DEFAULT_SAMPLING.sample_rate / DEFAULT_SAMPLING.samples) / (sampling.sample_rate / sampling.samples)) # packets per second at the default sampling and this one
+        if virtual / wall < floor:
+            problems.append(f"run {run+1} went x{virtual/wall:.0f}, below x{floor:.0f}")
+        os.chdir(tempfile.gettempdir())
+        shutil.rmtree(folder, ignore_errors=True)
+    expected = (last_task if last_task is not None else len(protocol.tasks)) - first_task + 1
+    if len(digests[0]) != expected:
+        problems.append(f"{len(digests[0])} tasks completed, {expected} requested")
+    if any(d != digests[0] for d in digests[1:]):
+        problems.append("the runs recorded different data")
+    print("PASS" if len(problems) == 0 else "FAIL: " + "; ".join(problems))
+    logging.shutdown()
+    return 0 if len(problems) == 0 else 1
+
+# calibrate the simulated board against DEFAULT_LOADS on a virtual clock and check the fit, returns the exit code
+def calibrationCheck(protocol):
+    from Calibration import DEFAULT_LOADS, CalibrationProfile, loadProfile
+    from Clock import VirtualClock
+    from Engine import AcquisitionEngine, startLogging
+    folder = tempfile.mkdtemp(prefix="mmd_calibration_")
+    os.chdir(folder)
+    startLogging().setLevel(logging.INFO)
+    clock = VirtualClock(start=0.0)
+    engine = AcquisitionEngine(protocol, clock=clock)
+    state = {}
+    engine.sig_sensorsReady.connect(lambda: state.__setitem__("ready", True))
+    engine.sig_impTempReady.connect(lambda reading: state.__setitem__("reading", reading))
+    engine.start(simulate=1)
+    clock.run(stop=lambda: "ready" in state)
+
+    # the board's own calibration, the default one varied for each electrode pair and frequency
+    rng = np.random.default_rng(1)
+    base_p, base_o = DEFAULT_PROFILE.polynomials[IT_FREQUENCY], DEFAULT_PROFILE.phase_offsets[IT_FREQUENCY]
+    board = CalibrationProfile(SimulatedDevice.serial_number, {f: base_p * rng.uniform(0.9, 1.1, (4, 3)) for f in SWEEP_FREQUENCIES},
+                               {f: base_o + rng.normal(0, 3, 4) for f in SWEEP_FREQUENCIES})
+    device = engine.link.serial_obj
+    device.calibration = board
+
+    tic = time.perf_counter()
+    run = engine.startCalibration(DEFAULT_LOADS, SWEEP_FREQUENCIES, 50)
+    run.sig_finished.connect(lambda profile: state.__setitem__("profile", profile))
+    for i, load in enumerate(DEFAULT_LOADS):
+        device.load = load # the operator connects the load
+        run.measure(i)
+        clock.run(stop=lambda: not run.running)
+    device.load = None
+    problems = []
+    if "profile" not in state:
+        problems.append("the calibration did not finish")
+    else:
+        profile = state["profile"]
+        engine.applyCalibration(profile)
+        # over the range of raw magnitudes the loads gave, the fitted conversion should match the board's
+        for f in SWEEP_FREQUENCIES:
+            low, high = board.invert(np.array([[DEFAULT_LOADS[0].resistance] * 4, [DEFAULT_LOADS[-1].resistance] * 4]), np.zeros((2, 4)), f)[0]
+            raw = np.linspace(low, high, 50)
+            fitted, fitted_phase = profile.convert(raw, np.zeros_like(raw), f)
+            true, true_phase = board.convert(raw, np.zeros_like(raw), f)
+            error = np.max(np.abs(fitted / true - 1))
+            if error > 0.01 or np.max(np.abs(fitted_phase - true_phase)) > 0.5:
+                problems.append(f"{f} Hz: fitted magnitudes up to {error:.2%} and phases up to {np.max(np.abs(fitted_phase - true_phase)):.2f} degrees from the board's calibration")
+        saved = loadProfile(SimulatedDevice.serial_number)
+        if saved.serial != profile.serial or any(not np.allclose(saved.polynomials[f], profile.polynomials[f]) for f in SWEEP_FREQUENCIES):
+            problems.append("the saved profile did not read back the same")
+        # a reading of the electrodes after calibrating is converted with the new profile
+        state.pop("reading", None)
+        engine.getImpAndTemp()
+        clock.run(stop=lambda: "reading" in state)
+        r_inf, r_0, tau, alpha = np.array(SimulatedDevice.electrodes).T
+        z = r_inf + (r_0 - r_inf) / (1 + (2j * np.pi * IT_FREQUENCY * tau)**alpha)
+        if "reading" not in state or np.max(np.abs(np.array(state["reading"].magnitude) / np.abs(z) - 1)) > 0.02:
+            problems.append(f"electrodes read as {state.get('reading')} after calibrating, simulated {np.abs(z)}")
+    print(f"Calibrated {len(DEFAULT_LOADS)} loads at {len(SWEEP_FREQUENCIES)} frequencies, {clock.now():.0f} s of calibration in {time.perf_counter() - tic:.1f} s")
+    print("PASS" if len(problems) == 0 else "FAIL: " + "; ".join(problems))
+    engine.close()
+    logging.shutdown()
+    os.chdir(tempfile.gettempdir())
+    shutil.rmtree(folder, ignore_errors=True)
+    return 0 if len(problems) == 0 else 1
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--calibrate" in args:
+        args.remove("--calibrate")
+        from Protocol import DEFAULT_PROTOCOL, loadProtocol
+        protocol = loadProtocol(os.path.abspath(args[0]) if len(args) > 0 else DEFAULT_PROTOCOL)
+        app = QCoreApplication(sys.argv)
+        sys.exit(calibrationCheck(protocol))
+    if "--soak" in args:
+        args.remove("--soak")
+        options = {"--minutes": "60", "--speed": "10", "--interval": "30", "--warmup": "5", "--report": None, "--baseline": None}
+        for name in list(options):
+            if name in args:
+                i = args.index(name)
+                options[name] = args[i+1]
+                del args[i:i+2]
+        flags = {name: name in args for name in ["--gui", "--trace"]}
+        args = [a for a in args if a not in flags]
+        from Protocol import DEFAULT_PROTOCOL, loadProtocol
+        from Soak import soakTest
+        protocol = loadProtocol(os.path.abspath(args[0]) if len(args) > 0 else DEFAULT_PROTOCOL)
+        sys.exit(soakTest(protocol, float(options["--minutes"]), float(options["--speed"]), float(options["--interval"]), float(options["--warmup"]), flags["--gui"], flags["--trace"], options["--report"], options["--baseline"]))
+    if "--virtual" in args:
+        args.remove("--virtual")
+        options = {"--tasks": None, "--repeat": "2", "--sampling": None, "--min-speed": "1000"}
+        for name in list(options):
+            if name in args:
+                i = args.index(name)
+                options[name] = args[i+1]
+                del args[i:i+2]
+        from Protocol import DEFAULT_PROTOCOL, loadProtocol
+        protocol = loadProtocol(os.path.abspath(args[0]) if len(args) > 0 else DEFAULT_PROTOCOL)
+        if options["--sampling"] is not None:
+            sample_rate, samples = (int(v) for v in options["--sampling"].split(","))
+            if not validSampling(sample_rate, samples):
+                print(f"{options['--sampling']} is not a sampling the device can use")
+                sys.exit(2)
+            protocol.sampling = Sampling(sample_rate, protocol.sampling.channels, samples)
+        first_task, last_task = 1, None
+        if options["--tasks"] is not None:
+            first, _, last = options["--tasks"].partition("-")
+            first_task = int(first)
+            last_task = int(last) if last else first_task
+        app = QCoreApplication(sys.argv)
+        sys.exit(virtualCheck(protocol, first_task, last_task, int(options["--repeat"]), float(options["--min-speed"])))
+
+    options = {"--speed": "10", "--seconds": "40", "--sink-delay": "25", "--slow": None}
+    for name in list(options):
+        if name in args:
+            i = args.index(name)
+            options[name] = args[i+1]
+            del args[i:i+2]
+    gui = "--gui" in args
+    if gui:
+        args.remove("--gui")
+    speed, seconds, sink_delay = float(options["--speed"]), float(options["--seconds"]), float(options["--sink-delay"]) / 1000
+    slow = float(options["--slow"]) if options["--slow"] is not None else 0.6 * seconds
+
+    from Engine import AcquisitionEngine, startLogging
+    from Protocol import DEFAULT_PROTOCOL, loadProtocol
+    protocol = loadProtocol(os.path.abspath(args[0]) if len(args) > 0 else DEFAULT_PROTOCOL)
+    protocol.tasks[0] = shortenedTask(protocol.tasks[0], seconds)
+
+    folder = tempfile.mkdtemp(prefix="mmd_check_")
+    os.chdir(folder)
+    logger = startLogging(console=True)
+    if gui:
+        from PyQt5.QtWidgets import QApplication
+        from MainWindow import MainWindow
+        app = QApplication(sys.argv)
+        window = MainWindow(protocol, simulate=speed)
+        window.show()
+        engine = window.engine
+    else:
+        app = QCoreApplication(sys.argv)
+        engine = AcquisitionEngine(protocol)
+
+    loads = {"NORMAL"}
+    counts = {}
+    delivered = [0] # EMG packets delivered to the engine, counted at the start and end of the task
+    engine.sig_emgDataReady.connect(lambda *a: delivered.__setitem__(0, delivered[0] + 1))
+    engine.sig_pipelineLoad.connect(lambda load, depth: loads.add(load))
+    slow_until = [0.0] # perf_counter time the sink recovers at
+    def slowSink(packet):
+        if time.perf_counter() < slow_until[0]:
+            time.sleep(sink_delay)
+    if sink_delay > 0:
+        engine.sig_emgLabelled.connect(slowSink) # a slow sink on the main thread
+
+    def sensorsReady():
+        if engine.results_dir is None:
+            engine.openParticipant("1")
+            QTimer.singleShot(0, engine.startNextTask)
+
+    def taskStarted(number, name):
+        counts["start"] = delivered[0]
+        slow_until[0] = time.perf_counter() + slow
+
+    def taskEnded(number, completed):
+        counts["end"] = delivered[0]
+        counts["unread"] = engine.link.intake.spilled # spilled packets not yet read back, which the recording of the task would be missing
+        QTimer.singleShot(0, app.quit)
+
+    engine.sig_sensorsReady.connect(sensorsReady)
+    engine.sig_taskStarted.connect(taskStarted)
+    engine.sig_taskEnded.connect(taskEnded)
+    QTimer.singleShot(int((seconds + 30) * 1000), app.quit) # give up if the task never ends
+    if not gui:
+        engine.start(simulate=speed)
+    app.exec_()
+    engine.close()
+
+    if "end" not in counts:
+        problems, recorded = ["the task did not finish"], 0
+    else:
+        path = os.path.join(engine.results_dir.absolutePath(), protocol.tasks[0].file + ".csv")
+        problems, recorded = checkRecording(path, counts["end"] - counts["start"], engine.sampling.samples)
+    intake = engine.link.intake
+    if sink_delay > 0: # the policies were loaded, each must have acted
+        missing = [l for l in ['BEHIND', 'OVERLOADED', 'SPILLING'] if l not in loads]
+        if len(missing) > 0:
+            problems.append(f"load levels {', '.join(missing)} never reported, the sink was not slow enough for long enough")
+        if engine.frames_skipped == 0:
+            problems.append("no display frames skipped")
+        if intake.total_spilled == 0:
+            problems.append("nothing spilled to disk")
+        elif counts.get("unread", 0) > 0:
+            problems.append(f"{counts['unread']} spilled packets not read back when the task ended")
+    print(f"x{speed:g} for {seconds:g} s, sink delay {sink_delay*1000:g} ms for {slow:g} s: {recorded} samples recorded, max queue depth {intake.max_depth} packets, {intake.total_spilled} spilled to disk")
+    print(f"Load levels reached: {', '.join(l for l in ['NORMAL', 'BEHIND', 'OVERLOADED', 'SPILLING'] if l in loads)}. Display frames drawn {engine.frames_drawn}, skipped {engine.frames_skipped}")
+    print("PASS" if len(problems) == 0 else "FAIL: " + "; ".join(problems))
+    logging.shutdown()
+    os.chdir(tempfile.gettempdir())
+    shutil.rmtree(folder, ignore_errors=True)
+    sys.exit(0 if len(problems) == 0 else 1)
@@ -0,0 +1,422 @@
+# Soak test, runs the program against the simulated device (see Simulator.py) for hours as a day of participant sessions would, to catch growth that only shows late:
+# memory held by lists that are never trimmed, a backlog building in the Qt event queue, or the per packet writes slowing as the files grow.
+# The protocol's tasks are run back to back, with a new participant each time all are done. Each task's recording is checked to hold every packet delivered during it and then deleted, so the disk does not fill
+# Every interval a sample is taken of:
+#   the resident memory of the process, with --trace the memory traced by tracemalloc and the lines that allocated most since the warm up, and the objects tracked by the garbage collector
+#   the garbage collections of each generation and the time spent in them
+#   the event loop lag, how late a timer due every lag_interval fires
+#   the latency of each stage of the pipeline from the packet being read by the device thread: queued (delivered to the main thread), recorded (labelled and written to the task file)
+#   and displayed (the display frame that draws it), and the depth of the intake queue
+# After the warm up the trend of the resident memory (the traced memory while tracing) and of each interval's p99 latency is fitted (the median of the slopes between every pair of samples, so one slow interval is not a trend),
+# and the test fails if either rises by more per hour than the limits of SoakMonitor. Tracing is left off by default, as it slows the program several times over and taking its snapshots
+# holds up the event loop: with --trace the latencies are reported but not checked, so a traced run is for finding where a leak found by an untraced run allocates. A compact report is written as json, and given the report of an earlier version the two are compared
+# usage: python Simulator.py [protocol] --soak [--minutes <m>] [--speed <x>] [--interval <s>] [--warmup <m>] [--gui] [--trace] [--report <file>] [--baseline <file>]
+#   --minutes  length of the test, default 60
+#   --speed    data rate as a multiple of the real rate, default 10. The task schedules run in real time
+#   --interval seconds between samples, default 30
+#   --warmup   minutes at the start left out of the trends, default 5. It is lengthened to cover the protocol's longest task, as the buffers of a task grow until it ends,
+#              and the test is lengthened to at least twice the warm up
+#   --gui      run the full GUI, so the displays are included, rather than the engine alone
+#   --trace    turn tracemalloc on, to report the lines allocating most. The latency trends are then not checked or compared with the baseline
+#   --report   file the report is written to, default soak_<date time>.json in the working directory
+#   --baseline report of an earlier run to compare with, a p99 latency more than baseline_tolerance worse fails the test. Latencies are compared between runs at the same speed and settings,
+#              both without tracing
+# The test runs in a temporary folder which is deleted afterwards, and exits with 0 if it passed
+
+import gc
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PyQt5.QtCore import *
+
+STAGES = ["queued", "recorded", "displayed"] # stages of the pipeline timed from the packet being read
+
+# resident memory of the process in bytes, from psutil (see requirements.txt) or /proc where it is not installed
+def residentMemory():
+    try:
+        import psutil
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return psutil.Process().memory_info().rss
+
+# trend of y against t per unit of t, the median of the slopes between every pair of points so a few outliers do not make one
+def trend(t, y):
+    if len(t) < 2:
+        return 0.0
+    t, y = np.asarray(t, dtype=float), np.asarray(y, dtype=float)
+    i, j = np.triu_indices(len(t), 1)
+    return float(np.median((y[j] - y[i]) / (t[j] - t[i])))
+
+# count of times in s in log spaced bins from low up, so percentiles of any number of packets are kept in a fixed amount of memory. Percentiles are to within a bin (about 5%)
+class LatencyHistogram:
+
+    low = 1e-5 # s, times below this are counted in the first bin
+    bins_per_decade = 50
+    decades = 7 # up to 100 s, times above are counted in the last bin
+
+    def __init__(self):
+        self.bins = self.decades * self.bins_per_decade + 2
+        self.counts = [0] * self.bins
+        self.n = 0
+        self.max = 0.0
+
+    def add(self, t):
+        i = 0 if t < self.low else min(self.bins - 1, 1 + int(math.log10(t / self.low) * self.bins_per_decade))
+        self.counts[i] += 1
+        self.n += 1
+        self.max = max(self.max, t)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.max = max(self.max, other.max)
+
+    # the upper edge of the bin holding the q th percentile, in ms. None if nothing was counted
+    def percentile(self, q):
+        if self.n == 0:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.n))
+        return round(min(self.low * 10**(i / self.bins_per_decade), self.max) * 1000, 3)
+
+    def summary(self):
+        return {"p50": self.percentile(50), "p99": self.percentile(99), "max": round(self.max * 1000, 3) if self.n > 0 else None}
+
+# runs the protocol's tasks back to back until stopped, a new participant each time all are done. Each task's files are checked once it ends and then deleted
+class SoakSession(QObject):
+
+    gap = 1 # s between tasks
+
+    def __init__(self, engine, *args, **kwargs):
+
+        super(SoakSession, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.SoakSession")
+
+        self.engine = engine
+        self.participants = 0
+        self.tasks = 0 # tasks completed
+        self.problems = []
+        self.delivered = 0 # EMG packets delivered to the engine
+        self.task_start = 0 # delivered when the task started
+        self.stopped = False
+
+        self.next_timer = QTimer()
+        self.next_timer.setSingleShot(True)
+        self.next_timer.timeout.connect(self.startNext)
+
+        engine.sig_sensorsReady.connect(self.sensorsReady)
+        engine.sig_emgDataReady.connect(self.packetDelivered)
+        engine.sig_taskStarted.connect(self.taskStarted)
+        engine.sig_taskEnded.connect(self.taskEnded)
+
+    def sensorsReady(self):
+        if self.engine.results_dir is None:
+            self.nextParticipant()
+        self.next_timer.start(0)
+
+    def packetDelivered(self, packet):
+        self.delivered += 1
+
+    # close the last participant's session and delete its folder, then open the next
+    def nextParticipant(self):
+        if self.engine.results_dir is not None:
+            self.engine.journal.close()
+            shutil.rmtree(self.engine.results_dir.absolutePath(), ignore_errors=True)
+        self.participants += 1
+        self.engine.openParticipant(str(self.participants))
+
+    def taskStarted(self, number, name):
+        self.task_start = self.delivered
+
+    # count the rows of the task file rather than parsing it, which would hold up the packets arriving meanwhile. The sample sequence is checked by Simulator.py
+    def taskEnded(self, number, completed):
+        if not completed:
+            return
+        path = self.engine.results_dir.absolutePath()
+        file = self.engine.protocol.tasks[number-1].file
+        rows = 0
+        with open(os.path.join(path, file + ".csv"), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                rows += chunk.count(b"\n")
+        expected = (self.delivered - self.task_start) * self.engine.sampling.samples
+        if rows != expected:
+            self.problems.append(f"participant {self.participants} task {number}: {rows} samples recorded, {expected} delivered")
+        for name in os.listdir(path):
+            if os.path.splitext(name)[0] == file or name.startswith(file + "_"):
+                os.remove(os.path.join(path, name))
+        self.tasks += 1
+        self.next_timer.start(int(self.gap * 1000))
+
+    def startNext(self):
+        if self.stopped or self.engine.in_task:
+            return
+        if not self.engine.tasksRemaining():
+            self.nextParticipant()
+        self.engine.startNextTask()
+
+    # abandon any running task, at the end of the test
+    def stop(self):
+        self.stopped = True
+        self.next_timer.stop()
+        self.engine.reset()
+
+# samples the memory, garbage collection, event loop lag and pipeline latency of the program while it runs, and reports their trends
+class SoakMonitor(QObject):
+
+    sig_finished = pyqtSignal() # signal emitted when the test has run for its length
+
+    lag_interval = 20 # ms between the ticks of the timer the event loop lag is measured from
+    rss_limit = 10.0 # MB per hour the memory may rise by after the warm up, the resident memory or while tracing the traced memory
+    rss_min_rise = 5.0 # MB the fitted rise over the test must also reach to fail, so a short test is not failed by the allocator settling
+    latency_rise = 0.5 # fraction of its median that the fitted rise of a stage's p99 latency over the test may reach
+    latency_min_rise = 5.0 # ms the fitted rise must also reach to fail, as the p99 of a single interval varies by a few ms with the machine's other work
+    baseline_tolerance = 0.5 # fraction by which a p99 latency may exceed the baseline's, ignoring differences under 1 ms
+    top_allocators = 10 # lines reported that allocated most since the warm up
+    trace_frames = 1 # frames of each allocation traced, more attributes allocations to their callers at a higher cost
+
+    # trace, if True, turns tracemalloc on. Tracing every allocation slows the program, so the latencies are only checked with it off
+    def __init__(self, engine, seconds, interval, warmup, trace=False, *args, **kwargs):
+
+        super(SoakMonitor, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.SoakMonitor")
+
+        self.engine = engine
+        self.seconds = seconds
+        self.warmup = warmup # s
+        self.trace = trace
+        self.samples = [] # one row per interval
+        self.latency = {stage: LatencyHistogram() for stage in STAGES} # this interval's
+        self.total_latency = {stage: LatencyHistogram() for stage in STAGES} # since the warm up
+        self.lag = LatencyHistogram()
+        self.total_lag = LatencyHistogram()
+        self.newest = None # receive time of the newest packet recorded since the last display frame
+        self.resume = 0.0 # packets read before this time were held up by the last sample being taken, and are not timed
+        self.packets = 0
+        self.gc_collections = [0, 0, 0]
+        self.gc_time = 0.0 # s spent collecting
+        self.gc_start = None
+        self.baseline_snapshot = None # tracemalloc snapshot at the end of the warm up
+        self.allocators = []
+
+        engine.sig_emgDataReady.connect(self.packetQueued)
+        engine.sig_emgLabelled.connect(self.packetRecorded)
+        engine.sig_displayFrame.connect(self.frameDrawn) # connected after the displays, so the frame is timed once they have redrawn
+
+        self.lag_timer = QTimer()
+        self.lag_timer.setTimerType(Qt.PreciseTimer)
+        self.lag_timer.setInterval(self.lag_interval)
+        self.lag_timer.timeout.connect(self.lagTick)
+        self.sample_timer = QTimer()
+        self.sample_timer.setInterval(int(interval * 1000))
+        self.sample_timer.timeout.connect(self.sample)
+
+    def start(self):
+        if self.trace:
+            tracemalloc.start(self.trace_frames)
+        gc.callbacks.append(self.gcPhase)
+        self.t0 = self.last_tick = time.perf_counter()
+        self.lag_timer.start()
+        self.sample_timer.start()
+
+    def stop(self):
+        self.lag_timer.stop()
+        self.sample_timer.stop()
+        gc.callbacks.remove(self.gcPhase)
+        if self.trace:
+            tracemalloc.stop()
+
+    def gcPhase(self, phase, info):
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.gc_time += time.perf_counter() - self.gc_start
+            self.gc_collections[info["generation"]] += 1
+
+    def packetQueued(self, packet):
+        if packet.recv_time >= self.resume:
+            self.latency["queued"].add(time.perf_counter() - packet.recv_time)
+
+    def packetRecorded(self, packet):
+        self.packets += 1
+        if packet.recv_time >= self.resume:
+            self.latency["recorded"].add(time.perf_counter() - packet.recv_time)
+            self.newest = packet.recv_time
+
+    def frameDrawn(self):
+        if self.newest is not None:
+            self.latency["displayed"].add(time.perf_counter() - self.newest)
+            self.newest = None
+
+    def lagTick(self):
+        now = time.perf_counter()
+        self.lag.add(max(0.0, now - self.last_tick - self.lag_interval / 1000))
+        self.last_tick = now
+
+    # take a sample of this interval, and check the trends once the test has run its length
+    def sample(self):
+        tic = time.perf_counter()
+        elapsed = tic - self.t0
+        row = {"t": round(elapsed, 1), "rss_mb": round(residentMemory() / 2**20, 2), "traced_mb": round(tracemalloc.get_traced_memory()[0] / 2**20, 2) if self.trace else None, "objects": len(gc.get_objects()),
+               "gc": list(self.gc_collections), "gc_ms": round(self.gc_time * 1000, 1), "depth": self.engine.link.intake.depth(), "packets": self.packets,
+               "lag_p99_ms": self.lag.percentile(99), "lag_max_ms": round(self.lag.max * 1000, 3)}
+        for stage in STAGES:
+            row[stage + "_p99_ms"] = self.latency[stage].percentile(99)
+        # the lines that allocated most since the warm up, compared by line so the snapshot stays small
+        if self.trace and elapsed >= self.warmup:
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+            if self.baseline_snapshot is None:
+                self.baseline_snapshot = snapshot
+            else:
+                growth = sorted(snapshot.compare_to(self.baseline_snapshot, 'lineno'), key=lambda s: s.size_diff, reverse=True)[:self.top_allocators]
+                self.allocators = [{"where": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}", "kb": round(s.size_diff / 1024, 1), "blocks": s.count_diff} for s in growth if s.size_diff > 0]
+                row["top"] = [f"{a['where']} +{a['kb']:g} KB" for a in self.allocators[:3]]
+        if elapsed >= self.warmup:
+            for stage in STAGES:
+                self.total_latency[stage].merge(self.latency[stage])
+            self.total_lag.merge(self.lag)
+        self.samples.append(row)
+        latencies = ", ".join(f"{stage} {row[stage + '_p99_ms']} ms" for stage in STAGES)
+        self.logger.info(f"Soak {elapsed/60:.1f} min: {row['rss_mb']} MB resident, {row['traced_mb']} MB traced, {row['objects']} objects, queue depth {row['depth']}, "
+                         f"p99 latency {latencies}, loop lag p99 {row['lag_p99_ms']} ms")
+        self.latency = {stage: LatencyHistogram() for stage in STAGES}
+        self.lag = LatencyHistogram()
+        self.resume = self.last_tick = time.perf_counter() # the time taken sampling is not lag or latency of the program
+        if elapsed >= self.seconds:
+            self.sig_finished.emit()
+
+    # the trends and totals since the warm up, and the problems found. Trends are per hour of the test, and a trend fails once the rise it gives over the test passes the limits
+    def report(self):
+        after = [row for row in self.samples if row["t"] >= self.warmup]
+        hours = [row["t"] / 3600 for row in after]
+        span = hours[-1] - hours[0] if len(after) > 0 else 0.0
+        problems = []
+        if len(after) < 3:
+            problems.append(f"only {len(after)} samples after the warm up, too few to fit a trend")
+        rss_trend = trend(hours, [row["rss_mb"] for row in after])
+        traced_trend = trend(hours, [row["traced_mb"] for row in after]) if self.trace else None
+        # tracemalloc's own tables and snapshots grow the resident memory, so while tracing the memory it traces is checked instead
+        memory_trend = traced_trend if self.trace else rss_trend
+        if memory_trend > self.rss_limit and memory_trend * span > self.rss_min_rise:
+            problems.append(f"{'traced' if self.trace else 'resident'} memory rising {memory_trend:.1f} MB per hour, the limit is {self.rss_limit:g}")
+        latency_trend = {}
+        for stage in STAGES:
+            points = [(h, row[stage + "_p99_ms"]) for h, row in zip(hours, after) if row[stage + "_p99_ms"] is not None]
+            latency_trend[stage] = round(trend(*zip(*points)), 3) if len(points) > 1 else 0.0
+            if not self.trace and len(points) > 1 and latency_trend[stage] * span > max(self.latency_min_rise, self.latency_rise * np.median([p for h, p in points])):
+                problems.append(f"p99 {stage} latency rising {latency_trend[stage]:.1f} ms per hour, {latency_trend[stage] * span:.1f} ms over the test")
+        first, last = (after[0], after[-1]) if len(after) > 0 else ({}, {})
+        summary = {"rss_mb": [first.get("rss_mb"), last.get("rss_mb")], "rss_trend_mb_per_hour": round(rss_trend, 2),
+                   "traced_mb": [first.get("traced_mb"), last.get("traced_mb")],
+                   "traced_trend_mb_per_hour": round(traced_trend, 2) if self.trace else None,
+                   "objects": [first.get("objects"), last.get("objects")], "objects_trend_per_hour": round(trend(hours, [row["objects"] for row in after])),
+                   "latency_ms": {stage: self.total_latency[stage].summary() for stage in STAGES}, "latency_trend_ms_per_hour": latency_trend,
+                   "lag_ms": self.total_lag.summary(), "gc_collections": self.gc_collections, "gc_ms": round(self.gc_time * 1000, 1),
+                   "packets": self.packets, "max_queue_depth": self.engine.link.intake.max_depth, "spilled": self.engine.link.intake.total_spilled,
+                   "frames_drawn": self.engine.frames_drawn, "frames_skipped": self.engine.frames_skipped}
+        return summary, problems
+
+# compare a report with an earlier one, returns lines describing the differences and the regressions beyond the tolerance.
+# Latencies are only compared between runs at the same speed and gui setting, both without tracing
+def compareReports(report, baseline):
+    lines, problems = [], []
+    new, old = report["summary"], baseline["summary"]
+    if report["trace"] or baseline["trace"]:
+        lines.append(f"latencies not compared, {'this run' if report['trace'] else 'the baseline'} traced allocations")
+    elif (report["speed"], report["gui"]) != (baseline["speed"], baseline["gui"]):
+        lines.append(f"latencies not compared, the baseline ran at x{baseline['speed']:g} with gui {baseline['gui']}")
+    else:
+        for name in STAGES + ["lag"]:
+            new_p99 = (new["lag_ms"] if name == "lag" else new["latency_ms"][name])["p99"]
+            old_p99 = (old["lag_ms"] if name == "lag" else old["latency_ms"][name])["p99"]
+            if new_p99 is None or old_p99 is None:
+                continue
+            lines.append(f"p99 {name}: {new_p99:g} ms, baseline {old_p99:g} ms")
+            if new_p99 > old_p99 * (1 + SoakMonitor.baseline_tolerance) and new_p99 - old_p99 > 1:
+                problems.append(f"p99 {name} latency {new_p99:g} ms, {new_p99/old_p99 - 1:.0%} above the baseline")
+    lines.append(f"resident memory trend: {new['rss_trend_mb_per_hour']:+g} MB per hour, baseline {old['rss_trend_mb_per_hour']:+g}")
+    lines.append(f"objects trend: {new['objects_trend_per_hour']:+g} per hour, baseline {old['objects_trend_per_hour']:+g}")
+    return lines, problems
+
+# run the soak test, returns the exit code
+def soakTest(protocol, minutes=60, speed=10, interval=30, warmup=5, gui=False, trace=False, report_path=None, baseline_path=None):
+    from Engine import AcquisitionEngine, startLogging
+    report_path = os.path.abspath(report_path if report_path is not None else time.strftime("soak_%Y-%m-%d_%H-%M-%S.json"))
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix="mmd_soak_")
+    os.chdir(folder)
+    startLogging().setLevel(logging.INFO) # the per packet debug lines would grow the log by GB over hours
+    if gui:
+        from PyQt5.QtWidgets import QApplication
+        from MainWindow import MainWindow
+        app = QApplication([])
+        window = MainWindow(protocol, simulate=speed)
+        window.show()
+        engine = window.engine
+    else:
+        app = QCoreApplication([])
+        engine = AcquisitionEngine(protocol)
+
+    # the warm up covers the longest task, as the display and recording buffers grow through a task and are reused by the next
+    warmup = max(warmup, (max(task.schedule[-1].offset for task in protocol.tasks) / 1000 + SoakSession.gap + interval) / 60)
+    minutes = max(minutes, 2 * warmup)
+    session = SoakSession(engine)
+    monitor = SoakMonitor(engine, minutes * 60, interval, warmup * 60, trace)
+    monitor.sig_finished.connect(app.quit)
+    monitor.start()
+    if not gui:
+        engine.start(simulate=speed)
+    print(f"Soak test for {minutes:.1f} min at x{speed:g}{' with the GUI' if gui else ''}{', latencies not checked while tracing' if trace else ''}, {warmup:.1f} min warm up, report to {report_path}")
+    app.exec_()
+    monitor.stop()
+    session.stop()
+    engine.close()
+    time.sleep(0.1) # leave time for the device to stop
+    if engine.link.serial_thread is not None:
+        engine.link.serial_thread.quit()
+        engine.link.serial_thread.wait()
+
+    summary, problems = monitor.report()
+    problems = session.problems + problems
+    if session.tasks == 0:
+        problems.append("no task completed")
+    summary.update(tasks=session.tasks, participants=session.participants)
+    report = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "protocol": protocol.name, "sampling": list(engine.sampling), "minutes": minutes, "speed": speed, "interval": interval,
+              "warmup": monitor.warmup / 60, "gui": gui, "trace": trace, "python": platform.python_version(), "passed": True, "problems": [],
+              "summary": summary, "top_allocators": monitor.allocators, "samples": monitor.samples}
+    comparison = []
+    if baseline is not None:
+        comparison, regressions = compareReports(report, baseline)
+        problems += regressions
+    report.update(passed=len(problems) == 0, problems=problems)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    latency = summary["latency_ms"]
+    print(f"{session.tasks} tasks of {session.participants} participants, {summary['packets']} packets, max queue depth {summary['max_queue_depth']}, display frames skipped {summary['frames_skipped']}")
+    print(f"Resident memory {summary['rss_mb']} MB ({summary['rss_trend_mb_per_hour']:+g} MB per hour)" + (f", traced {summary['traced_mb']} MB ({summary['traced_trend_mb_per_hour']:+g} MB per hour)" if trace else "")
+          + f", objects {summary['objects']} ({summary['objects_trend_per_hour']:+g} per hour)")
+    print("p99 latency " + ", ".join(f"{s} {latency[s]['p99']} ms ({summary['latency_trend_ms_per_hour'][s]:+g} per hour)" for s in STAGES) + f", loop lag {summary['lag_ms']['p99']} ms")
+    print(f"Garbage collections {summary['gc_collections']} taking {summary['gc_ms']:g} ms")
+    for a in monitor.allocators[:5]:
+        print(f"  {a['where']} +{a['kb']:g} KB in {a['blocks']} blocks")
+    for line in comparison:
+        print(line)
+    print("PASS" if len(problems) == 0 else "FAIL: " + "; ".join(problems))
+    logging.shutdown()
+    os.chdir(cwd)
+    shutil.rmtree(folder, ignore_errors=True)
+    return 0 if len(problems) == 0 else 1
@@ -0,0 +1,199 @@
+# Widget to show the spectral content of the EMG live, a scrolling spectrogram of each sensor and the power spectral density (PSD) of the last few seconds with the median frequency,
+# which falls with muscle fatigue during the activations, and shows mains pickup or a poor electrode as power away from the EMG band
+#
+# The spectrogram is an incremental short time Fourier transform (STFT): incoming samples are appended to a buffer and every hop samples a new column is computed over the last segment samples,
+# for all channels in one vectorised FFT. The window, buffers and tiles are allocated once and reused, only the new columns are computed.
+# Each spectrogram is drawn as a row of image tiles of tile_columns columns, only the tile receiving new columns is updated at a display frame (see AcquisitionEngine.sig_displayFrame),
+# tiles that have scrolled out of the history are moved to the front and reused, so drawing costs the same however long the history is.
+# Columns are computed as packets arrive, drawing is skipped like the EMG display's when frames are skipped, and while the widget is hidden
+
+import logging
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import pyqtgraph as pg
+
+from SignalQuality import SENSORS
+
+class SpectrumDisplayWidget(QWidget):
+
+    segment = 256 # samples per STFT column, 0.512 s at 500 Hz giving 1.95 Hz resolution
+    hop = 50 # samples between columns, 0.1 s at 500 Hz (80% overlap)
+    history_seconds = 10 # length of spectrogram shown
+    tile_columns = 10 # columns per image tile
+    psd_seconds = 2 # PSD averaged over the columns of this many seconds
+    band = (20, 250) # Hz, range the median frequency is measured over
+    levels = (-10, 40) # dB range of the spectrogram colours, power density in counts^2/Hz
+    colours = [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)] # viridis, low to high
+
+    def __init__(self, sample_rate, channels=2, *args, **kwargs):
+
+        super(SpectrumDisplayWidget, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.SpectrumDisplayWidget")
+
+        self.channels = channels
+        self.window = np.hanning(self.segment)
+        self.frames = np.zeros((channels, 1, self.segment)) # windowed frames, grown if more columns are due at once
+
+        self.logger.info("Setting up widgets.")
+        self.lut = pg.ColorMap(np.linspace(0, 1, len(self.colours)), [c + (255,) for c in self.colours]).getLookupTable(0, 1, 256)
+        self.graphs = []
+        self.images = [[] for c in range(channels)] # per channel, one ImageItem per tile, made for the sample rate
+        for c in range(channels):
+            graph = pg.PlotWidget()
+            graph.setLabel('left', SENSORS[c] if c < len(SENSORS) else f"Sensor {c+1}", units='Hz')
+            graph.enableAutoRange(x=False)
+            graph.setMouseEnabled(x=False, y=False)
+            self.graphs.append(graph)
+
+        self.psd_graph = pg.PlotWidget()
+        self.psd_graph.setLabel('bottom', "Frequency", units='Hz')
+        self.psd_graph.setLabel('left', "PSD", units='dB')
+        self.psd_graph.addLegend()
+        self.psd_curves = [self.psd_graph.plot(pen=pg.intColor(c, channels), name=SENSORS[c] if c < len(SENSORS) else f"Sensor {c+1}") for c in range(channels)]
+        self.lmf = QLabel("Median Frequency:")
+
+        self.logger.info("Setting up layout.")
+        layout = QVBoxLayout()
+        for graph in self.graphs:
+            layout.addWidget(graph)
+        layout.addWidget(self.psd_graph)
+        layout.addWidget(self.lmf)
+        self.setLayout(layout)
+
+        self.logger.info("Finalising.")
+        self.setSampleRate(sample_rate)
+
+        sp = QSizePolicy()
+        sp.setRetainSizeWhenHidden(False)
+        self.setSizePolicy(sp)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+
+    # set up the frequencies, buffers and tiles for a sample rate, called again when the device connects at another rate. The segment and hop stay the same number of samples
+    def setSampleRate(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.freqs = np.fft.rfftfreq(self.segment, 1 / sample_rate)
+        # one sided power spectral density scaling, the bins other than DC and Nyquist hold the power of their negative frequency too
+        self.scale = np.full(len(self.freqs), 2 / (sample_rate * np.sum(self.window**2)))
+        self.scale[0] /= 2
+        self.scale[-1] /= 2
+        self.in_band = (self.freqs >= self.band[0]) & (self.freqs <= min(self.band[1], sample_rate / 2))
+        self.num_tiles = int(np.ceil(self.history_seconds * sample_rate / self.hop / self.tile_columns)) + 1 # one more than the history so the tile being filled is off the left edge when reused
+        self.psd_columns = int(self.psd_seconds * sample_rate / self.hop)
+
+        # data storage, reused until the rate changes
+        self.buffer = np.zeros((self.channels, self.segment + 4 * self.hop)) # samples not yet used by a column, and the overlap of the next
+        self.tiles = np.zeros((self.channels, self.num_tiles, self.tile_columns, len(self.freqs)), dtype=np.float32) # dB, [x, y] as ImageItem expects
+        self.psd_ring = np.zeros((self.psd_columns, self.channels, len(self.freqs))) # power of the last psd_columns columns, and their sum
+
+        for graph, images in zip(self.graphs, self.images):
+            graph.setYRange(0, sample_rate / 2, padding=0)
+            while len(images) > self.num_tiles:
+                graph.removeItem(images.pop())
+            while len(images) < self.num_tiles:
+                image = pg.ImageItem()
+                image.setLookupTable(self.lut)
+                graph.addItem(image)
+                images.append(image)
+        self.psd_graph.setXRange(0, sample_rate / 2, padding=0)
+        self.displayClear()
+
+    # the device connected with another EMG Sampling (see Schema.py)
+    def setSampling(self, sampling):
+        if sampling.sample_rate != self.sample_rate:
+            self.setSampleRate(sampling.sample_rate)
+
+    def postInit(self):
+        pass
+
+    # the device reconnected, start the spectrogram again from the new data
+    def resetSoftware(self):
+        self.displayClear()
+
+    def sensorsReady(self):
+        pass
+
+    # wipes the spectrogram and PSD
+    def displayClear(self):
+        self.fill = 0 # samples in the buffer
+        self.columns = 0 # columns computed
+        self.drawn = 0 # columns drawn
+        self.tiles[...] = self.levels[0]
+        self.psd_ring[...] = 0
+        self.psd_sum = np.zeros((self.channels, len(self.freqs)))
+        self.dirty = set() # tiles with columns not yet drawn
+        for images in self.images:
+            for t, image in enumerate(images):
+                self.placeTile(image, t - self.num_tiles)
+                image.setImage(self.tiles[0, 0], autoLevels=False, levels=self.levels)
+        for curve in self.psd_curves:
+            curve.setData([], [])
+
+    # position a tile's image for the columns starting at tile number n (which may be negative, before the first column)
+    def placeTile(self, image, n):
+        dt = self.hop / self.sample_rate
+        first = n * self.tile_columns # column number, column k covers the segment ending at sample k * hop + segment
+        image.setRect(QRectF((first * self.hop + self.segment) / self.sample_rate - dt, 0, self.tile_columns * dt, self.sample_rate / 2))
+
+    # called on receipt of new data, an EMGPacket (see Packets.py). Computes the columns now due, drawing waits for the next display frame
+    def insertNewData(self, packet):
+        n = packet.samples.shape[1]
+        if self.fill + n > self.buffer.shape[1]:
+            self.buffer = np.concatenate([self.buffer, np.zeros((self.channels, self.fill + n - self.buffer.shape[1]))], axis=1)
+        self.buffer[:, self.fill:self.fill + n] = packet.samples
+        self.fill += n
+        if self.fill < self.segment:
+            return
+
+        count = (self.fill - self.segment) // self.hop + 1 # columns due
+        if self.frames.shape[1] < count:
+            self.frames = np.zeros((self.channels, count, self.segment))
+        frames = self.frames[:, :count]
+        raw = sliding_window_view(self.buffer[:, :self.fill], self.segment, axis=1)[:, ::self.hop][:, :count] # views of the buffer, not copies
+        np.subtract(raw, raw.mean(axis=2, keepdims=True), out=frames) # remove each frame's offset so the ADC mid-scale does not leak into the low bins
+        frames *= self.window
+        power = np.abs(np.fft.rfft(frames, axis=2))**2 * self.scale # (channels, count, bins)
+
+        used = count * self.hop
+        self.buffer[:, :self.fill - used] = self.buffer[:, used:self.fill].copy() # keep the overlap for the next column
+        self.fill -= used
+
+        db = 10 * np.log10(power + 1e-12)
+        for k in range(count):
+            column = self.columns + k
+            tile = (column // self.tile_columns) % self.num_tiles
+            self.tiles[:, tile, column % self.tile_columns] = db[:, k]
+            self.dirty.add(tile)
+            ring = column % self.psd_columns
+            self.psd_sum += power[:, k] - self.psd_ring[ring]
+            self.psd_ring[ring] = power[:, k]
+        self.columns += count
+
+    # draw the columns computed since the last frame. Only the tiles they fall in are updated, the rest of the spectrogram is scrolled
+    def displayUpdate(self):
+        if not self.isVisible() or self.columns == self.drawn:
+            return
+        for tile in self.dirty:
+            n = (self.columns - 1) // self.tile_columns
+            n -= (n - tile) % self.num_tiles # the latest tile number stored in this slot
+            for c in range(self.channels):
+                image = self.images[c][tile]
+                image.setImage(self.tiles[c, tile], autoLevels=False, levels=self.levels)
+                self.placeTile(image, n)
+        self.dirty.clear()
+        self.drawn = self.columns
+
+        end = ((self.columns - 1) * self.hop + self.segment) / self.sample_rate
+        for graph in self.graphs:
+            graph.setXRange(end - self.history_seconds, end, padding=0)
+
+        psd = self.psd_sum / min(self.columns, self.psd_columns)
+        for c in range(self.channels):
+            self.psd_curves[c].setData(self.freqs, 10 * np.log10(psd[c] + 1e-12))
+        cumulative = np.cumsum(psd[:, self.in_band], axis=1)
+        median = self.freqs[self.in_band][np.argmax(cumulative >= cumulative[:, -1:] / 2, axis=1)]
+        self.lmf.setText("Median Frequency: " + ", ".join(f"{SENSORS[c] if c < len(SENSORS) else c+1} {median[c]:.0f} Hz" for c in range(self.channels)))
@@ -3,44 +3,37 @@
 # When alternating whether the grip should be performed or not a green and red border are shown around the image. This in incorporated in the image file (ON/OFF)
 
 import logging
+import time
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
+from AssetCache import PixmapCache
+
 class StimulusDisplayWidget(QWidget):
 
+    sig_stimDisplayed = pyqtSignal(float) # signal emitted once a stim on/off image has been painted, with the perf_counter time it completed (used to measure cue latency)
+
     stims_off = None
     stims_on = None
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, protocol, *args, **kwargs):
     
         super(StimulusDisplayWidget, self).__init__(*args, **kwargs)
         
         self.logger = logging.getLogger("app_logger.StimulusDisplayWidget")
         
         self.logger.info("Setting up widgets.")
-        self.image = QPixmap("assets\Stimulus.png")
-        self.rest_image = QPixmap(r"assets\Neutral_COLOUR.png")
-        
-        # Preload the png files and assign them to arrays in order of performance
-        
-        self.stim_one_off = QPixmap(r"assets\LargeDiameterOff.png")
-        self.stim_one_on = QPixmap(r"assets\LargeDiameterOn.png")
-        self.stim_two_off = QPixmap(r"assets\PowerSphereOff.png")
-        self.stim_two_on = QPixmap(r"assets\PowerSphereOn.png")
-        self.stim_three_off = QPixmap(r"assets\PrecisionSphereOff.png")
-        self.stim_three_on = QPixmap(r"assets\PrecisionSphereOn.png")
-        self.stim_four_off = QPixmap(r"assets\MediumWrapOff.png")
-        self.stim_four_on = QPixmap(r"assets\MediumWrapOn.png")
-        self.stim_five_off = QPixmap(r"assets\ExtendedIndexFingerOff.png")
-        self.stim_five_on = QPixmap(r"assets\ExtendedIndexFingerOn.png")
-        self.stim_six_off = QPixmap(r"assets\AbductedThumbOff.png")
-        self.stim_six_on = QPixmap(r"assets\AbductedThumbOn.png")
-        self.stim_seven_off = QPixmap(r"assets\Neutral_COLOUR.png")
-        self.stim_seven_on = QPixmap(r"assets\Neutral_COLOUR.png")
-        
-        self.stims_off = [self.stim_one_off, self.stim_two_off, self.stim_three_off, self.stim_four_off, self.stim_five_off, self.stim_six_off, self.stim_seven_off]
-        self.stims_on = [self.stim_one_on, self.stim_two_on, self.stim_three_on, self.stim_four_on, self.stim_five_on, self.stim_six_on, self.stim_seven_on]
+        
+        # asset names from the protocol, red bordered (off) and green bordered (on) versions of each grip in the order of their stim value
+        self.rest_image = protocol.rest_image
+        self.stims_off = [g.image_off for g in protocol.grips]
+        self.stims_on = [g.image_on for g in protocol.grips]
+        
+        # Images are shared through the process wide cache, so the main and participant displays decode each png only once, in the background
+        self.cache = PixmapCache.instance()
+        self.cache.preload([self.rest_image] + self.stims_off + self.stims_on)
+        self.current_image = self.rest_image # name of the image currently displayed
         
         self.current_stim = 1 # variable to store the current grip
         
@@ -53,9 +46,14 @@ class StimulusDisplayWidget(QWidget):
         
         self.resetStim() # set a neutral image prior to experiment start
         
+        # after a resize, wait for the size to settle then scale every stimulus frame to the new size in the background
+        self.prescale_timer = QTimer()
+        self.prescale_timer.setSingleShot(True)
+        self.prescale_timer.setInterval(100)
+        self.prescale_timer.timeout.connect(self.prescaleFrames)
         
         self.logger.info("Setting up signals.")
-        
+        self.cache.sig_pixmapReady.connect(self.pixmapReady)
         
         self.logger.info("Setting up layout.")
         layout = QVBoxLayout()
@@ -78,16 +76,14 @@ class StimulusDisplayWidget(QWidget):
     # update the image to the green bordered version of the current grip
     def setStimOn(self):
         if self.stims_on is not None:
-            self.currentPixmap = self.stims_on[self.current_stim-1]
-            self.l.setPixmap(self.currentPixmap.scaled(self.w, self.h, Qt.KeepAspectRatio))
+            self.showFrame(True)
         else:
             self.logger.warning(f"Recieved stim on {self.current_stim} but has no image")
         
     # update the image to the red bordered version of the current grip
     def setStimOff(self):
         if self.stims_on is not None:
-            self.currentPixmap = self.stims_off[self.current_stim-1]
-            self.l.setPixmap(self.currentPixmap.scaled(self.w, self.h, Qt.KeepAspectRatio))
+            self.showFrame(False)
         else:
             self.logger.warning(f"Recieved stim off {self.current_stim} but has no image")
         
@@ -97,12 +93,42 @@ class StimulusDisplayWidget(QWidget):
         
     # set the stimulus image back to the neutral display, occurs between trials    
     def resetStim(self):
-        self.currentPixmap = self.rest_image
-        self.l.setPixmap(self.currentPixmap.scaled(self.w, self.h, Qt.KeepAspectRatio))
+        self.current_image = self.rest_image
+        self.showImage()
+        
+    # asset name for the stimulus frame of a grip, on (green) or off (red). Stim values outside the grips (0 after the final activation) show the rest image
+    def frame(self, stim, on):
+        if stim < 1 or stim > len(self.stims_on):
+            return self.rest_image
+        return self.stims_on[stim-1] if on else self.stims_off[stim-1]
+        
+    # show a stimulus frame as a cue. The frame is painted immediately rather than on the next event loop pass, and the completion time is emitted so the controls can measure the latency from the timer
+    def showFrame(self, on):
+        self.current_image = self.frame(self.current_stim, on)
+        if not self.cache.pixmap(self.current_image).isNull() and not self.cache.hasScaled(self.current_image, self.w, self.h):
+            self.logger.warning(f"Stim {self.current_stim} {'on' if on else 'off'} not prescaled for {self.w}x{self.h}, scaling on cue")
+        self.showImage()
+        self.l.repaint()
+        self.sig_stimDisplayed.emit(time.perf_counter())
+        
+    # display the current image at the label size, frames are prescaled per size so this is normally a lookup
+    def showImage(self):
+        self.l.setPixmap(self.cache.scaled(self.current_image, self.w, self.h))
+        
+    # queue background scaling of all stimulus frames to the current label size
+    def prescaleFrames(self):
+        self.cache.prescale([self.rest_image] + self.stims_off + self.stims_on, self.w, self.h)
+        
+    # callback when the cache finishes decoding an image, refresh if it is the one we are waiting to show and make sure it is prescaled
+    def pixmapReady(self, name):
+        if name == self.current_image:
+            self.showImage()
+        self.prescale_timer.start()
         
     # override an internal QT event; keeps the widget a consistent size when the image is changed
     def resizeEvent(self, rEvnt):
         self.w = self.l.width()
         self.h = self.l.height()
-        self.l.setPixmap(self.currentPixmap.scaled(self.w, self.h, Qt.KeepAspectRatio))
+        self.showImage()
+        self.prescale_timer.start() # restarting the timer on every resize event means only the final size is prescaled
     
\ No newline at end of file
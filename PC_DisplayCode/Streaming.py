@@ -0,0 +1,228 @@
+# Live stream of the decoded data to other processes, e.g. classifiers or visualisers, so they do not need to run inside the acquisition program
+# StreamPublisher listens on a local TCP port ("host:port") or a local socket ("local:<name>", a Unix socket or Windows named pipe) and sends every subscriber
+# the EMG packets with the class of each sample and the IT readings, in a compact binary framing. Each subscriber has its own bounded queue: frames are only passed to the
+# socket while it has less than high_water bytes unsent, and if a subscriber falls queue_frames behind its oldest frames are dropped, so a slow consumer never holds up
+# the acquisition or the other subscribers. A DROPPED frame tells the subscriber how many frames it missed before the next one it receives
+#
+# Frames, little endian: FRAME_HEADER (magic b"MM", version, type, sequence, wall clock time (s since the epoch), payload length) then the payload
+#   HELLO   - JSON stream description {"channels", "sample_rate", "grips"}, the first frame sent to each subscriber, and sent again to all if the device's sampling changes
+#   EMG     - first sample index (u8, counted from the start of the stream), samples (u2), then samples u2 per channel (channel by channel), then the class of each sample u1
+#   IT      - value count of each field (4 x u1) then the values (f8): raw AD5933 values, magnitudes, phases, temperatures of the ITReading (see Schema.py)
+#   DROPPED - number of frames dropped for this subscriber (u4)
+# The sequence number counts frames published, so gaps also show what was dropped. Run this file to subscribe and print the stream, e.g. python Streaming.py 127.0.0.1:5799
+
+import json
+import logging
+import socket
+import struct
+import sys
+import time
+from collections import deque
+
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtNetwork import QHostAddress, QLocalServer, QTcpServer, QAbstractSocket
+
+from Recorder import wallTime
+from Schema import itValues
+
+MAGIC = b"MM"
+VERSION = 1
+FRAME_HEADER = struct.Struct("<2sBBIdI") # magic, version, type, sequence, time, payload length
+EMG_HEADER = struct.Struct("<QH") # first sample, samples
+HELLO, EMG, IT, DROPPED = range(4)
+
+def encodeFrame(frame_type, sequence, t, payload):
+    return FRAME_HEADER.pack(MAGIC, VERSION, frame_type, sequence, t, len(payload)) + payload
+
+# One connected subscriber, with its queue of frames waiting for the socket
+class Subscriber(QObject):
+
+    sig_closed = pyqtSignal() # signal emitted when the subscriber disconnects
+
+    def __init__(self, sock, queue_frames, high_water, *args, **kwargs):
+
+        super(Subscriber, self).__init__(*args, **kwargs)
+
+        self.sock = sock
+        self.queue = deque()
+        self.queue_frames = queue_frames
+        self.high_water = high_water
+        self.dropped = 0 # frames dropped since the subscriber was last told
+        self.total_dropped = 0
+        self.sock.bytesWritten.connect(self.pump)
+        self.sock.disconnected.connect(self.sig_closed)
+
+    def push(self, frame):
+        if len(self.queue) >= self.queue_frames: # slow consumer, drop its oldest frame
+            self.queue.popleft()
+            self.dropped += 1
+            self.total_dropped += 1
+        self.queue.append(frame)
+        self.pump()
+
+    # pass queued frames to the socket while it has room
+    def pump(self, written=0):
+        while len(self.queue) > 0 and self.sock.bytesToWrite() < self.high_water:
+            if self.dropped > 0:
+                self.sock.write(encodeFrame(DROPPED, 0, wallTime(time.perf_counter()), struct.pack("<I", self.dropped)))
+                self.dropped = 0
+            self.sock.write(self.queue.popleft())
+
+class StreamPublisher(QObject):
+
+    queue_frames = 200 # frames a subscriber may fall behind before its oldest are dropped, 10 s of EMG packets
+    high_water = 64 * 1024 # unsent bytes a subscriber socket may hold before frames wait in its queue
+
+    def __init__(self, channels, sample_rate, grips=[], *args, **kwargs):
+
+        super(StreamPublisher, self).__init__(*args, **kwargs)
+
+        self.logger = logging.getLogger("app_logger.StreamPublisher")
+
+        self.grips = grips
+        self.hello = json.dumps({"channels": channels, "sample_rate": sample_rate, "grips": grips}).encode()
+        self.server = None
+        self.subscribers = []
+        self.sequence = 0
+        self.samples = 0 # samples published, the index of the first sample of the next packet
+
+    # start listening, address is "host:port" for TCP or "local:<name>" for a local socket. Returns False if the address could not be used
+    def listen(self, address):
+        if address.startswith("local:"):
+            name = address[len("local:"):]
+            QLocalServer.removeServer(name) # clear a socket file left by a program that did not close
+            self.server = QLocalServer(self)
+            ok = self.server.listen(name)
+        else:
+            host, port = address.rsplit(":", 1)
+            self.server = QTcpServer(self)
+            ok = self.server.listen(QHostAddress(host), int(port))
+        if not ok:
+            self.logger.error(f"Could not publish on {address}: {self.server.errorString()}")
+            return False
+        self.server.newConnection.connect(self.newConnection)
+        self.logger.info(f"Publishing stream on {address}")
+        return True
+
+    # callback for each subscriber connecting
+    def newConnection(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            if isinstance(self.server, QTcpServer):
+                sock.setSocketOption(QAbstractSocket.LowDelayOption, 1) # send each frame immediately rather than coalescing
+            subscriber = Subscriber(sock, self.queue_frames, self.high_water, self)
+            subscriber.sig_closed.connect(self.subscriberClosed)
+            subscriber.push(encodeFrame(HELLO, self.sequence, wallTime(time.perf_counter()), self.hello))
+            self.subscribers.append(subscriber)
+            self.logger.info(f"Subscriber connected, {len(self.subscribers)} connected")
+
+    def subscriberClosed(self):
+        subscriber = self.sender()
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            subscriber.sock.deleteLater()
+            self.logger.info(f"Subscriber disconnected ({subscriber.total_dropped} frames dropped), {len(self.subscribers)} connected")
+
+    # the device connected with a different sampling, subscribers are sent the new description before its packets
+    def setStream(self, channels, sample_rate):
+        self.hello = json.dumps({"channels": channels, "sample_rate": sample_rate, "grips": self.grips}).encode()
+        self.publish(HELLO, wallTime(time.perf_counter()), self.hello)
+
+    def publish(self, frame_type, t, payload):
+        frame = encodeFrame(frame_type, self.sequence, t, payload)
+        self.sequence += 1
+        for subscriber in self.subscribers:
+            subscriber.push(frame)
+
+    # callback for each labelled EMGPacket (see Packets.py)
+    def publishEMG(self, packet):
+        n = len(packet.labels)
+        first = self.samples
+        self.samples += n
+        if len(self.subscribers) == 0:
+            return
+        payload = EMG_HEADER.pack(first, n) + packet.samples.astype('<u2', copy=False).tobytes() + packet.labels.astype(np.uint8).tobytes()
+        self.publish(EMG, wallTime(packet.recv_time), payload)
+
+    # callback for each processed ITReading (see Schema.py)
+    def publishIT(self, reading):
+        if len(self.subscribers) == 0:
+            return
+        payload = bytes([len(field) for field in reading]) + np.asarray(itValues(reading), dtype='<f8').tobytes()
+        self.publish(IT, wallTime(time.perf_counter()), payload)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            if isinstance(self.server, QTcpServer):
+                subscriber.sock.disconnectFromHost()
+            else:
+                subscriber.sock.disconnectFromServer()
+        if self.server is not None:
+            self.server.close()
+
+# decode the payload of a frame: HELLO gives a dict, EMG (first sample, channels array (channels, samples), labels array), IT the four lists of values, DROPPED the count
+def decodePayload(frame_type, payload, channels=2):
+    if frame_type == HELLO:
+        return json.loads(payload.decode())
+    if frame_type == EMG:
+        first, n = EMG_HEADER.unpack_from(payload, 0)
+        data = np.frombuffer(payload, dtype='<u2', count=channels*n, offset=EMG_HEADER.size).reshape(channels, n)
+        labels = np.frombuffer(payload, dtype=np.uint8, count=n, offset=EMG_HEADER.size + channels*n*2)
+        return first, data, labels
+    if frame_type == IT:
+        counts = list(payload[:4])
+        values = np.frombuffer(payload, dtype='<f8', offset=4).tolist()
+        lists, pos = [], 0
+        for c in counts:
+            lists.append(values[pos:pos+c])
+            pos += c
+        return lists
+    if frame_type == DROPPED:
+        return struct.unpack("<I", payload)[0]
+    return payload
+
+# subscribe from another process without Qt, yields (type, sequence, time, decoded payload) for each frame. address as StreamPublisher.listen
+def subscribe(address):
+    if address.startswith("local:"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        name = address[len("local:"):]
+        sock.connect(name if name.startswith("/") else QDir.tempPath() + "/" + name) # QLocalServer puts named sockets in the temp folder
+    else:
+        host, port = address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stream = sock.makefile('rb')
+    channels = 2
+    try:
+        while True:
+            header = stream.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            magic, version, frame_type, sequence, t, length = FRAME_HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Not a version {VERSION} stream")
+            payload = stream.read(length)
+            decoded = decodePayload(frame_type, payload, channels)
+            if frame_type == HELLO:
+                channels = decoded["channels"]
+            yield frame_type, sequence, t, decoded
+    finally:
+        sock.close()
+
+# example subscriber, prints the stream description and once a second the packet rate, latency from the packet being read to it being received here, and any drops
+if __name__ == "__main__":
+    packets, latency, dropped, tic = 0, 0, 0, time.time()
+    for frame_type, sequence, t, decoded in subscribe(sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:5799"):
+        if frame_type == HELLO:
+            print(f"Stream: {decoded}")
+        elif frame_type == EMG:
+            packets += 1
+            latency += time.time() - t
+        elif frame_type == IT:
+            print(f"IT reading: {decoded}")
+        elif frame_type == DROPPED:
+            dropped += decoded
+        if time.time() - tic >= 1:
+            print(f"{packets} packets/s, mean latency {latency/max(packets, 1)*1000:.2f} ms, {dropped} dropped")
+            packets, latency, dropped, tic = 0, 0, 0, time.time()
@@ -2,23 +2,18 @@
 # Display of any warnings or errors detected on the COM bus
 # Display of any warnings or errors sent by the Arduino Host relating to itself, or its sensor units
 # Display of most recent sensor temperature and impedance readings 
+# Display of the electrode model fitted to the most recent impedance sweep (see ImpedanceSweep.py), and of the impedance calibration in use (see Calibration.py)
+# The readings are converted and the sensors polled by the acquisition engine (see Engine.py), this widget only displays them
 
 import logging
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
-from Commands import cmds # import for enum of commands
-
-import numpy as np
-import sys
+from SignalQuality import SENSORS, flagNames, qualityColour
 
 class UtilDisplayWidget(QWidget):
 
-    sig_sensorsReady = pyqtSignal() # signal emitted when the Arduino alerts that sensors are detected on the bus
-    sig_sendCommand = pyqtSignal(int) # signal emitted when a command must be sent to the Arduino 
-    sig_impTempReady = pyqtSignal(list, list, list, list) # signal emitted with the latest processed impedance and temperature readings. Lists are "raw AD5933 values", "calculated magnitudes", "calculated phases", "calculated temperatures"
-
     FCU_temp = 0
     FCU_imp = [0,0]
     FCU_phase = [0,0]
@@ -40,6 +35,14 @@ class UtilDisplayWidget(QWidget):
         self.lcb_t = QLabel("COM Port Info:")
         self.lsd_t = QLabel("Sensors Info: ")
         self.lti_t = QLabel("Current Values: ")
+        self.lpl = QLabel("Normal") # displays the load on the live pipeline
+        self.lpl_t = QLabel("Pipeline:")
+        self.lsq = [QLabel(f"{name}: Unknown") for name in SENSORS] # displays the signal quality of each sensor
+        self.lsq_t = QLabel("Signal Quality:")
+        self.les = QLabel("No sweep") # displays the electrode model fitted to the latest impedance sweep
+        self.les_t = QLabel("Electrodes:")
+        self.lcal = QLabel("Default calibration") # displays the impedance calibration in use
+        self.lcal_t = QLabel("Calibration:")
         
         # initialise values to unknown. \u03A9 is ohm, \u00B0 is degree
         self.lcb.setText("Unknown State")
@@ -57,6 +60,13 @@ class UtilDisplayWidget(QWidget):
         layout.addRow(self.lcb_t, self.lcb)
         layout.addRow(self.lsd_t, self.lsd)
         layout.addRow(self.lti_t, self.lti)
+        layout.addRow(self.les_t, self.les)
+        layout.addRow(self.lcal_t, self.lcal)
+        layout.addRow(self.lpl_t, self.lpl)
+        layout_sq = QHBoxLayout()
+        for label in self.lsq:
+            layout_sq.addWidget(label)
+        layout.addRow(self.lsq_t, layout_sq)
         
         self.setLayout(layout)
         
@@ -69,11 +79,6 @@ class UtilDisplayWidget(QWidget):
         sp.setVerticalPolicy(4)
         self.lti.setSizePolicy(sp)
         
-        # set up a timer for 1 second, which on timeout emits the command to ask the arduino to confirm the sensor precense
-        self.poll_sen_timer = QTimer()
-        self.poll_sen_timer.setInterval(1000)
-        self.poll_sen_timer.timeout.connect(self.check_for_sensors)
-        
         # set up a timer for half a second. Used to flash the port label on disconnect
         self.timer = QTimer()
         self.timer.setSingleShot(True) # do not automatically reset the timer
@@ -108,62 +113,51 @@ class UtilDisplayWidget(QWidget):
             self.lcb.setStyleSheet("QLabel {}")
             self.timer.start()
         
-    # Updates the serial label based on Serial widget detection of the Arduino. If the arduino is connected, begin the polling timer for the sensors    
+    # Updates the serial label based on the engine's detection of the Arduino
     def setComNotification(self, noti):
         self.lcb.setText(noti)
-        if noti == "Arduino Connected":
-            self.poll_sen_timer.start()
             
-    # Updates the sensor label based on the response of the Arduino through the serial widget. If the sensors are both there, end the polling and emit the ready signal, which unlocks the program for recoring
+    # Updates the sensor label based on the response of the Arduino, the engine polls for the sensors until both are connected
     def setDeviceNotification(self, noti):
         self.lsd.setText(noti)
-        if noti == "Connected":
-            self.poll_sen_timer.stop()
-            self.sig_sensorsReady.emit()
             
-    # Function to process the raw impedance and temperature data        
-    def setImpTempData(self, imp, temp):
-        self.ECR_temp = temp[1] * 0.00390625 # the MAX30205 provides this value as a multiplier for the recorded interger value. Performing float maths on the PC is more straightforward so done here
-        self.FCU_temp = temp[0] * 0.00390625
-        
-        # Convert the raw readings to signed intergers 
-        as_i16 = []
-        for i in range(len(imp)):
-            as_i16.append(int.from_bytes(imp[i].to_bytes(2, byteorder=sys.byteorder, signed=False), byteorder=sys.byteorder, signed=True))
+    # Updates the pipeline label when the load on the live pipeline changes (see Pipeline.py). Orange when falling behind, red once display frames are skipped or packets spilled to disk
+    def setPipelineLoad(self, load, depth):
+        if load == "NORMAL":
+            self.lpl.setText("Normal")
+            self.lpl.setStyleSheet("QLabel {}")
+        else:
+            self.lpl.setText(f"{load.capitalize()}, {depth} packets waiting ({depth / 20:.1f} s)")
+            self.lpl.setStyleSheet("QLabel { background-color : orange;}" if load == "BEHIND" else "QLabel { background-color : red;}")
+            
+    # Updates the signal quality indicators, coloured by score (see SignalQuality.py) with any flags raised named
+    def setQuality(self, scores, flags):
+        for label, name, score, flag in zip(self.lsq, SENSORS, scores, flags):
+            label.setText(f"{name}: {score:.0f}" + (f" ({flagNames(flag)})" if flag else ""))
+            label.setStyleSheet(f"QLabel {{ background-color : {qualityColour(score)};}}")
+            
+    # callback when the engine's impedance calibration changes, on connecting a board or saving a calibration
+    def setCalibration(self, description):
+        self.lcal.setText(description[:1].upper() + description[1:])
             
-        # calculate the magnitude and phase values as per the AD5933 datasheet    
-        comb_val = []
-        phase_val = []
-        for i in range(0, len(as_i16), 2):
-            comb_val.append(np.sqrt(as_i16[i]**2 + as_i16[i+1]**2))
-            phase_val.append(np.rad2deg(np.arctan2(as_i16[i+1], as_i16[i])))
-        
-        # apply the previously calculated polynomial fit for each sensor to the recorded magnitude value
-        self.FCU_imp = np.polyval([2.08553599726588e-06, 14.1943911679110, 39.1817314267489], [comb_val[0], comb_val[1]])
-        self.ECR_imp = np.polyval([7.95978542134756e-07, 14.1353065689958, 67.5674420365175], [comb_val[2], comb_val[3]])
-        
-        # apply the open (no DUT) adjustment in phase to the recorded phase
-        self.FCU_phase = [96.991226597164020 - i for i in phase_val[:2]]
-        self.ECR_phase = [95.3347889128904 - i for i in phase_val[2:]]
+    # callback for each impedance sweep from the engine, a SweepResult. Shows the fitted parameters of each electrode, in kilohms, microseconds and nanofarads
+    def setSweep(self, result):
+        names = ["FCU Sen 1", "FCU Sen 2", "ECR Sen 1", "ECR Sen 2"]
+        fit = result.fit
+        if fit.model == "cole":
+            text = [f"{name}: R\u221E {p[0]/1000:.2f}k\u03A9, R0 {p[1]/1000:.1f}k\u03A9, \u03C4 {p[2]*1e6:.1f}\u00B5s, \u03B1 {p[3]:.2f}" for name, p in zip(names, fit.parameters)]
+        else:
+            text = [f"{name}: Rs {p[0]/1000:.2f}k\u03A9, Rp {p[1]/1000:.1f}k\u03A9, C {p[2]*1e9:.1f}nF" for name, p in zip(names, fit.parameters)]
+        self.les.setText(f"{text[0]} {text[1]}\n{text[2]} {text[3]}")
+            
+    # callback for each processed IT reading from the engine, an ITReading (see Schema.py)
+    def setImpTempData(self, reading):
+        self.FCU_imp, self.ECR_imp = reading.magnitude[:2], reading.magnitude[2:]
+        self.FCU_phase, self.ECR_phase = reading.phase[:2], reading.phase[2:]
+        self.FCU_temp, self.ECR_temp = reading.temperature
 
         # update the label with the new values of temperature and impedance for each sensor
         self.lti.setText(f"FCU Temp: {self.FCU_temp}, FCU Imp Sen 1: {int(self.FCU_imp[0])}\u03A9, {int(self.FCU_phase[0])}\u00B0 "
                          f"FCU Imp Sen 2: {int(self.FCU_imp[1])}\u03A9, {int(self.FCU_phase[1])}\u00B0\n"
                          f"ECR Temp: {self.ECR_temp}, ECR Imp Sen 1: {int(self.ECR_imp[0])}\u03A9, {int(self.ECR_phase[0])}\u00B0 "
                          f"ECR Imp Sen 2: {int(self.ECR_imp[1])}\u03A9, {int(self.ECR_phase[1])}\u00B0")
-        
-        # store this data in the log for reference and prior testing
-        self.logger.debug(f"{imp}")
-        self.logger.info(f"FCU Temp: {self.FCU_temp}, FCU Imp Sen 1: {int(self.FCU_imp[0])}, {int(self.FCU_phase[0])} "
-                         f"FCU Imp Sen 2: {int(self.FCU_imp[1])}, {int(self.FCU_phase[1])}    "
-                         f"ECR Temp: {self.ECR_temp}, ECR Imp Sen 1: {int(self.ECR_imp[0])}, {int(self.ECR_phase[0])} "
-                         f"ECR Imp Sen 2: {int(self.ECR_imp[1])}, {int(self.ECR_phase[1])}")
-        
-        # emit a signal indicating the conversion is complete and that the new data can be saved by the control widget (saves raw impedance data also)
-        self.sig_impTempReady.emit(imp, self.FCU_imp.tolist() + self.ECR_imp.tolist(), self.FCU_phase + self.ECR_phase, [self.FCU_temp, self.ECR_temp])
-    
-    # function to store signal emit command on timer finish for checking sensor state on arduino
-    def check_for_sensors(self):
-        self.sig_sendCommand.emit(cmds.CHECK_SEN)
-        
-        
\ No newline at end of file
@@ -7,42 +7,76 @@ Created on Wed Jun 21 2023
 
 # core file, run this to begin the program
 # handles the initial window and logger set up
+# usage: python main.py [protocol] [--stream <address>] [--display-process [emg|participant]] [--review [participant folder]]
+#   --stream          publishes the decoded data to other processes on "host:port" or "local:<name>" (see Streaming.py)
+#   --display-process runs the EMG display (emg, the default) or the EMG display and the participant window (participant) in a separate process, so redraws cannot delay the acquisition (see SharedDisplay.py)
+#   --review          opens the session review window instead of running the experiment, no device is needed
 
 import sys
+import time
 import logging
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import QDateTime, QDir
+
+startup_tic = time.perf_counter() # taken before the Qt imports so the reported startup time includes them
+
+from PyQt5.QtWidgets import QApplication, QMessageBox
+from PyQt5.QtCore import QTimer
+from Engine import startLogging
 from MainWindow import MainWindow
+from ReviewWindow import ReviewWindow
+from Protocol import DEFAULT_PROTOCOL, ProtocolError, loadProtocol
 
-logger = logging.getLogger("app_logger") # setup a logger, each widget creates a new input to the logger, the argument passed is used to show in the log where the message comes from
-logger.setLevel(logging.DEBUG)
-
-# check logs folder, if we have more than 100 logs, clear the oldest
-dir = QDir()
-if not dir.exists("Logs"):
-    dir.mkdir("Logs")
-dir.cd("Logs")
-logs = dir.entryList()
-l_logs = len(logs)
-if l_logs > 100:
-    for i in range(100, l_logs-1):
-        dir.remove(logs[l_logs-i])
-        
-# Determine the output file name of the log
-fh = logging.FileHandler("Logs/log_%s.log" % QDateTime.currentDateTime().toString("yyyy-MM-dd hh-mm-ss"))
-fh.setLevel(logging.DEBUG)
-
-# setup the format of the logger, posts the time, the widget name, the level of message, and the message
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-logger.addHandler(fh)        
+logger = startLogging() # setup a logger, each widget creates a new input to the logger, the argument passed is used to show in the log where the message comes from
 
 logger.info('creating QApp')
 app = QApplication(sys.argv) # begin an app
 
-logger.info('Attaching MainWindow to App')
-window = MainWindow()
+# stream publishing and review mode, optionally given the participant folder to open
+args = sys.argv[1:]
+stream_address = None
+if "--stream" in args:
+    i = args.index("--stream")
+    stream_address = args[i+1] if i + 1 < len(args) else "127.0.0.1:5799"
+    del args[i:i+2]
+display_process = None
+if "--display-process" in args:
+    i = args.index("--display-process")
+    if i + 1 < len(args) and args[i+1] in ["emg", "participant"]:
+        display_process = args[i+1]
+        del args[i:i+2]
+    else:
+        display_process = "emg"
+        del args[i]
+review = "--review" in args
+review_path = None
+if review:
+    i = args.index("--review")
+    if i + 1 < len(args):
+        review_path = args[i+1]
+    args = args[:i]
+
+# load the experiment protocol, optionally given as the first argument (python main.py Protocols/<study>.json). It is validated here so a bad file stops the program before any recording
+protocol_path = args[0] if len(args) > 0 else DEFAULT_PROTOCOL
+try:
+    protocol = loadProtocol(protocol_path)
+except ProtocolError as e:
+    logger.error(f"Invalid protocol: {e}")
+    QMessageBox.critical(None, "Invalid protocol", str(e))
+    sys.exit(1)
+
+window_tic = time.perf_counter()
+if review:
+    logger.info('Attaching ReviewWindow to App')
+    window = ReviewWindow(protocol)
+    if review_path is not None:
+        window.openSession(review_path)
+else:
+    logger.info('Attaching MainWindow to App')
+    window = MainWindow(protocol, stream_address, display_process=display_process)
+logger.info(f"{type(window).__name__} constructed in {(time.perf_counter() - window_tic)*1000:.1f} ms")
 window.show() # show the app
 
+# a zero length timer fires on the first pass of the event loop, i.e. once the windows have been shown
+QTimer.singleShot(0, lambda: logger.info(f"Startup complete in {(time.perf_counter() - startup_tic)*1000:.1f} ms"))
+
 logger.info('Executing event loop')
 app.exec_() # run, starts the QT main loop
\ No newline at end of file
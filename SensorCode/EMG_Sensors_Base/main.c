@@ -36,6 +36,7 @@ enum {
 	SET_AD_RANGE, // Command to set the AD5933 output value (recieve 1 byte)
 	SET_AD_PGA, // Command to set the AD5933 gain (recieve 1 byte)
 	SET_REF_SW, //  Command to manually move the REF electrode between the EMG and impedance subsystems (recieve 1 byte)
+	SET_AD_FREQ, // Command to set the AD5933 excitation frequency in kHz for the impedance reads that follow (recieve 2 bytes)
 };
 
 // Data buffers
@@ -449,6 +450,13 @@ void I2C_SERCOM_IRQ_HANDLER(void) {
 							digitalWrite(SW_REF, true);
 						}
 						break;
+					case SET_AD_FREQ:
+						// each read starts at the start frequency with no increments, so this sets the frequency of the reads (1 to 100 kHz)
+						if (ad5933_enabled && v >= 1 && v <= 100) {
+							i2c_m_sync_set_slaveaddr(&I2C_MST, AD5933_ADDR, I2C_M_SEVEN);
+							AD_set_start_freq(v * 1000UL);
+						}
+						break;
 					default:
 						//do nothing, other registers are not writable
 						break;